@@ -1,3 +1,42 @@
-from .buildconfig import BuildConfig
-from .image import DockerImage
-from .registry import DockerRegistry
+# Exports are imported when first used, so that e.g. `python -m dockerensure --help` starts quickly
+import importlib
+from typing import TYPE_CHECKING
+
+_EXPORTS = {
+    "BuildConfig": ".buildconfig",
+    "ImageGraph": ".graph",
+    "ensure_all": ".graph",
+    "ensure_all_async": ".graph",
+    "plan_all": ".graph",
+    "DockerImage": ".image",
+    "PushPipeline": ".pushpipeline",
+    "DockerRegistry": ".registry",
+    "RunReport": ".report",
+    "TarballCache": ".tarballcache",
+    "GraphFile": ".graphfile",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
+
+
+if TYPE_CHECKING:
+    from .buildconfig import BuildConfig
+    from .graph import ImageGraph, ensure_all, ensure_all_async, plan_all
+    from .graphfile import GraphFile
+    from .image import DockerImage
+    from .pushpipeline import PushPipeline
+    from .registry import DockerRegistry
+    from .report import RunReport
+    from .tarballcache import TarballCache
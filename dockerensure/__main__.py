@@ -0,0 +1,132 @@
+"""
+Command line interface.
+
+Usage:
+python -m dockerensure [--plan | --watch] [--workers N] TARGET...
+(or the dockerensure console script)
+
+Each TARGET names the images to ensure, either as:
+- module:attribute, where the attribute is a DockerImage or a list of them, e.g. "images:app"
+- a TOML or YAML graph file (see GraphFile), to ensure all of its images, e.g. "images.toml"
+- a graph file followed by the keys of some of its images, e.g. "images.toml:app,worker"
+
+All targets are ensured together in one graph, so images they share are only checked and built once.
+With --plan nothing is pulled or built: the plan is printed as JSON instead.
+With --watch the images are kept up to date as their inputs change, until interrupted.
+
+Modules are only imported once the arguments have been parsed, so --help doesn't pay for them.
+"""
+
+import argparse
+import importlib
+import os
+import sys
+
+
+def split_graph_target(target):
+    """Returns (path, keys) if the target refers to a graph file, otherwise None. keys is None for all images"""
+
+    from .graphfile import is_graph_file
+
+    if is_graph_file(target):
+        return target, None
+    path, _, keys = target.rpartition(":")
+    if path and is_graph_file(path):
+        return path, [key for key in keys.split(",") if key]
+    return None
+
+
+def load_target(target, graph_files=None):
+    """
+    Returns the images named by a target. Graph files are loaded once and kept in graph_files
+    (path -> GraphFile), so targets in the same file share their images.
+    """
+
+    from .image import DockerImage
+
+    graph_target = split_graph_target(target)
+    if graph_target is not None:
+        from .graphfile import GraphFile
+
+        path, keys = graph_target
+        if graph_files is None:
+            graph_files = {}
+        key = os.path.abspath(path)
+        if key not in graph_files:
+            graph_files[key] = GraphFile.load(path)
+        return graph_files[key].select(keys)
+
+    module_name, _, attribute = target.partition(":")
+    if not attribute:
+        raise ValueError(
+            f"Target {target} should be a graph file or of the form module:attribute"
+        )
+
+    value = importlib.import_module(module_name)
+    for name in attribute.split("."):
+        value = getattr(value, name)
+
+    if isinstance(value, DockerImage):
+        return [value]
+    return list(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="dockerensure", description="Ensure that Docker images are ready for use"
+    )
+    parser.add_argument(
+        "targets",
+        nargs="+",
+        metavar="TARGET",
+        help="module:attribute, or a TOML/YAML graph file optionally followed by :key,key...",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Print what would be done as JSON, without pulling or building anything",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep ensuring the images as their inputs change",
+    )
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args(argv)
+
+    from . import report
+    from .graph import ensure_all, plan_all
+
+    sys.path.insert(0, os.getcwd())
+    graph_files = {}
+    images = [
+        image for target in args.targets for image in load_target(target, graph_files)
+    ]
+
+    if args.plan:
+        report.remove_listener(report.print_messages)
+        try:
+            print(plan_all(images).to_json())
+        finally:
+            report.add_listener(report.print_messages)
+        return 0
+
+    if args.watch:
+        from .watch import watch
+
+        try:
+            watch(images, max_workers=args.workers)
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    try:
+        ensure_all(images, max_workers=args.workers)
+    finally:
+        for graph_file in graph_files.values():
+            graph_file.save()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+import os
+import sqlite3
+import threading
+import time
+from os import PathLike
+from typing import Dict, Tuple, Union
+
+
+class AbsentCache:
+    """
+    Remembers references that a registry didn't have, so that they aren't looked up again for a while.
+    Entries expire after ttl seconds and are removed when the image is pushed.
+
+    Entries are kept in memory, and also in an SQLite database if a path is given so that later runs
+    (and other processes) can use them.
+
+    Params:
+    ttl: Seconds to remember that a reference is absent for
+    path: Optional database file to persist entries to
+    """
+
+    def __init__(self, ttl: float = 60, path: Union[None, str, PathLike] = None):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.expiry: Dict[Tuple[str, str], float] = {}
+
+        self.connection = None
+        if path is not None:
+            if str(path) != ":memory:":
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.connection = sqlite3.connect(
+                str(path), timeout=30, check_same_thread=False, isolation_level=None
+            )
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS absent (registry TEXT NOT NULL, "
+                "reference TEXT NOT NULL, expires REAL NOT NULL, "
+                "PRIMARY KEY (registry, reference))"
+            )
+
+    def is_absent(self, registry, reference) -> bool:
+        """Returns True if the reference was recently found to be absent from the registry"""
+
+        now = time.time()
+        with self.lock:
+            expires = self.expiry.get((registry, reference))
+            if expires is None and self.connection is not None:
+                row = self.connection.execute(
+                    "SELECT expires FROM absent WHERE registry = ? AND reference = ?",
+                    (registry, reference),
+                ).fetchone()
+                if row is not None:
+                    expires = self.expiry[(registry, reference)] = row[0]
+
+            if expires is None:
+                return False
+            if expires <= now:
+                del self.expiry[(registry, reference)]
+                return False
+            return True
+
+    def add(self, registry, reference):
+        expires = time.time() + self.ttl
+        with self.lock:
+            self.expiry[(registry, reference)] = expires
+            if self.connection is not None:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO absent (registry, reference, expires) "
+                    "VALUES (?, ?, ?)",
+                    (registry, reference, expires),
+                )
+                self.connection.execute(
+                    "DELETE FROM absent WHERE expires <= ?", (time.time(),)
+                )
+
+    def discard(self, registry, reference):
+        """Forgets a reference, e.g. because it has just been pushed"""
+
+        with self.lock:
+            self.expiry.pop((registry, reference), None)
+            if self.connection is not None:
+                self.connection.execute(
+                    "DELETE FROM absent WHERE registry = ? AND reference = ?",
+                    (registry, reference),
+                )
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
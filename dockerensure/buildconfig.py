@@ -1,13 +1,22 @@
-import subprocess
+import asyncio
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from datetime import datetime
 from os import PathLike
 from pathlib import Path
 from typing import List, Optional, Union
 
+from . import report
+from .context import write_context_tar
+from .digestcache import DigestCache, StatHasher
+from .dockerfile import Dockerfile
+from .engine import get_engine
 from .filepolicy import FilePolicy
+from .graph import ImageGraph
 from .hasher import Hasher
-from .utils import IntervalOffset
+from .utils import IntervalOffset, normalize_reference
 
 
 @dataclass
@@ -22,12 +31,20 @@ class BuildConfig:
     dockerfile: The dockerfile to build with
     build_args: Docker build_args
     parents: List of images that this image depends on
-    files: A FilePolicy object describing what files are to be made available to the build
+    files: A FilePolicy object describing what files are to be made available to the build. FilePolicy.FromDockerfile
+        uses the sources of the Dockerfile's COPY and ADD instructions
     metadata: Additional metadata to include in the hash
     interval: An interval to refresh the hash after. For example, if you want to force a re-build every day set this interval to one day
     directory: Directory to set the build context to. Leave as None for the current directory
     unhashed_build_args: Docker build_args that won't be included in the hash. These could include credentials and other data that is required by the build
         but won't affect the built image.
+    stream_context: If true, the build context is sent as a tar stream holding only the files allowed by the file policy,
+        instead of writing a .dockerignore file into the directory
+    digest_cache: Optional DigestCache. If set, the hash is looked up using the files' metadata and only recomputed when a file has changed
+    known_images: Images that the Dockerfile might be built from. Those whose references appear in a FROM line (after
+        build args are substituted) are added to parents automatically
+    prefetch_bases: If true, the external images in FROM lines are pulled concurrently before building, rather than
+        one at a time as the build reaches them
     """
 
     dockerfile: str = "Dockerfile"
@@ -38,14 +55,72 @@ class BuildConfig:
     interval: Optional[IntervalOffset] = None
     directory: Union[None, str, PathLike] = None
     unhashed_build_args: dict = field(default_factory=dict)
+    stream_context: bool = False
+    digest_cache: Optional[DigestCache] = field(default=None, compare=False, repr=False)
+    known_images: List["DockerImage"] = field(
+        default_factory=list, compare=False, repr=False
+    )
+    prefetch_bases: bool = False
 
     def __post_init__(self):
         self.directory = Path(self.directory) if self.directory else None
 
-    def is_hashable(self):
-        if self.files == FilePolicy.All or self.files == FilePolicy.AllBut:
-            return False
+        if self.known_images:
+            self.link_parents()
+
+    def parse_dockerfile(self) -> Dockerfile:
+        """Parses the Dockerfile, resolving FROM lines with the build args"""
+        return Dockerfile.load(
+            self.get_relative(self.dockerfile),
+            {**self.unhashed_build_args, **self.build_args},
+        )
+
+    def link_parents(self):
+        """Adds the known images that the Dockerfile is built from to parents"""
+
+        bases = {
+            normalize_reference(base) for base in self.parse_dockerfile().base_images()
+        }
+        parents = list(self.parents)
+        for image in self.known_images:
+            if normalize_reference(image.ref) in bases and image not in parents:
+                parents.append(image)
+        self.parents = parents
+
+    def external_bases(self) -> List[str]:
+        """Returns the images in FROM lines that aren't built from parents"""
+
+        parents = {normalize_reference(parent.ref) for parent in self.parents}
+        return [
+            base
+            for base in self.parse_dockerfile().base_images()
+            if normalize_reference(base) not in parents
+        ]
+
+    def prefetch(self, max_workers=4):
+        """
+        Pulls the external base images that don't exist locally, concurrently. Failures are ignored here,
+        as the build itself will report them.
+        """
+
+        engine = get_engine()
+
+        def fetch(base):
+            if engine.image_exists(base):
+                return
+            with report.phase(base, "prefetch"):
+                try:
+                    engine.pull(base)
+                except Exception as e:
+                    report.message(base, f"Failed to prefetch base image: {e}")
 
+        bases = self.external_bases()
+        if bases:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(fetch, bases))
+
+    def is_hashable(self):
+        """All file policies can be hashed, so this is always True"""
         return True
 
     def get_relative(self, path):
@@ -54,29 +129,78 @@ class BuildConfig:
 
         return self.directory / path
 
+    def file_policy(self):
+        """Returns the file policy, with FilePolicy.FromDockerfile resolved to the paths that the Dockerfile uses"""
+
+        if self.files != FilePolicy.FromDockerfile:
+            return self.files
+
+        sources = self.parse_dockerfile().copy_sources()
+        if sources is None:
+            return FilePolicy.All
+        if not sources:
+            return FilePolicy.Nothing
+        return FilePolicy.Only(sources)
+
+    def hashes_file_contents(self, files=None):
+        """
+        Returns True if the files policy lists plain files, which are hashed directly.
+        Otherwise the whole build context is walked and folded into a tree digest.
+        """
+
+        files = files or self.file_policy()
+        if type(files) != FilePolicy.Only:
+            return False
+
+        return not any(
+            glob.has_magic(file) or os.path.isdir(self.get_relative(file))
+            for file in files.exceptions
+        )
+
     def add_files_to_hash(self, hasher):
         """Adds the files specified by the file policy to the state hash"""
 
-        assert self.files != FilePolicy.All
-        assert self.files != FilePolicy.AllBut
+        files = self.file_policy()
+        if files == FilePolicy.Nothing:
+            return
 
-        if self.files == FilePolicy.Nothing:
+        if self.hashes_file_contents(files):
+            hasher.add_files(self.get_relative(file) for file in files.exceptions)
             return
 
-        if type(self.files) == FilePolicy.Only:
-            for file in self.files.exceptions:
-                hasher.add_file(self.get_relative(file))
+        hasher.add_tree(self.directory or ".", self.docker_ignore_lines())
 
     def get_hash(self):
         """Returns a hash of all build state"""
 
-        hasher = Hasher()
+        if self.digest_cache is None:
+            return self.add_state_to_hash(Hasher())
+
+        key = self.add_state_to_hash(StatHasher())
+        digest = self.digest_cache.get(key)
+        if digest is None:
+            report.count("digest_cache_misses")
+            digest = self.add_state_to_hash(Hasher(digest_cache=self.digest_cache))
+            self.digest_cache.put(key, digest)
+        else:
+            report.count("digest_cache_hits")
+
+        return digest
+
+    def add_state_to_hash(self, hasher):
+        """
+        Adds all build state to the given hasher and returns its digest.
+
+        The references of the parents are included, so when a parent's hash changes, so do the hashes
+        of everything built from it. References are cached on each image, so every parent is only hashed once.
+        """
+
         hasher.add_file(self.get_relative(self.dockerfile))
         for arg, value in self.build_args.items():
             hasher.add_str(arg)
             hasher.add_str(value)
         for parent in self.parents:
-            hasher.add_str(parent.name)
+            hasher.add_str(parent.reference)
 
         self.add_files_to_hash(hasher)
 
@@ -86,39 +210,118 @@ class BuildConfig:
 
         return hasher.hexdigest()
 
-    def create_docker_ignore_file(self):
+    def docker_ignore_lines(self):
         """
-        Create a dockerignore file that either ignores everything but the given dependencies
-        or ignores the given exclude paths.
+        Returns dockerignore lines that either ignore everything but the given dependencies
+        or ignore the given exclude paths.
         """
 
         lines = []
-        policy_class = type(self.files)
-        if self.files == FilePolicy.Nothing:
+        files = self.file_policy()
+        policy_class = type(files)
+        if files == FilePolicy.Nothing:
             lines = ["**"]
         elif policy_class == FilePolicy.Only:
-            lines = ["**"] + [f"!{path}" for path in self.files.exceptions]
+            lines = ["**"] + [f"!{path}" for path in files.exceptions]
         elif policy_class == FilePolicy.AllBut:
-            lines = self.files.exceptions
-        elif self.files == FilePolicy.All:
+            lines = files.exceptions
+        elif files == FilePolicy.All:
             lines = []
 
+        return lines
+
+    def create_docker_ignore_file(self):
+        """Create a dockerignore file from docker_ignore_lines"""
+
+        lines = self.docker_ignore_lines()
         with open(self.get_relative(".dockerignore"), "w") as ignore_file:
             ignore_file.write("\n".join(lines))
 
-    def build_image(self, name):
+    def build_image(
+        self,
+        name,
+        ensure_parents=True,
+        push_pipeline=None,
+        cache_from=(),
+        cache_to=None,
+    ):
         """
         Builds an image with the config contained in this class.
 
-        Parent images that this image depends on will be prepared first.
+        Parent images that this image depends on will be prepared first, unless ensure_parents is False
+        (e.g. because they have already been ensured by an ImageGraph). Parents that are built are pushed
+        through push_pipeline if one is given. cache_from and cache_to are passed on to the engine (see Engine.build).
         """
-        for parent in self.parents:
-            parent.ensure()
+        if ensure_parents:
+            self.ensure_parents(push_pipeline)
+        if self.prefetch_bases:
+            self.prefetch()
+
+        get_engine().build(
+            name,
+            self.directory,
+            self.dockerfile,
+            {**self.unhashed_build_args, **self.build_args},
+            context=self.prepare_context(),
+            cache_from=cache_from,
+            cache_to=cache_to,
+        )
+
+    def ensure_parents(self, push_pipeline=None):
+        """
+        Ensures the parent images and, recursively, their parents. Each image is ensured once, after its
+        own parents, even if it is shared by several of them. When there are several, their existence is
+        checked in batches up front (see ImageGraph.resolve_existence).
+        """
+        graph = ImageGraph(self.parents)
+        try:
+            if len(graph) > 1:
+                graph.resolve_existence()
+            for parent in graph:
+                parent.ensure(ensure_parents=False, push_pipeline=push_pipeline)
+        finally:
+            graph.forget_existence()
+
+    async def ensure_parents_async(self):
+        """Async variant of ensure_parents. Independent parents are ensured concurrently"""
+
+        # Building the graph hashes the parents, so it happens in the executor
+        loop = asyncio.get_running_loop()
+        graph = await loop.run_in_executor(None, ImageGraph, self.parents)
+        await graph.ensure_async()
+
+    def prepare_context(self):
+        """
+        Prepares the build context. Returns a function writing the context tar if it is streamed, otherwise
+        writes the .dockerignore file and returns None so that the directory is sent as it is.
+        """
+
+        if not self.stream_context:
+            self.create_docker_ignore_file()
+            return None
+
+        directory = self.directory or "."
+        lines = self.docker_ignore_lines()
+        return lambda fileobj: write_context_tar(
+            directory, lines, self.dockerfile, fileobj
+        )
 
-        self.create_docker_ignore_file()
+    async def build_image_async(
+        self, name, ensure_parents=True, cache_from=(), cache_to=None
+    ):
+        """Async variant of build_image. Parents are ensured concurrently"""
 
-        args = ["docker", "build", "-t", name, ".", "-f", self.dockerfile]
-        for arg, value in {**self.unhashed_build_args, **self.build_args}.items():
-            args.extend(["--build-arg", f"{arg}={value}"])
+        if ensure_parents:
+            await self.ensure_parents_async()
+        if self.prefetch_bases:
+            await asyncio.get_running_loop().run_in_executor(None, self.prefetch)
 
-        subprocess.run(args, check=True, cwd=self.directory)
+        await get_engine().build_async(
+            name,
+            self.directory,
+            self.dockerfile,
+            {**self.unhashed_build_args, **self.build_args},
+            context=self.prepare_context(),
+            cache_from=cache_from,
+            cache_to=cache_to,
+        )
@@ -0,0 +1,109 @@
+import http.client
+import threading
+from contextlib import contextmanager
+from typing import Callable
+
+
+class ConnectionPool:
+    """
+    Keeps idle keep-alive HTTP connections to one server so that requests don't each pay for a new connection.
+    Safe to use from several threads; each request gets a connection of its own.
+
+    Params:
+    factory: Creates a new, unconnected http.client.HTTPConnection
+    max_idle: Maximum number of idle connections to keep open
+    """
+
+    def __init__(
+        self, factory: Callable[[], http.client.HTTPConnection], max_idle: int = 4
+    ):
+        self.factory = factory
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def _connection(self, reuse=True):
+        if reuse:
+            with self.lock:
+                if self.idle:
+                    return self.idle.pop(), True
+        return self.factory(), False
+
+    def _release(self, connection, response):
+        if response.will_close:
+            connection.close()
+            return
+
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def _send(self, method, url, body, headers, encode_chunked):
+        """
+        Makes a request and returns (connection, response), with the response body still unread.
+        A streamed body (an iterator) can only be sent once, so it always gets a fresh connection
+        rather than an idle one that the server may have closed.
+        """
+
+        replayable = body is None or isinstance(body, (bytes, str))
+        while True:
+            connection, reused = self._connection(reuse=replayable)
+            try:
+                connection.request(
+                    method,
+                    url,
+                    body=body,
+                    headers=headers or {},
+                    encode_chunked=encode_chunked,
+                )
+                return connection, connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                connection.close()
+                if reused:
+                    # The server may have closed an idle connection, so try again on a fresh one
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+
+    def request(self, method, url, body=None, headers=None, encode_chunked=False):
+        """
+        Makes a request and returns (response, body). The whole response is read so that the
+        connection can be reused.
+        """
+
+        connection, response = self._send(method, url, body, headers, encode_chunked)
+        try:
+            data = response.read()
+        except Exception:
+            connection.close()
+            raise
+
+        self._release(connection, response)
+        return response, data
+
+    @contextmanager
+    def stream(self, method, url, body=None, headers=None, encode_chunked=False):
+        """
+        Makes a request and yields the response, so that its body can be read as it arrives. Whatever the
+        block leaves unread is read afterwards so that the connection can be reused, unless the block raised.
+        """
+
+        connection, response = self._send(method, url, body, headers, encode_chunked)
+        try:
+            yield response
+            response.read()
+        except BaseException:
+            connection.close()
+            raise
+
+        self._release(connection, response)
+
+    def close(self):
+        with self.lock:
+            for connection in self.idle:
+                connection.close()
+            self.idle = []
@@ -0,0 +1,318 @@
+import hashlib
+import io
+import os
+import re
+import stat
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from . import report
+
+
+def _translate(pattern):
+    """Converts a .dockerignore pattern into a regular expression, following Docker's patternmatcher"""
+
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "*":
+            if pattern[i + 1 : i + 2] == "*":
+                i += 1
+                if pattern[i + 1 : i + 2] == "/":
+                    # "**/" matches zero or more directories
+                    i += 1
+                    regex += "(.*/)?"
+                else:
+                    regex += ".*"
+            else:
+                regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "\\" and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        elif char == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                regex += re.escape(char)
+            else:
+                group = pattern[i + 1 : end]
+                if group.startswith("^") or group.startswith("!"):
+                    group = "^" + group[1:]
+                regex += "[" + group.replace("\\", "\\\\") + "]"
+                i = end
+        else:
+            regex += re.escape(char)
+        i += 1
+
+    return re.compile("^" + regex + "$")
+
+
+class IgnoreMatcher:
+    """
+    Matches relative paths against .dockerignore lines, with the same semantics as the Docker CLI:
+    later lines win, lines starting with ! re-include paths, and a pattern matching a directory
+    also matches everything inside it.
+    """
+
+    def __init__(self, lines: List[str]):
+        self.patterns: List[Tuple[re.Pattern, bool, str]] = []
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            negation = line.startswith("!")
+            if negation:
+                line = line[1:].strip()
+
+            line = os.path.normpath(line).replace(os.sep, "/").lstrip("/")
+            if line in ("", "."):
+                continue
+
+            self.patterns.append((_translate(line), negation, line))
+
+        self.has_negations = any(negation for _, negation, _ in self.patterns)
+
+    def match(self, path, parent_matches=None) -> Tuple[bool, Tuple[bool, ...]]:
+        """
+        Returns whether the path is excluded, and which patterns matched it.
+        parent_matches is the second return value for the path's parent directory, which saves
+        re-checking every parent of every path.
+        """
+
+        if parent_matches is None:
+            parent_matches = (False,) * len(self.patterns)
+
+        excluded = False
+        matches = []
+        for (regex, negation, _), parent_match in zip(self.patterns, parent_matches):
+            matched = parent_match or regex.match(path) is not None
+            matches.append(matched)
+            if matched:
+                excluded = not negation
+
+        return excluded, tuple(matches)
+
+    def is_excluded(self, path):
+        matches = None
+        parts = path.split("/")
+        for i in range(1, len(parts) + 1):
+            excluded, matches = self.match("/".join(parts[:i]), matches)
+        return excluded
+
+    def can_prune(self, directory):
+        """Returns True if nothing inside an excluded directory can be re-included by a ! line"""
+
+        if not self.has_negations:
+            return True
+
+        return not any(
+            negation and _could_match_inside(pattern, directory)
+            for _, negation, pattern in self.patterns
+        )
+
+
+def _could_match_inside(pattern, directory):
+    """Returns True if the pattern could match a path inside the directory"""
+
+    pattern_parts = pattern.split("/")
+    directory_parts = directory.split("/")
+    if len(pattern_parts) <= len(directory_parts) and "**" not in pattern:
+        return False
+
+    for pattern_part, directory_part in zip(pattern_parts, directory_parts):
+        if "**" in pattern_part:
+            return True
+        if not _translate(pattern_part).match(directory_part):
+            return False
+
+    return True
+
+
+def walk_context(directory, ignore_lines: List[str]) -> Iterator[Tuple[str, str]]:
+    """
+    Walks a build context, yielding (relative path, absolute path) for every file that Docker would send
+    with the given .dockerignore lines. Paths use / as the separator. Excluded directories are skipped
+    without being read where possible.
+
+    The .dockerignore file at the root of the context is never included, since it is generated by the build.
+    """
+
+    matcher = IgnoreMatcher(ignore_lines)
+    root = os.path.abspath(directory)
+
+    def walk(path, relative, parent_matches):
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+
+        for entry in entries:
+            entry_relative = relative + entry.name
+            if entry_relative == ".dockerignore":
+                continue
+
+            excluded, matches = matcher.match(entry_relative, parent_matches)
+            if entry.is_dir(follow_symlinks=False):
+                if excluded and matcher.can_prune(entry_relative):
+                    continue
+                yield from walk(entry.path, entry_relative + "/", matches)
+            elif not excluded:
+                yield entry_relative, entry.path
+
+    yield from walk(root, "", None)
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """
+    Returns the digest of a single file's contents. Symlinks are hashed by their target
+    and the executable bit is included as it is preserved in the image.
+    """
+
+    if os.path.islink(path):
+        return hashlib.sha256(b"link\0" + os.readlink(path).encode("utf-8")).hexdigest()
+
+    executable = os.stat(path).st_mode & stat.S_IXUSR
+    hash = hashlib.sha256(b"x\0" if executable else b"f\0")
+    total = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hash.update(chunk)
+            total += len(chunk)
+    report.count("bytes_hashed", total)
+    return hash.hexdigest()
+
+
+def tree_digest(digests: Dict[str, str]) -> str:
+    """
+    Folds a mapping of relative path -> file digest into a single Merkle-style digest,
+    where each directory's digest is the hash of its sorted children.
+    """
+
+    tree = {}
+    for path, digest in digests.items():
+        node = tree
+        *directories, name = path.split("/")
+        for directory in directories:
+            node = node.setdefault(directory, {})
+        node[name] = digest
+
+    def fold(node):
+        hash = hashlib.sha256()
+        for name in sorted(node):
+            child = node[name]
+            if isinstance(child, dict):
+                hash.update(f"d {name} {fold(child)}\n".encode("utf-8"))
+            else:
+                hash.update(f"f {name} {child}\n".encode("utf-8"))
+        return hash.hexdigest()
+
+    return fold(tree)
+
+
+def context_digest(
+    directory,
+    ignore_lines: List[str],
+    digest: Callable[[str], str] = file_digest,
+    max_workers=8,
+    batch_size=256,
+):
+    """
+    Returns a tree digest of every file in the build context. Files are digested concurrently
+    using the given function, in batches so that many small files don't drown in scheduling overhead.
+    """
+
+    paths = list(walk_context(directory, ignore_lines))
+    batches = [
+        [path for _, path in paths[i : i + batch_size]]
+        for i in range(0, len(paths), batch_size)
+    ]
+
+    def digest_batch(batch):
+        return [digest(path) for path in batch]
+
+    if len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            digests = [
+                d for batch in executor.map(digest_batch, batches) for d in batch
+            ]
+    else:
+        digests = [d for batch in batches for d in digest_batch(batch)]
+
+    return tree_digest(dict(zip([relative for relative, _ in paths], digests)))
+
+
+def _reset_owner(info):
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    return info
+
+
+def write_context_tar(directory, ignore_lines: List[str], dockerfile, fileobj):
+    """
+    Writes the build context as an uncompressed tar stream to fileobj, containing only the files that
+    the .dockerignore lines allow. Files are streamed one at a time, so the archive is never held in memory.
+
+    The Dockerfile is always included, along with a .dockerignore holding the given lines so that the
+    daemon can still hide the Dockerfile from COPY instructions if it is excluded.
+    """
+
+    dockerfile = os.path.normpath(dockerfile).replace(os.sep, "/")
+    with tarfile.open(fileobj=fileobj, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+        included_dockerfile = False
+        for relative, path in walk_context(directory, ignore_lines):
+            tar.add(path, arcname=relative, recursive=False, filter=_reset_owner)
+            included_dockerfile |= relative == dockerfile
+
+        if not included_dockerfile:
+            tar.add(
+                os.path.join(directory, dockerfile),
+                arcname=dockerfile,
+                recursive=False,
+                filter=_reset_owner,
+            )
+
+        ignore_file = "\n".join(ignore_lines).encode("utf-8")
+        info = tarfile.TarInfo(".dockerignore")
+        info.size = len(ignore_file)
+        tar.addfile(info, io.BytesIO(ignore_file))
+
+
+class ContextStream:
+    """
+    Runs a function writing a build context on a background thread, feeding a pipe that can be passed
+    to a process as stdin or read as a request body. Use as a context manager; errors from the writer
+    are raised on exit, in preference to the reader's error as they are the cause of it.
+    """
+
+    def __init__(self, write):
+        read_fd, write_fd = os.pipe()
+        self.reader = os.fdopen(read_fd, "rb")
+        self.error = None
+
+        def run():
+            try:
+                with os.fdopen(write_fd, "wb") as writer:
+                    write(writer)
+            except BrokenPipeError:
+                # The reader stopped early; it will report its own error
+                pass
+            except Exception as e:
+                self.error = e
+
+        self.thread = threading.Thread(target=run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def chunks(self, size=64 * 1024):
+        return iter(lambda: self.reader.read(size), b"")
+
+    def __exit__(self, *exc):
+        self.reader.close()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,136 @@
+import os
+import sqlite3
+import threading
+from os import PathLike
+from typing import Optional, Union
+
+from . import report
+from .context import context_digest, file_digest
+from .hasher import Hasher
+from .utils import default_cache_dir
+
+
+def stat_key(path):
+    """
+    Returns a string identifying the current state of a file from its metadata alone:
+    (path, size, mtime_ns, inode, device). If any of these change the file is assumed to have changed.
+    """
+
+    st = os.stat(path)
+    return "\0".join(
+        [
+            os.path.abspath(path),
+            str(st.st_size),
+            str(st.st_mtime_ns),
+            str(st.st_ino),
+            str(st.st_dev),
+        ]
+    )
+
+
+class StatHasher(Hasher):
+    """
+    A Hasher that adds file metadata (see stat_key) instead of file contents.
+    Hashing the same inputs with it gives a cheap key for looking up the real digest.
+    """
+
+    def add_file(self, path):
+        self.add_str(stat_key(path))
+
+    def add_files(self, paths, buffers=4):
+        for path in paths:
+            self.add_file(path)
+
+    def add_tree(self, directory, ignore_lines):
+        self.add_str(context_digest(directory, ignore_lines, stat_key))
+
+
+class DigestCache:
+    """
+    Persistent cache of digests stored in an SQLite database, so that unchanged inputs don't need to be
+    re-read on every run. Safe to share between threads and processes.
+
+    Params:
+    path: The database file. Defaults to digests.sqlite in the dockerensure cache directory
+    max_entries: Once there are more entries than this, the least recently used ones are removed
+    """
+
+    def __init__(
+        self, path: Union[None, str, PathLike] = None, max_entries: int = 100000
+    ):
+        if path is None:
+            path = default_cache_dir() / "digests.sqlite"
+        if str(path) != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            str(path), timeout=30, check_same_thread=False, isolation_level=None
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS digests "
+            "(key TEXT PRIMARY KEY, digest TEXT NOT NULL, used INTEGER NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS digests_used ON digests (used)"
+        )
+
+    def _next_use(self):
+        row = self.connection.execute("SELECT MAX(used) FROM digests").fetchone()
+        return (row[0] or 0) + 1
+
+    def get(self, key) -> Optional[str]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT digest FROM digests WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            self.connection.execute(
+                "UPDATE digests SET used = ? WHERE key = ?", (self._next_use(), key)
+            )
+            return row[0]
+
+    def put(self, key, digest):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO digests (key, digest, used) VALUES (?, ?, ?)",
+                (key, digest, self._next_use()),
+            )
+            self._evict()
+
+    def file_digest(self, path):
+        """Returns the digest of a file's contents, only reading it if its metadata has changed"""
+
+        key = stat_key(path)
+        digest = self.get(key)
+        if digest is None:
+            report.count("digest_cache_misses")
+            digest = file_digest(path)
+            self.put(key, digest)
+        else:
+            report.count("digest_cache_hits")
+        return digest
+
+    def _evict(self):
+        (count,) = self.connection.execute("SELECT COUNT(*) FROM digests").fetchone()
+        if count <= self.max_entries:
+            return
+
+        self.connection.execute(
+            "DELETE FROM digests WHERE key IN "
+            "(SELECT key FROM digests ORDER BY used LIMIT ?)",
+            (count - self.max_entries,),
+        )
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM digests").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,242 @@
+import json
+import re
+import shlex
+from dataclasses import dataclass, field
+from os import PathLike
+from typing import Dict, List, Optional, Union
+
+_VARIABLE = re.compile(r"\$(?:\{(\w+)(?::([-+])([^}]*))?\}|(\w+))")
+# A heredoc in a RUN, COPY or ADD instruction, e.g. <<EOF, <<-EOF or <<"EOF"
+_HEREDOC = re.compile(r"(?:^|\s)<<(-?)([\"']?)([A-Za-z_]\w*)\2")
+_HEREDOC_KEYWORDS = ("RUN", "COPY", "ADD")
+
+
+def substitute(value, variables: Dict[str, str]):
+    """
+    Replaces $NAME, ${NAME}, ${NAME:-default} and ${NAME:+alternative} the way Docker does.
+    Unknown variables are replaced with an empty string.
+    """
+
+    def replace(match):
+        name = match.group(1) or match.group(4)
+        current = variables.get(name)
+        if match.group(2) == "-":
+            return current if current else match.group(3)
+        if match.group(2) == "+":
+            return match.group(3) if current else ""
+        return current or ""
+
+    return _VARIABLE.sub(replace, value)
+
+
+@dataclass
+class Instruction:
+    """
+    One instruction of a Dockerfile.
+
+    keyword: The upper case instruction, e.g. FROM
+    flags: Leading --name=value flags, e.g. {"from": "builder"} for COPY --from=builder
+    value: The rest of the instruction, with line continuations joined
+    stage: Index of the build stage that the instruction is in. Instructions before the first FROM are in stage -1
+    """
+
+    keyword: str
+    flags: Dict[str, str]
+    value: str
+    stage: int
+
+
+@dataclass
+class Stage:
+    """A build stage, started by a FROM instruction"""
+
+    base: str  # The image the stage is built from, with build args substituted
+    name: Optional[str] = None
+    instructions: List[Instruction] = field(default_factory=list)
+
+
+def _split_flags(value):
+    flags = {}
+    while value.startswith("--"):
+        flag, _, value = value.partition(" ")
+        name, _, flag_value = flag[2:].partition("=")
+        flags[name.lower()] = flag_value
+        value = value.lstrip()
+    return flags, value
+
+
+def parse_instructions(text) -> List[Instruction]:
+    """
+    Splits a Dockerfile into instructions, joining continued lines and skipping comments and the bodies of
+    heredocs, which are left in the value of their instruction as the <<EOF marker.
+    """
+
+    instructions = []
+    stage = -1
+    pending = ""
+    # (terminator, whether leading tabs are stripped) of the heredocs whose bodies follow
+    heredocs = []
+    for line in text.splitlines():
+        if heredocs:
+            terminator, strip_tabs = heredocs[0]
+            if (line.lstrip("\t") if strip_tabs else line) == terminator:
+                heredocs.pop(0)
+            continue
+
+        stripped = line.strip()
+        if not pending and (not stripped or stripped.startswith("#")):
+            continue
+        if pending and stripped.startswith("#"):
+            # Comments may appear between continued lines
+            continue
+
+        if stripped.endswith("\\"):
+            pending += stripped[:-1] + " "
+            continue
+        full = (pending + stripped).strip()
+        pending = ""
+        if not full:
+            continue
+
+        keyword, _, value = full.partition(" ")
+        keyword = keyword.upper()
+        if keyword == "FROM":
+            stage += 1
+        flags, value = _split_flags(value.strip())
+        instructions.append(Instruction(keyword, flags, value, stage))
+        if keyword in _HEREDOC_KEYWORDS:
+            heredocs = [
+                (match.group(3), bool(match.group(1)))
+                for match in _HEREDOC.finditer(value)
+            ]
+
+    return instructions
+
+
+class Dockerfile:
+    """
+    A parsed Dockerfile. FROM lines are resolved using the global ARGs (those before the first FROM),
+    with values from build_args taking priority over their defaults.
+
+    Params:
+    text: The contents of the Dockerfile
+    build_args: The build args that the image will be built with
+    """
+
+    def __init__(self, text, build_args: Optional[Dict[str, str]] = None):
+        self.build_args = dict(build_args or {})
+        self.instructions = parse_instructions(text)
+        self.global_args: Dict[str, str] = {}
+        self.stages: List[Stage] = []
+
+        for instruction in self.instructions:
+            if instruction.keyword == "ARG" and instruction.stage == -1:
+                self.global_args.update(self._declare(instruction, self.global_args))
+            elif instruction.keyword == "FROM":
+                words = substitute(instruction.value, self.global_args).split()
+                name = None
+                if len(words) >= 3 and words[1].upper() == "AS":
+                    name = words[2].lower()
+                self.stages.append(Stage(words[0] if words else "", name))
+            elif instruction.stage >= 0:
+                self.stages[instruction.stage].instructions.append(instruction)
+
+    @classmethod
+    def load(cls, path: Union[str, PathLike], build_args=None):
+        with open(path) as f:
+            return cls(f.read(), build_args)
+
+    def _declare(self, instruction, variables):
+        """Returns the variables declared by an ARG instruction"""
+        declared = {}
+        for word in shlex.split(instruction.value):
+            name, has_default, default = word.partition("=")
+            if name in self.build_args:
+                declared[name] = self.build_args[name]
+            elif has_default:
+                declared[name] = substitute(default, {**variables, **declared})
+        return declared
+
+    def _stage_variables(self, instruction, variables):
+        """Returns the variables after an ARG or ENV instruction inside a stage"""
+
+        if instruction.keyword == "ARG":
+            declared = {}
+            for word in shlex.split(instruction.value):
+                name, has_default, default = word.partition("=")
+                if name in self.build_args:
+                    declared[name] = self.build_args[name]
+                elif has_default:
+                    declared[name] = substitute(default, {**variables, **declared})
+                elif name in self.global_args:
+                    declared[name] = self.global_args[name]
+            return {**variables, **declared}
+
+        words = shlex.split(instruction.value)
+        if words and "=" not in words[0]:
+            # Legacy form: ENV NAME value
+            return {**variables, words[0]: substitute(" ".join(words[1:]), variables)}
+        declared = dict(word.partition("=")[::2] for word in words)
+        return {
+            **variables,
+            **{name: substitute(value, variables) for name, value in declared.items()},
+        }
+
+    def copy_sources(self) -> Optional[List[str]]:
+        """
+        Returns the context paths used by COPY and ADD instructions, relative to the build context, with
+        variables substituted. Sources copied from other stages or images (--from), remote URLs and heredocs
+        are skipped. Returns None if an instruction copies the whole context.
+        """
+
+        sources = []
+        for stage in self.stages:
+            variables = {}
+            for instruction in stage.instructions:
+                if instruction.keyword in ("ARG", "ENV"):
+                    variables = self._stage_variables(instruction, variables)
+                    continue
+                if (
+                    instruction.keyword not in ("COPY", "ADD")
+                    or "from" in instruction.flags
+                ):
+                    continue
+
+                value = instruction.value
+                if value.startswith("["):
+                    words = json.loads(value)
+                else:
+                    words = shlex.split(value)
+                for source in words[:-1]:
+                    source = substitute(source, variables)
+                    if source.startswith("<<") or re.match(r"^(\w+://|git@)", source):
+                        continue
+
+                    source = source.lstrip("/")
+                    while source.startswith("./"):
+                        source = source[2:]
+                    source = source.rstrip("/")
+                    if source in ("", "."):
+                        return None
+                    if source not in sources:
+                        sources.append(source)
+
+        return sources
+
+    def stage_names(self):
+        return {stage.name for stage in self.stages if stage.name}
+
+    def base_images(self) -> List[str]:
+        """
+        Returns the images that the Dockerfile is built from, excluding earlier stages and scratch.
+        """
+
+        bases = []
+        names = set()
+        for stage in self.stages:
+            is_stage = stage.base.lower() in names
+            if not is_stage and stage.base != "scratch" and stage.base not in bases:
+                bases.append(stage.base)
+            if stage.name:
+                names.add(stage.name)
+        return bases
@@ -0,0 +1,647 @@
+import asyncio
+import base64
+import functools
+import http.client
+import json
+import os
+import shutil
+import socket
+import subprocess
+from typing import Dict, Optional, Sequence, Set
+from urllib.parse import quote, urlencode
+
+from . import report
+from .connpool import ConnectionPool
+from .context import ContextStream
+from .utils import normalize_reference, registry_host, split_reference
+
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class Engine:
+    """
+    Interface to the Docker daemon. All image operations go through an engine so the way of talking to Docker
+    can be swapped out. Methods raise an exception if the operation fails.
+    """
+
+    def image_exists(self, reference) -> bool:
+        raise NotImplementedError
+
+    def list_images(self) -> Dict[str, str]:
+        """Returns a mapping of every tagged local image reference to its image ID"""
+        raise NotImplementedError
+
+    def image_id(self, reference) -> Optional[str]:
+        """Returns the ID of a local image, or None if it doesn't exist"""
+        return self.list_images().get(normalize_reference(reference))
+
+    def pull(self, reference):
+        raise NotImplementedError
+
+    def push(self, reference):
+        raise NotImplementedError
+
+    def tag(self, source, target):
+        raise NotImplementedError
+
+    def remove_image(self, reference):
+        """Removes a tag. The image itself is deleted once it has no tags left"""
+        raise NotImplementedError
+
+    def image_size(self, reference) -> Optional[int]:
+        """Returns the size of a local image in bytes, or None if it doesn't exist"""
+        raise NotImplementedError
+
+    def save(self, reference, file):
+        """Writes an image to a binary file object as a tar archive, like docker save"""
+        raise NotImplementedError
+
+    def load(self, file):
+        """Loads the images in a tar archive read from a binary file object, like docker load"""
+        raise NotImplementedError
+
+    def login(self, server, username, password):
+        raise NotImplementedError
+
+    def set_credentials(self, server, username, password):
+        """
+        Makes credentials that are already stored (e.g. by an earlier docker login) available to the engine
+        without logging in again. The CLI reads them from the docker config itself, so by default this does nothing.
+        """
+
+    def build(
+        self,
+        name,
+        directory,
+        dockerfile,
+        build_args,
+        context=None,
+        cache_from: Sequence[str] = (),
+        cache_to: Optional[str] = None,
+    ):
+        """
+        Builds an image. If context is given it is a function that writes the build context tar to a file object,
+        otherwise the directory is sent as the context.
+
+        cache_from and cache_to are registry references of BuildKit layer caches to import from and export to.
+        """
+        raise NotImplementedError
+
+    # Async variants. By default these run the blocking methods in the event loop's executor,
+    # engines that can do better override them.
+
+    async def _in_executor(self, method, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(method, *args))
+
+    async def image_exists_async(self, reference) -> bool:
+        return await self._in_executor(self.image_exists, reference)
+
+    async def pull_async(self, reference):
+        await self._in_executor(self.pull, reference)
+
+    async def push_async(self, reference):
+        await self._in_executor(self.push, reference)
+
+    async def tag_async(self, source, target):
+        await self._in_executor(self.tag, source, target)
+
+    async def login_async(self, server, username, password):
+        await self._in_executor(self.login, server, username, password)
+
+    async def build_async(
+        self,
+        name,
+        directory,
+        dockerfile,
+        build_args,
+        context=None,
+        cache_from: Sequence[str] = (),
+        cache_to: Optional[str] = None,
+    ):
+        await self._in_executor(
+            self.build,
+            name,
+            directory,
+            dockerfile,
+            build_args,
+            context,
+            cache_from,
+            cache_to,
+        )
+
+
+async def _run_async(args, check=True, cwd=None, stdout=None, stdin=None):
+    """Like subprocess.run, but with an asyncio subprocess. Returns the return code"""
+
+    process = await asyncio.create_subprocess_exec(
+        *args, cwd=cwd, stdout=stdout, stdin=stdin
+    )
+    returncode = await process.wait()
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, args)
+    return returncode
+
+
+class CLIEngine(Engine):
+    """
+    Runs the docker command line client for every operation.
+    The async methods use asyncio subprocesses, so they don't need a thread each.
+    """
+
+    @staticmethod
+    def login_args(server, username, password):
+        args = ["docker", "login"]
+        if server:
+            args += [server]
+        args += ["-u", username, "-p", password]
+        return args
+
+    @staticmethod
+    def build_args(
+        name, dockerfile, build_args, stdin=False, cache_from=(), cache_to=None
+    ):
+        """
+        Returns the docker build command. Builds that use a registry cache are run with buildx, as the
+        cache can only be exported by BuildKit. --load makes the result available locally like a normal build.
+        """
+
+        if cache_from or cache_to:
+            args = ["docker", "buildx", "build", "--load"]
+        else:
+            args = ["docker", "build"]
+        args += ["-t", name, "-" if stdin else ".", "-f", dockerfile]
+        for arg, value in build_args.items():
+            args.extend(["--build-arg", f"{arg}={value}"])
+        for reference in cache_from:
+            args.extend(["--cache-from", f"type=registry,ref={reference}"])
+        if cache_to:
+            args.extend(["--cache-to", f"type=registry,ref={cache_to},mode=max"])
+        return args
+
+    def image_exists(self, reference):
+        p = subprocess.run(
+            ["docker", "image", "inspect", reference], stdout=subprocess.DEVNULL
+        )
+        return p.returncode == 0
+
+    def image_id(self, reference):
+        p = subprocess.run(
+            ["docker", "image", "inspect", "--format", "{{.Id}}", reference],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        if p.returncode != 0:
+            return None
+        return p.stdout.strip()
+
+    def list_images(self):
+        p = subprocess.run(
+            [
+                "docker",
+                "image",
+                "ls",
+                "--no-trunc",
+                "--format",
+                "{{.Repository}}:{{.Tag}} {{.ID}}",
+            ],
+            check=True,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+
+        images = {}
+        for line in p.stdout.splitlines():
+            reference, _, image_id = line.partition(" ")
+            if "<none>" not in reference:
+                images[normalize_reference(reference)] = image_id
+        return images
+
+    def pull(self, reference):
+        subprocess.run(["docker", "pull", reference], check=True)
+
+    def push(self, reference):
+        subprocess.run(["docker", "push", reference], check=True)
+
+    def tag(self, source, target):
+        subprocess.run(["docker", "tag", source, target], check=True)
+
+    def remove_image(self, reference):
+        subprocess.run(["docker", "image", "rm", reference], check=True)
+
+    def image_size(self, reference):
+        p = subprocess.run(
+            ["docker", "image", "inspect", "--format", "{{.Size}}", reference],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        if p.returncode != 0:
+            return None
+        return int(p.stdout.strip())
+
+    def save(self, reference, file):
+        args = ["docker", "save", reference]
+        p = subprocess.Popen(args, stdout=subprocess.PIPE)
+        try:
+            shutil.copyfileobj(p.stdout, file, _COPY_CHUNK_SIZE)
+        finally:
+            p.stdout.close()
+            returncode = p.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, args)
+
+    def load(self, file):
+        args = ["docker", "load", "--quiet"]
+        p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        try:
+            shutil.copyfileobj(file, p.stdin, _COPY_CHUNK_SIZE)
+        finally:
+            p.stdin.close()
+            returncode = p.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, args)
+
+    def login(self, server, username, password):
+        subprocess.run(self.login_args(server, username, password), check=True)
+
+    def build(
+        self,
+        name,
+        directory,
+        dockerfile,
+        build_args,
+        context=None,
+        cache_from=(),
+        cache_to=None,
+    ):
+        if context is None:
+            subprocess.run(
+                self.build_args(
+                    name, dockerfile, build_args, False, cache_from, cache_to
+                ),
+                check=True,
+                cwd=directory,
+            )
+            return
+
+        with ContextStream(context) as stream:
+            subprocess.run(
+                self.build_args(
+                    name, dockerfile, build_args, True, cache_from, cache_to
+                ),
+                check=True,
+                cwd=directory,
+                stdin=stream.reader,
+            )
+
+    async def image_exists_async(self, reference):
+        returncode = await _run_async(
+            ["docker", "image", "inspect", reference],
+            check=False,
+            stdout=subprocess.DEVNULL,
+        )
+        return returncode == 0
+
+    async def pull_async(self, reference):
+        await _run_async(["docker", "pull", reference])
+
+    async def push_async(self, reference):
+        await _run_async(["docker", "push", reference])
+
+    async def tag_async(self, source, target):
+        await _run_async(["docker", "tag", source, target])
+
+    async def login_async(self, server, username, password):
+        await _run_async(self.login_args(server, username, password))
+
+    async def build_async(
+        self,
+        name,
+        directory,
+        dockerfile,
+        build_args,
+        context=None,
+        cache_from=(),
+        cache_to=None,
+    ):
+        if context is None:
+            await _run_async(
+                self.build_args(
+                    name, dockerfile, build_args, False, cache_from, cache_to
+                ),
+                cwd=directory,
+            )
+            return
+
+        with ContextStream(context) as stream:
+            await _run_async(
+                self.build_args(
+                    name, dockerfile, build_args, True, cache_from, cache_to
+                ),
+                cwd=directory,
+                stdin=stream.reader,
+            )
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+def default_socket_path():
+    """
+    Returns the socket that DOCKER_HOST points to, or the default socket if it isn't set. Other kinds of
+    DOCKER_HOST (e.g. tcp:// for Docker in Docker) are refused, as the CLI fallback would use a different daemon.
+    """
+
+    host = os.environ.get("DOCKER_HOST", "")
+    if not host:
+        return "/var/run/docker.sock"
+    if host.startswith("unix://"):
+        return host[len("unix://") :]
+    raise SocketEngine.UnsupportedHostException(
+        f"DOCKER_HOST is {host}, but the Engine API can only be used over a unix socket. Use CLIEngine instead"
+    )
+
+
+class SocketEngine(Engine):
+    """
+    Talks to the Docker Engine API over its unix socket, reusing a small pool of keep-alive connections
+    instead of starting a docker process for every operation.
+
+    Operations that the API client doesn't handle itself are passed to the fallback engine (the CLI by default).
+
+    Params:
+    socket_path: Path to the Docker socket. Defaults to DOCKER_HOST, which has to be a unix socket if it is set,
+    otherwise /var/run/docker.sock
+    api_version: Engine API version to request
+    timeout: Socket timeout in seconds. None waits forever, which is needed for long pulls and pushes
+    max_connections: Maximum number of idle connections to keep open
+    fallback: Engine used for unsupported operations
+    """
+
+    class APIException(Exception):
+        def __init__(self, status, message):
+            self.status = status
+            super().__init__(f"Docker API error {status}: {message}")
+
+    class UnsupportedHostException(Exception):
+        pass
+
+    def __init__(
+        self,
+        socket_path=None,
+        api_version="v1.41",
+        timeout=None,
+        max_connections=4,
+        fallback: Optional[Engine] = None,
+    ):
+        self.socket_path = socket_path or default_socket_path()
+        self.api_version = api_version
+        self.timeout = timeout
+        self.fallback = fallback or CLIEngine()
+
+        self.pool = ConnectionPool(
+            lambda: _UnixHTTPConnection(self.socket_path, self.timeout),
+            max_connections,
+        )
+        self.auths: Dict[Optional[str], dict] = {}
+        # Servers whose credentials the fallback engine has, from docker login or its config
+        self.fallback_servers: Set[Optional[str]] = set()
+
+    def request(self, method, path, params=None, body=None, headers=None):
+        """Makes an API request and returns (status, body)"""
+
+        url = f"/{self.api_version}{path}"
+        if params:
+            url += "?" + urlencode(params)
+
+        response, data = self.pool.request(method, url, body=body, headers=headers)
+        return response.status, data
+
+    def _check(self, status, data):
+        if status >= 400:
+            try:
+                message = json.loads(data)["message"]
+            except (ValueError, KeyError, TypeError):
+                message = data.decode("utf-8", "replace")
+            raise SocketEngine.APIException(status, message)
+
+    def _check_stream(self, status, data):
+        """Checks a streamed JSON progress response, which reports errors in the body with a 200 status"""
+
+        self._check(status, data)
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            message = json.loads(line)
+            if "error" in message:
+                raise SocketEngine.APIException(status, message["error"])
+
+    def _auth_header(self, reference):
+        auth = self.auths.get(registry_host(reference), {})
+        encoded = base64.urlsafe_b64encode(json.dumps(auth).encode("utf-8"))
+        return {"X-Registry-Auth": encoded.decode("ascii")}
+
+    def _image_path(self, name):
+        return "/images/" + quote(name, safe="/:@")
+
+    def image_exists(self, reference):
+        status, data = self.request("GET", self._image_path(reference) + "/json")
+        if status == 404:
+            return False
+        self._check(status, data)
+        return True
+
+    def image_id(self, reference):
+        status, data = self.request("GET", self._image_path(reference) + "/json")
+        if status == 404:
+            return None
+        self._check(status, data)
+        return json.loads(data)["Id"]
+
+    def list_images(self):
+        status, data = self.request("GET", "/images/json")
+        self._check(status, data)
+
+        images = {}
+        for image in json.loads(data):
+            for reference in image.get("RepoTags") or []:
+                if "<none>" not in reference:
+                    images[normalize_reference(reference)] = image["Id"]
+        return images
+
+    def pull(self, reference):
+        repository, tag = split_reference(reference)
+        self._check_stream(
+            *self.request(
+                "POST",
+                "/images/create",
+                params={"fromImage": repository, "tag": tag or "latest"},
+                headers=self._auth_header(reference),
+            )
+        )
+
+    def push(self, reference):
+        repository, tag = split_reference(reference)
+        self._check_stream(
+            *self.request(
+                "POST",
+                self._image_path(repository) + "/push",
+                params={"tag": tag or "latest"},
+                headers=self._auth_header(reference),
+            )
+        )
+
+    def remove_image(self, reference):
+        self._check(*self.request("DELETE", self._image_path(reference)))
+
+    def image_size(self, reference):
+        status, data = self.request("GET", self._image_path(reference) + "/json")
+        if status == 404:
+            return None
+        self._check(status, data)
+        return json.loads(data)["Size"]
+
+    def tag(self, source, target):
+        repository, tag = split_reference(target)
+        self._check(
+            *self.request(
+                "POST",
+                self._image_path(source) + "/tag",
+                params={"repo": repository, "tag": tag or "latest"},
+            )
+        )
+
+    def save(self, reference, file):
+        # Responses are read into memory by the connection pool, which images are too large for
+        self.fallback.save(reference, file)
+
+    def load(self, file):
+        def chunks():
+            while True:
+                chunk = file.read(_COPY_CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+        response, data = self.pool.request(
+            "POST",
+            f"/{self.api_version}/images/load?quiet=1",
+            body=chunks(),
+            headers={"Content-Type": "application/x-tar"},
+            encode_chunked=True,
+        )
+        self._check_stream(response.status, data)
+
+    @staticmethod
+    def _auth(server, username, password):
+        auth = {"username": username, "password": password}
+        if server:
+            auth["serveraddress"] = server
+        return auth
+
+    def login(self, server, username, password):
+        auth = self._auth(server, username, password)
+        self._check(
+            *self.request(
+                "POST",
+                "/auth",
+                body=json.dumps(auth),
+                headers={"Content-Type": "application/json"},
+            )
+        )
+        self.auths[server] = auth
+        self.fallback_servers.discard(server)
+
+    def set_credentials(self, server, username, password):
+        self.auths[server] = self._auth(server, username, password)
+        # The credentials are stored in the docker config, where the CLI finds them
+        self.fallback_servers.add(server)
+
+    def _login_fallback(self, references):
+        """Logs the fallback engine in to the servers of the references that this engine has logged in to"""
+
+        for server in {registry_host(reference) for reference in references}:
+            auth = self.auths.get(server)
+            if auth is None or server in self.fallback_servers:
+                continue
+            self.fallback.login(server, auth["username"], auth["password"])
+            self.fallback_servers.add(server)
+
+    def build(
+        self,
+        name,
+        directory,
+        dockerfile,
+        build_args,
+        context=None,
+        cache_from=(),
+        cache_to=None,
+    ):
+        if context is None or cache_from or cache_to:
+            # The API needs the context as a tar, which is only produced when the build config streams it.
+            # Registry caches need BuildKit, which the API's classic builder doesn't provide, and the fallback
+            # needs the credentials to read and write them
+            self._login_fallback([*cache_from, *([cache_to] if cache_to else [])])
+            self.fallback.build(
+                name, directory, dockerfile, build_args, context, cache_from, cache_to
+            )
+            return
+
+        params = {
+            "t": name,
+            "dockerfile": dockerfile,
+            "buildargs": json.dumps(build_args),
+        }
+        url = f"/{self.api_version}/build?{urlencode(params)}"
+        with ContextStream(context) as stream, self.pool.stream(
+            "POST",
+            url,
+            body=stream.chunks(),
+            headers={"Content-Type": "application/x-tar"},
+            encode_chunked=True,
+        ) as response:
+            if response.status >= 400:
+                self._check(response.status, response.read())
+
+            # The daemon sends the build output as it goes, one JSON message per line
+            for line in response:
+                if not line.strip():
+                    continue
+                message = json.loads(line)
+                if "error" in message:
+                    raise SocketEngine.APIException(response.status, message["error"])
+                text = message.get("stream", "").rstrip("\n")
+                if text:
+                    report.message(name, text)
+
+    def close(self):
+        self.pool.close()
+
+
+_engine: Engine = CLIEngine()
+
+
+def get_engine() -> Engine:
+    """Returns the engine used for all Docker operations"""
+    return _engine
+
+
+def set_engine(engine: Engine):
+    """
+    Sets the engine used for all Docker operations, e.g. set_engine(SocketEngine()) to use the Engine API.
+    The docker CLI is used by default.
+    """
+    global _engine
+    _engine = engine
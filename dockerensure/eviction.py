@@ -0,0 +1,191 @@
+import os
+import sqlite3
+import threading
+import time
+from os import PathLike
+from typing import Dict, Iterable, List, Optional, Union
+
+from . import report
+from .engine import get_engine
+from .graph import ImageGraph
+from .utils import default_cache_dir, normalize_reference, split_reference
+
+
+class UsageIndex:
+    """
+    Records when each image was last ensured, so that images that haven't been used for a while can be evicted.
+    The index is a report listener: once added with report.add_listener, every image that ensure finishes with
+    (found locally, pulled or built) is recorded, along with the other tags it was given (e.g. the registry
+    tag of a pushed or pulled image), so that evicting the image removes all of them.
+
+    Params:
+    path: The database file. Defaults to usage.sqlite in the dockerensure cache directory
+    """
+
+    def __init__(self, path: Union[None, str, PathLike] = None):
+        if path is None:
+            path = default_cache_dir() / "usage.sqlite"
+        if str(path) != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            str(path), timeout=30, check_same_thread=False, isolation_level=None
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS usage "
+            "(reference TEXT PRIMARY KEY, repository TEXT NOT NULL, used REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS aliases "
+            "(reference TEXT NOT NULL, alias TEXT NOT NULL, PRIMARY KEY (reference, alias))"
+        )
+
+    def __call__(self, event: report.Event):
+        if event.kind == "outcome":
+            self.record(event.image)
+        elif event.kind == "tag":
+            self.record_alias(event.image, event.alias)
+
+    def record(self, reference, used: Optional[float] = None):
+        reference = normalize_reference(reference)
+        repository, _ = split_reference(reference)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO usage (reference, repository, used) VALUES (?, ?, ?)",
+                (reference, repository, time.time() if used is None else used),
+            )
+
+    def record_alias(self, reference, alias):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO aliases (reference, alias) VALUES (?, ?)",
+                (normalize_reference(reference), normalize_reference(alias)),
+            )
+
+    def aliases(self, reference) -> List[str]:
+        """Returns the other tags that the image was given"""
+
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT alias FROM aliases WHERE reference = ? ORDER BY alias",
+                (normalize_reference(reference),),
+            ).fetchall()
+        return [alias for alias, in rows]
+
+    def forget(self, reference):
+        reference = normalize_reference(reference)
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM usage WHERE reference = ?", (reference,)
+            )
+            self.connection.execute(
+                "DELETE FROM aliases WHERE reference = ?", (reference,)
+            )
+
+    def entries(self) -> Dict[str, List[str]]:
+        """Returns the recorded references of each repository, most recently used first"""
+
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT repository, reference FROM usage ORDER BY used DESC"
+            ).fetchall()
+
+        repositories = {}
+        for repository, reference in rows:
+            repositories.setdefault(repository, []).append(reference)
+        return repositories
+
+    def last_used(self, reference) -> Optional[float]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT used FROM usage WHERE reference = ?",
+                (normalize_reference(reference),),
+            ).fetchone()
+        return row and row[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def evict(
+    index: UsageIndex,
+    live_images: Iterable["DockerImage"] = (),
+    keep: Optional[int] = 3,
+    max_bytes: Optional[int] = None,
+    dry_run: bool = False,
+) -> List[str]:
+    """
+    Removes the least recently used images recorded in the index.
+
+    The live images and all of their parents are never removed. Of the rest, only the `keep` most recently
+    used tags of each repository are kept, and then the least recently used are removed until the images
+    recorded in the index take up at most max_bytes. Sizes are as reported by Docker, so layers shared
+    between images are counted for each image. The other tags recorded for an image (e.g. its registry tag)
+    are removed along with it, so that Docker deletes the image.
+
+    An image that Docker fails to remove (e.g. because a container uses it) is reported and skipped.
+
+    Returns the references that were removed (or that would be, if dry_run is set).
+    """
+
+    protected = {normalize_reference(image.ref) for image in ImageGraph(live_images)}
+    engine = get_engine()
+    local = engine.list_images()
+
+    # Images that no longer exist don't need to be tracked
+    repositories = {}
+    for repository, references in index.entries().items():
+        for reference in references:
+            if reference in local:
+                repositories.setdefault(repository, []).append(reference)
+            elif not dry_run:
+                index.forget(reference)
+
+    evicted = []
+    remaining = []
+    for references in repositories.values():
+        for position, reference in enumerate(references):
+            if reference in protected:
+                continue
+            if keep is not None and position >= keep:
+                evicted.append(reference)
+            else:
+                remaining.append(reference)
+
+    if max_bytes is not None:
+        sizes = {
+            reference: engine.image_size(reference) or 0
+            for references in repositories.values()
+            for reference in references
+            if reference not in evicted
+        }
+        total = sum(sizes.values())
+        remaining.sort(key=index.last_used)
+        for reference in remaining:
+            if total <= max_bytes:
+                break
+            evicted.append(reference)
+            total -= sizes[reference]
+
+    if dry_run:
+        return evicted
+
+    removed = []
+    for reference in evicted:
+        try:
+            with report.phase(reference, "evict"):
+                engine.remove_image(reference)
+                for alias in index.aliases(reference):
+                    if alias in local:
+                        engine.remove_image(alias)
+        except Exception as e:
+            # e.g. the image is used by a container; it stays in the index to be tried again next time
+            report.message(reference, f"Failed to evict image: {e}")
+            continue
+        index.forget(reference)
+        removed.append(reference)
+        report.count("images_evicted")
+    return removed
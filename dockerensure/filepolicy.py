@@ -22,8 +22,16 @@ class Only:
     exceptions: List[str] = field(default_factory=list)
 
 
+class FromDockerfile:
+    """
+    The files used by the COPY and ADD instructions of the Dockerfile, found by parsing it.
+    Equivalent to Only with those paths, or All if an instruction copies the whole context.
+    """
+
+
 class FilePolicy(ABC):
     All = All
     Nothing = Nothing
     AllBut = AllBut
     Only = Only
+    FromDockerfile = FromDockerfile
@@ -0,0 +1,292 @@
+import asyncio
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, List, Set
+
+
+def image_parents(image):
+    """Returns the images that the given image is built from"""
+    if image.build_config is None:
+        return []
+    return image.build_config.parents
+
+
+class ImageGraph:
+    """
+    The graph formed by a set of images and, recursively, their parents.
+
+    Nodes are deduplicated by reference, so an image that is reached through several children
+    (e.g. the shared base of a diamond) is only ensured once.
+
+    Params:
+    images: The images to include. Their parents are added automatically
+    """
+
+    class CycleException(Exception):
+        pass
+
+    class EnsureFailedException(Exception):
+        """
+        Raised when one or more images in the graph failed to be ensured.
+
+        failures maps each failed reference to its exception. skipped contains the references
+        that were not attempted because one of their parents failed.
+        """
+
+        def __init__(self, failures, skipped):
+            self.failures = failures
+            self.skipped = skipped
+            message = f"Failed to ensure {', '.join(failures)}"
+            if skipped:
+                message += f" (skipped dependents: {', '.join(sorted(skipped))})"
+            super().__init__(message)
+
+    def __init__(self, images: Iterable["DockerImage"]):
+        self.nodes: Dict[str, "DockerImage"] = {}
+        self.parents: Dict[str, List[str]] = {}
+        self.dependents: Dict[str, List[str]] = {}
+        self.order: List[str] = []
+
+        images = list(images)
+        self._check_cycles(images)
+        for image in images:
+            self._add(image, set())
+
+    @staticmethod
+    def _check_cycles(images):
+        """
+        Follows the parents of the images to look for cycles. This has to happen before any reference is
+        computed, as the reference of a hashed image includes the references of its parents.
+        """
+
+        checked = set()
+
+        def visit(image, chain):
+            if id(image) in checked:
+                return
+            if id(image) in chain:
+                raise ImageGraph.CycleException(
+                    f"The image {image.name} depends on itself"
+                )
+            chain.add(id(image))
+            for parent in image_parents(image):
+                visit(parent, chain)
+            chain.discard(id(image))
+            checked.add(id(image))
+
+        for image in images:
+            visit(image, set())
+
+    def _add(self, image, visiting):
+        ref = image.reference
+        if ref in self.nodes:
+            return ref
+
+        if ref in visiting:
+            raise ImageGraph.CycleException(f"The image {ref} depends on itself")
+        visiting.add(ref)
+
+        parent_refs = []
+        for parent in image_parents(image):
+            parent_ref = self._add(parent, visiting)
+            if parent_ref not in parent_refs:
+                parent_refs.append(parent_ref)
+
+        visiting.discard(ref)
+
+        self.nodes[ref] = image
+        self.parents[ref] = parent_refs
+        self.dependents[ref] = []
+        for parent_ref in parent_refs:
+            self.dependents[parent_ref].append(ref)
+
+        # Parents are always added before their children, so this is a topological order
+        self.order.append(ref)
+
+        return ref
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return (self.nodes[ref] for ref in self.order)
+
+    def downstream(self, ref) -> Set[str]:
+        """Returns the references of every image that depends on the given one, directly or not"""
+        found = set()
+        stack = list(self.dependents[ref])
+        while stack:
+            child = stack.pop()
+            if child not in found:
+                found.add(child)
+                stack.extend(self.dependents[child])
+        return found
+
+    def plan(self) -> "Plan":
+        """
+        Works out what ensure would do for every image (see Plan), without pulling, building or writing
+        any files. Existence is checked in the same batched way as ensure.
+        """
+
+        from .image import DockerImage
+        from .plan import Plan
+
+        try:
+            self.resolve_existence()
+
+            return Plan([self.nodes[ref].plan(self.parents[ref]) for ref in self.order])
+        finally:
+            self.forget_existence()
+
+    def resolve_existence(self):
+        """
+        Checks which images exist locally with a single query, and looks up those that are missing locally
+        with one tag listing per repository on their registries
+        """
+        from .image import DockerImage
+
+        DockerImage.resolve_local_images(self)
+        DockerImage.resolve_remote_images(self)
+
+    def forget_existence(self):
+        """
+        Forgets the existence answers resolved for the images, and the tags listed by their registries,
+        which only hold for one run
+        """
+        registries = {}
+        for image in self.nodes.values():
+            image.forget_existence()
+            if image.registry is not None:
+                registries[id(image.registry)] = image.registry
+        for registry in registries.values():
+            registry.forget_listings()
+
+    def ensure(self, max_workers=4, push_pipeline=None):
+        """
+        Ensures every image in the graph.
+
+        An image is started as soon as all of its parents are ready, so independent branches are
+        ensured concurrently. If an image fails, the images that depend on it are skipped but
+        unrelated branches carry on. Once everything has settled an EnsureFailedException is raised
+        if anything failed.
+
+        The local existence of every image is checked up front with a single query, and images that
+        are missing locally are looked up with one tag listing per repository on their registry.
+
+        If a PushPipeline is given, built images are pushed in the background while the rest of the graph
+        is built. The pipeline is flushed before returning and failed pushes are reported as failures.
+        """
+
+        try:
+            self._ensure(max_workers, push_pipeline)
+        finally:
+            self.forget_existence()
+
+    def _ensure(self, max_workers, push_pipeline):
+        self.resolve_existence()
+
+        waiting = {ref: set(parents) for ref, parents in self.parents.items()}
+        ready = [ref for ref in self.order if not waiting[ref]]
+        failures = {}
+        skipped = set()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            running = {}
+            while ready or running:
+                for ref in ready:
+                    future = executor.submit(
+                        self.nodes[ref].ensure,
+                        ensure_parents=False,
+                        push_pipeline=push_pipeline,
+                    )
+                    running[future] = ref
+                ready = []
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    ref = running.pop(future)
+                    exception = future.exception()
+                    if exception is not None:
+                        failures[ref] = exception
+                        skipped |= self.downstream(ref)
+                        continue
+
+                    for child in self.dependents[ref]:
+                        waiting[child].discard(ref)
+                        if not waiting[child] and child not in skipped:
+                            ready.append(child)
+
+        if push_pipeline is not None:
+            failures.update(push_pipeline.flush())
+
+        if failures:
+            raise ImageGraph.EnsureFailedException(failures, skipped)
+
+    async def ensure_async(self, limit=8):
+        """
+        Async variant of ensure. Each image waits for its parents and then ensures itself, with at most
+        `limit` images being ensured at once.
+        """
+
+        try:
+            await self._ensure_async(limit)
+        finally:
+            self.forget_existence()
+
+    async def _ensure_async(self, limit):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.resolve_existence)
+
+        semaphore = asyncio.Semaphore(limit)
+        tasks = {}
+        failures = {}
+        skipped = set()
+
+        async def ensure_node(ref):
+            parents = [tasks[parent] for parent in self.parents[ref]]
+            results = await asyncio.gather(*parents, return_exceptions=True)
+            if any(isinstance(result, BaseException) for result in results):
+                skipped.add(ref)
+                raise _Skipped()
+
+            async with semaphore:
+                try:
+                    await self.nodes[ref].ensure_async(ensure_parents=False)
+                except Exception as e:
+                    failures[ref] = e
+                    raise
+
+        for ref in self.order:
+            tasks[ref] = asyncio.ensure_future(ensure_node(ref))
+
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+        if failures:
+            raise ImageGraph.EnsureFailedException(failures, skipped)
+
+
+class _Skipped(Exception):
+    """Marks an image that wasn't attempted because a parent failed"""
+
+
+def plan_all(images) -> "Plan":
+    """Returns what ensure_all would do for the given images and their parents. See ImageGraph.plan"""
+    return ImageGraph(images).plan()
+
+
+def ensure_all(images, max_workers=4, push_pipeline=None):
+    """
+    Ensures all of the given images and their parents, running independent images concurrently.
+    See ImageGraph.ensure.
+    """
+    ImageGraph(images).ensure(max_workers=max_workers, push_pipeline=push_pipeline)
+
+
+async def ensure_all_async(images, limit=8):
+    """
+    Ensures all of the given images and their parents from an event loop, with at most `limit`
+    images being ensured at once. See ImageGraph.ensure_async.
+    """
+
+    loop = asyncio.get_running_loop()
+    graph = await loop.run_in_executor(None, ImageGraph, list(images))
+    await graph.ensure_async(limit=limit)
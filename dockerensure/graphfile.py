@@ -0,0 +1,288 @@
+import datetime
+import os
+from os import PathLike
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Union
+
+from .buildconfig import BuildConfig
+from .digestcache import DigestCache
+from .filepolicy import FilePolicy
+from .image import DockerImage, RemotePolicy
+from .lockfile import Lockfile
+from .registry import DockerRegistry
+from .tarballcache import TarballCache
+from .utils import IntervalOffset
+
+SUFFIXES = (".toml", ".yaml", ".yml")
+
+_IMAGE_KEYS = {
+    "name",
+    "version",
+    "with_hash",
+    "force_build",
+    "hash_len",
+    "registry",
+    "prepend_server",
+    "remote_policy",
+    "build_cache",
+    "build",
+}
+_BUILD_KEYS = {
+    "dockerfile",
+    "directory",
+    "build_args",
+    "unhashed_build_args",
+    "parents",
+    "files",
+    "metadata",
+    "interval",
+    "stream_context",
+    "prefetch_bases",
+}
+
+
+def is_graph_file(path) -> bool:
+    return str(path).lower().endswith(SUFFIXES)
+
+
+def read_graph_file(path: Union[str, PathLike]) -> dict:
+    """
+    Reads a TOML or YAML file. The parser is only imported when it's needed: tomllib (or tomli before
+    Python 3.11) for TOML and PyYAML for YAML.
+    """
+
+    path = Path(path)
+    if path.suffix.lower() == ".toml":
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ImportError(
+                    "Reading TOML graph files before Python 3.11 needs tomli: pip install dockerensure[toml]"
+                ) from None
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+
+    try:
+        import yaml
+    except ImportError:
+        raise ImportError(
+            "Reading YAML graph files needs PyYAML: pip install dockerensure[yaml]"
+        ) from None
+    with open(path) as f:
+        return yaml.safe_load(f) or {}
+
+
+class GraphFile:
+    """
+    An image graph described in a TOML or YAML file, so that images can be ensured without writing a script.
+
+    Example (TOML):
+
+    lockfile = "dockerensure.lock"      # Optional, see Lockfile
+    digest_cache = true                 # Optional, true for the default DigestCache or a database path
+
+    [registries.main]
+    server = "registry.example.com"
+    username = "ci"
+    password_env = "REGISTRY_PASSWORD"  # Environment variable holding the password
+
+    [caches.shared]                     # A TarballCache, which images can use as their registry
+    directory = "/mnt/cache/images"
+    max_bytes = 50_000_000_000
+
+    [images.base]
+    version = "1"
+    with_hash = true
+    registry = "main"
+    build = { directory = "base", files = "dockerfile" }
+
+    [images.app]
+    name = "myorg/app"                  # Defaults to the key
+    remote_policy = "pull_only"
+    build = { directory = "app", parents = ["base"], files = { only = ["src"] } }
+
+    Images take the DockerImage parameters, and build takes the BuildConfig parameters. An image without build
+    has to be found locally or on its registry. parents are keys of other images. files is "all", "nothing",
+    "dockerfile", { only = [...] } or { all_but = [...] }, and interval is in seconds or a table of timedelta
+    arguments (e.g. { days = 1 }). Relative paths are relative to the graph file.
+
+    Every build config shares one DigestCache (in memory unless digest_cache is set), and images are only
+    constructed once, so ensuring several targets in one process hashes and checks shared parents once.
+
+    Params:
+    data: The parsed file
+    directory: Directory that relative paths are resolved against
+    """
+
+    class InvalidGraphException(Exception):
+        pass
+
+    def __init__(self, data: dict, directory: Union[str, PathLike] = "."):
+        if not isinstance(data, dict):
+            raise GraphFile.InvalidGraphException("The graph should be a mapping")
+
+        self.data = data
+        self.directory = Path(directory)
+
+        self.lockfile = None
+        if data.get("lockfile"):
+            self.lockfile = Lockfile(self.path(data["lockfile"]))
+
+        digest_cache = data.get("digest_cache")
+        if digest_cache is True:
+            self.digest_cache = DigestCache()
+        elif digest_cache:
+            self.digest_cache = DigestCache(self.path(digest_cache))
+        else:
+            self.digest_cache = DigestCache(":memory:")
+
+        self.registries: Dict[str, Union[DockerRegistry, TarballCache]] = {}
+        for name, spec in data.get("registries", {}).items():
+            self.registries[name] = self._registry(name, spec)
+        for name, spec in data.get("caches", {}).items():
+            if name in self.registries:
+                raise GraphFile.InvalidGraphException(
+                    f"{name} is defined as both a registry and a cache"
+                )
+            self.registries[name] = self._cache(name, spec)
+
+        self.specs: Dict[str, dict] = data.get("images", {})
+        if not self.specs:
+            raise GraphFile.InvalidGraphException("The graph has no images")
+        self.images: Dict[str, DockerImage] = {}
+        for key in self.specs:
+            self._image(key, [])
+
+    @classmethod
+    def load(cls, path: Union[str, PathLike]):
+        path = Path(path)
+        return cls(read_graph_file(path), path.parent)
+
+    def path(self, value) -> Path:
+        return self.directory / os.path.expanduser(value)
+
+    def select(self, keys: Optional[Iterable[str]] = None) -> List[DockerImage]:
+        """Returns the images with the given keys, or all of them"""
+
+        if keys is None:
+            return list(self.images.values())
+
+        unknown = [key for key in keys if key not in self.images]
+        if unknown:
+            raise GraphFile.InvalidGraphException(
+                f"Unknown images: {', '.join(unknown)}"
+            )
+        return [self.images[key] for key in keys]
+
+    def save(self):
+        """Saves the lockfile, if the graph has one"""
+        if self.lockfile is not None:
+            self.lockfile.save()
+
+    def _registry(self, name, spec):
+        spec = dict(spec)
+        password_env = spec.pop("password_env", None)
+        if password_env:
+            spec["password"] = os.environ.get(password_env)
+        try:
+            return DockerRegistry(**spec)
+        except TypeError as e:
+            raise GraphFile.InvalidGraphException(f"Registry {name}: {e}") from None
+
+    def _cache(self, name, spec):
+        spec = dict(spec)
+        if "directory" not in spec:
+            raise GraphFile.InvalidGraphException(f"Cache {name} needs a directory")
+        spec["directory"] = self.path(spec["directory"])
+        try:
+            return TarballCache(**spec)
+        except TypeError as e:
+            raise GraphFile.InvalidGraphException(f"Cache {name}: {e}") from None
+
+    def _image(self, key, chain) -> DockerImage:
+        if key in self.images:
+            return self.images[key]
+        if key in chain:
+            raise GraphFile.InvalidGraphException(
+                f"Images depend on each other: {' -> '.join(chain + [key])}"
+            )
+        if key not in self.specs:
+            raise GraphFile.InvalidGraphException(
+                f"Image {chain[-1]} has unknown parent {key}"
+            )
+
+        spec = dict(self.specs[key] or {})
+        unknown = set(spec) - _IMAGE_KEYS
+        if unknown:
+            raise GraphFile.InvalidGraphException(
+                f"Image {key} has unknown settings: {', '.join(sorted(unknown))}"
+            )
+
+        if "registry" in spec:
+            if spec["registry"] not in self.registries:
+                raise GraphFile.InvalidGraphException(
+                    f"Image {key} uses unknown registry {spec['registry']}"
+                )
+            spec["registry"] = self.registries[spec["registry"]]
+        if "remote_policy" in spec:
+            try:
+                spec["remote_policy"] = RemotePolicy[spec["remote_policy"].upper()]
+            except KeyError:
+                raise GraphFile.InvalidGraphException(
+                    f"Image {key} has unknown remote policy {spec['remote_policy']}"
+                ) from None
+        if "build" in spec:
+            spec["build_config"] = self._build_config(
+                key, spec.pop("build") or {}, chain + [key]
+            )
+
+        spec.setdefault("name", key)
+        image = DockerImage(lockfile=self.lockfile, **spec)
+        self.images[key] = image
+        return image
+
+    def _build_config(self, key, spec, chain) -> BuildConfig:
+        spec = dict(spec)
+        unknown = set(spec) - _BUILD_KEYS
+        if unknown:
+            raise GraphFile.InvalidGraphException(
+                f"Image {key} has unknown build settings: {', '.join(sorted(unknown))}"
+            )
+
+        spec["directory"] = self.path(spec.get("directory", "."))
+        spec["parents"] = [
+            self._image(parent, chain) for parent in spec.get("parents", [])
+        ]
+        if "files" in spec:
+            spec["files"] = self._file_policy(key, spec["files"])
+        if "interval" in spec:
+            interval = spec["interval"]
+            if isinstance(interval, dict):
+                interval = datetime.timedelta(**interval)
+            else:
+                interval = datetime.timedelta(seconds=interval)
+            spec["interval"] = IntervalOffset(interval)
+        return BuildConfig(digest_cache=self.digest_cache, **spec)
+
+    def _file_policy(self, key, files):
+        if isinstance(files, str):
+            policies = {
+                "all": FilePolicy.All,
+                "nothing": FilePolicy.Nothing,
+                "dockerfile": FilePolicy.FromDockerfile,
+            }
+            if files.lower() in policies:
+                return policies[files.lower()]
+        elif isinstance(files, dict) and len(files) == 1:
+            ((name, paths),) = files.items()
+            if name == "only":
+                return FilePolicy.Only(list(paths))
+            if name == "all_but":
+                return FilePolicy.AllBut(list(paths))
+
+        raise GraphFile.InvalidGraphException(
+            f"Image {key} has an invalid files policy: {files!r}"
+        )
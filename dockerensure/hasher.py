@@ -1,18 +1,110 @@
 import hashlib
+import queue
+import threading
+
+from . import report
+from .context import context_digest, file_digest
+
+CHUNK_SIZE = 1024 * 1024
 
 
 class Hasher:
     """
     Simple class to handle hashing of file data and strings.
+
+    Files are read in fixed size chunks so memory use does not depend on file size.
+    If a DigestCache is given, the digests of files in directory trees are looked up in it.
     """
 
-    def __init__(self):
+    def __init__(self, chunk_size=CHUNK_SIZE, digest_cache=None):
         self.hash = hashlib.sha256()
+        self.chunk_size = chunk_size
+        self.digest_cache = digest_cache
 
     def add_file(self, path):
         self.add_str(str(path))
+        buffer = bytearray(self.chunk_size)
+        view = memoryview(buffer)
+        total = 0
         with open(path, "rb") as f:
-            self.hash.update(f.read())
+            while True:
+                size = f.readinto(buffer)
+                if not size:
+                    break
+                self.hash.update(view[:size])
+                total += size
+        report.count("bytes_hashed", total)
+
+    def add_files(self, paths, buffers=4):
+        """
+        Adds several files to the hash, in order. The result is the same as calling add_file for each path.
+
+        Files are read on a background thread into a small pool of buffers while the previous chunks
+        are being hashed, so disk reads overlap with hashing. At most `buffers` chunks are held in memory.
+        """
+
+        paths = list(paths)
+        if len(paths) < 2:
+            for path in paths:
+                self.add_file(path)
+            return
+
+        free = queue.Queue()
+        for _ in range(buffers):
+            free.put(bytearray(self.chunk_size))
+        filled = queue.Queue()
+
+        def read():
+            try:
+                for path in paths:
+                    filled.put((path, None, 0))
+                    with open(path, "rb") as f:
+                        while True:
+                            buffer = free.get()
+                            size = f.readinto(buffer)
+                            if not size:
+                                free.put(buffer)
+                                break
+                            filled.put((path, buffer, size))
+            except Exception as e:
+                filled.put((None, e, 0))
+                return
+            filled.put(None)
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+
+        total = 0
+        while True:
+            item = filled.get()
+            if item is None:
+                break
+
+            path, buffer, size = item
+            if path is None:
+                raise buffer
+
+            if buffer is None:
+                self.add_str(str(path))
+            else:
+                self.hash.update(memoryview(buffer)[:size])
+                free.put(buffer)
+                total += size
+
+        reader.join()
+        report.count("bytes_hashed", total)
+
+    def file_digest(self, path):
+        if self.digest_cache is not None:
+            return self.digest_cache.file_digest(path)
+        return file_digest(path, self.chunk_size)
+
+    def add_tree(self, directory, ignore_lines):
+        """
+        Adds a tree digest of every file in a build context that is not excluded by the given
+        .dockerignore lines. See context.context_digest.
+        """
+        self.add_str(context_digest(directory, ignore_lines, self.file_digest))
 
     def add_str(self, string):
         self.hash.update(string.encode("utf-8"))
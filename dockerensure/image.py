@@ -1,10 +1,20 @@
+import asyncio
 import enum
-import subprocess
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from functools import cached_property
-from typing import Optional
+from typing import Dict, Iterable, Optional, Union
 
+from . import report
 from .buildconfig import BuildConfig
+from .engine import get_engine
+from .lockfile import Lockfile
+from .locks import BuildLocks
+from .plan import PlanEntry
+from .pushpipeline import PushPipeline
+from .utils import normalize_reference
+
+# Tag that the BuildKit layer cache of a repository is stored under
+CACHE_TAG = "buildcache"
 
 
 class RemotePolicy(enum.Enum):
@@ -33,10 +43,18 @@ class DockerImage:
     version: Optional version string to add to the tag
     hash_len: Length of the hash to append if ` with_hash` is True. Default is 16
 
-    registry:  DockerRegistry object for builds using a remote server
+    registry:  DockerRegistry object for builds using a remote server, or a TarballCache to keep images in a directory
     prepend_server: If true, the server url will be prepended to the image name before pushing. Set this to false
         if you have already prepended the registry to the image name (e.g. docker.io/image_name)
     remote_policy:  How the remote server will be used to push and pull images
+
+    build_cache: If true, the image is built with BuildKit (docker buildx) using a layer cache on the registry.
+        The cache is stored under the "buildcache" tag of the image's repository, and the previous reference
+        from the lockfile is also used as a cache source. The cache is only written if the remote policy allows pushes
+    build_locks: Optional BuildLocks. If set, a lock is held on the reference while building it, so that processes
+        ensuring the same image at the same time build it once. Waiters use the image built by the holder
+    lockfile: Optional Lockfile. If set, the reference and image ID are recorded once the image is ensured,
+        and later runs with unchanged inputs reuse the reference and only verify the image ID
     """
 
     name: str
@@ -47,10 +65,20 @@ class DockerImage:
     version: Optional[str] = None
     hash_len: int = 16
 
-    registry: Optional["DockerRegistry"] = None
+    registry: Union["DockerRegistry", "TarballCache", None] = None
     prepend_server: bool = True
     remote_policy: RemotePolicy = RemotePolicy.ALL
 
+    build_cache: bool = False
+    build_locks: Optional[BuildLocks] = field(default=None, repr=False, compare=False)
+    lockfile: Optional[Lockfile] = field(default=None, repr=False, compare=False)
+
+    # Whether the image is known to exist locally, or None if it hasn't been checked yet. Answers are only kept
+    # for the ensure (or graph ensure or plan) in progress, since the image can be removed at any time
+    local: Optional[bool] = field(default=None, init=False, repr=False, compare=False)
+    # The ID of the local image, if it is known. Kept for as long as local
+    image_id: Optional[str] = field(default=None, init=False, repr=False, compare=False)
+
     class BuildFailedException(Exception):
         pass
 
@@ -73,12 +101,59 @@ class DockerImage:
 
     def has_local_image(self):
         """
-        Check if the image exists locally
+        Check if the image exists locally. If resolve_local_images has already answered this for the image,
+        no query is made.
         """
-        p = subprocess.run(
-            ["docker", "image", "inspect", self.ref], stdout=subprocess.DEVNULL
-        )
-        return p.returncode == 0
+        if self.local is None:
+            with report.phase(self.ref, "inspect"):
+                self.local = get_engine().image_exists(self.ref)
+        return self.local
+
+    @staticmethod
+    def resolve_local_images(images: Iterable["DockerImage"]) -> Dict[str, bool]:
+        """
+        Checks which of the given images exist locally using a single query to list the local images,
+        instead of inspecting each image separately. The answers are stored on the images so that
+        has_local_image doesn't need to query them again.
+
+        Returns a mapping of reference -> whether the image exists.
+        """
+
+        with report.phase(None, "resolve_local"):
+            local = get_engine().list_images()
+
+        existence = {}
+        for image in images:
+            if "@" in image.ref:
+                # Only tags are listed, so images referred to by digest are inspected instead
+                image.image_id = None
+                image.local = None
+                existence[image.ref] = image.has_local_image()
+                continue
+            image.image_id = local.get(normalize_reference(image.ref))
+            image.local = image.image_id is not None
+            existence[image.ref] = image.local
+        return existence
+
+    @staticmethod
+    def resolve_remote_images(images: Iterable["DockerImage"]):
+        """
+        Looks up the images that aren't known to exist locally on their registries, with one
+        tag listing per repository (see DockerRegistry.resolve_remote_images).
+        """
+
+        by_registry = {}
+        for image in images:
+            if (
+                image.local is not True
+                and image.registry
+                and image.remote_policy in {RemotePolicy.ALL, RemotePolicy.PULL_ONLY}
+            ):
+                by_registry.setdefault(id(image.registry), []).append(image)
+
+        for registry_images in by_registry.values():
+            with report.phase(None, "resolve_remote"):
+                registry_images[0].registry.resolve_remote_images(registry_images)
 
     @cached_property
     def reference(self):
@@ -92,13 +167,72 @@ class DockerImage:
             tag_parts.append(self.version)
 
         if self.with_hash:
-            tag_parts.append(self.build_config.get_hash()[: self.hash_len])
+            entry = self.locked_entry()
+            if entry is not None:
+                return entry["reference"]
+
+            # Reported under the reference once it is known, like the other phases of the image
+            with report.phase(self.name, "hash") as event:
+                tag_parts.append(self.build_config.get_hash()[: self.hash_len])
+                event.image = self.name + ":" + "-".join(tag_parts)
 
         if not tag_parts:
             return self.name
 
         return self.name + ":" + "-".join(tag_parts)
 
+    def invalidate(self):
+        """
+        Forgets the cached reference and whether the image exists, so that they are worked out again,
+        e.g. after the image's inputs have changed.
+        """
+        for name in ("reference", "registry_reference", "fingerprint"):
+            self.__dict__.pop(name, None)
+        self.forget_existence()
+
+    def forget_existence(self):
+        """Forgets whether the image exists and its ID, so that they are checked again by the next ensure"""
+        self.local = None
+        self.image_id = None
+
+    @cached_property
+    def fingerprint(self):
+        """A cheap digest of the image's inputs, used to look the image up in its lockfile"""
+        return Lockfile.fingerprint(self)
+
+    def locked_entry(self):
+        """Returns the lockfile entry of the image if it has one that matches its current inputs"""
+        if self.lockfile is None:
+            return None
+        return self.lockfile.get(self, self.fingerprint)
+
+    def verify_locked(self):
+        """
+        Returns True if the lockfile has a matching entry for the image and the local image still has
+        the recorded ID. This takes a single query, or none if the ID is already known.
+        """
+
+        entry = self.locked_entry()
+        if entry is None or entry["reference"] != self.ref:
+            return False
+
+        if self.image_id is None:
+            with report.phase(self.ref, "verify"):
+                self.image_id = get_engine().image_id(self.ref)
+        if self.image_id is None or self.image_id != entry["id"]:
+            return False
+
+        self.local = True
+        return True
+
+    def record_lock(self):
+        """Records the reference and image ID in the lockfile, if the image has one"""
+        if self.lockfile is None:
+            return
+        if self.image_id is None:
+            self.image_id = get_engine().image_id(self.ref)
+        self.lockfile.record(self, self.fingerprint, self.ref, self.image_id)
+
     @property
     def ref(self):
         return self.reference
@@ -111,30 +245,135 @@ class DockerImage:
 
         return self.registry.prepend_server(self.reference)
 
-    def check_existence(self):
+    def cache_references(self):
+        """
+        Returns the BuildKit cache references to build with as (cache_from, cache_to). Both are empty unless
+        build_cache is set and the image has a registry (a TarballCache can't hold BuildKit caches).
+        """
+
+        if (
+            not self.build_cache
+            or not self.registry
+            or not self.registry.supports_build_cache
+        ):
+            return [], None
+
+        cache_tag = self.registry.remote_name(
+            f"{self.name}:{CACHE_TAG}", self.prepend_server
+        )
+
+        cache_from = []
+        if self.remote_policy in {RemotePolicy.ALL, RemotePolicy.PULL_ONLY}:
+            cache_from.append(cache_tag)
+            previous = self.lockfile and self.lockfile.previous_reference(self)
+            if previous and previous != self.ref:
+                cache_from.append(
+                    self.registry.remote_name(previous, self.prepend_server)
+                )
+
+        cache_to = None
+        if self.remote_policy in {RemotePolicy.ALL, RemotePolicy.PUSH_ONLY}:
+            cache_to = cache_tag
+
+        if cache_from or cache_to:
+            self.registry.login()
+        return cache_from, cache_to
+
+    def check_existence(self, pull=True):
+        """
+        Checks whether the image exists locally or on the server. The server is asked whether it has the image
+        before anything is pulled, so a missing image costs one request. If pull is True (the default) an image
+        found on the server is pulled so that it is available locally.
+        """
+
         if self.has_local_image():
-            print("<<< Image already exists locally <<<")
+            report.message(self.ref, "<<< Image already exists locally <<<")
+            report.outcome(self.ref, "local")
             return True
 
         if self.registry and self.remote_policy in {
             RemotePolicy.ALL,
             RemotePolicy.PULL_ONLY,
         }:
-            print("Checking for image on server...")
-            if self.registry.try_pull_image(self.ref, self.prepend_server):
-                print("<<< Pulled image from server <<<")
+            report.message(self.ref, "Checking for image on server...")
+            with report.phase(self.ref, "remote_check"):
+                remote = self.registry.has_remote_image(self.ref, self.prepend_server)
+            if remote is False:
+                report.message(self.ref, "Image not found on server")
+                return False
+            if not pull and remote:
+                return True
+
+            with report.phase(self.ref, "pull"):
+                pulled = self.registry.try_pull_image(self.ref, self.prepend_server)
+            if pulled:
+                report.message(self.ref, "<<< Pulled image from server <<<")
+                report.outcome(self.ref, "pulled")
+                self.local = True
                 return True
 
         return False
 
-    def ensure(self):
+    def plan(self, parents=()) -> PlanEntry:
+        """
+        Returns what ensure would do for this image, without pulling or building anything.
+        The registry is asked whether it has the image if it isn't available locally.
+        """
+
+        push = bool(self.registry) and self.remote_policy in {
+            RemotePolicy.ALL,
+            RemotePolicy.PUSH_ONLY,
+        }
+        entry = PlanEntry(self.ref, "build", push=push, parents=list(parents))
+        if self.force_build:
+            return entry
+
+        if self.has_local_image():
+            entry.action = "local"
+            entry.push = False
+            return entry
+
+        if self.registry and self.remote_policy in {
+            RemotePolicy.ALL,
+            RemotePolicy.PULL_ONLY,
+        }:
+            entry.remote = self.registry.has_remote_image(self.ref, self.prepend_server)
+            if entry.remote is None:
+                entry.action = "pull_or_build"
+            elif entry.remote:
+                entry.action = "pull"
+                entry.push = False
+
+        return entry
+
+    def ensure(self, ensure_parents=True, push_pipeline: Optional[PushPipeline] = None):
         """
         Ensures that the image is available on the local system.
         By the time this function returns, the image will exist. It will be downloaded or built if necessary.
+
+        If ensure_parents is False the parent images are assumed to be ready already, and existence answers
+        already resolved for this image (e.g. by ImageGraph.ensure) are used.
+        If a push_pipeline is given, built images are pushed in the background through it instead of
+        before this function returns. Call push_pipeline.flush() to wait for the pushes.
+
+        Whether images exist is checked afresh by every call. Parents are only checked once the image itself
+        turns out to need a build.
         """
-        print(f">>> Ensuring image {self.ref} >>>")
+        try:
+            self._ensure(ensure_parents, push_pipeline)
+        finally:
+            self.forget_existence()
+
+    def _ensure(self, ensure_parents, push_pipeline):
+        report.message(self.ref, f">>> Ensuring image {self.ref} >>>")
+
+        if not self.force_build and self.lockfile and self.verify_locked():
+            report.message(self.ref, "<<< Image matches lockfile <<<")
+            report.outcome(self.ref, "local")
+            return
 
         if not self.force_build and self.check_existence():
+            self.record_lock()
             return
 
         if self.build_config is None:
@@ -142,16 +381,161 @@ class DockerImage:
                 f"Image {self.ref} needs to be built but it has no build config, so it can't be ensured."
             )
 
-        print(f"Building {self.ref}")
-        self.build_config.build_image(self.ref)
+        if self.build_locks is None:
+            self.build(ensure_parents, push_pipeline)
+            return
+
+        with self.build_locks.hold(self.ref) as waited:
+            # The process that held the lock may have built the image, and pushed it if it is on another host
+            if waited and not self.force_build:
+                report.message(
+                    self.ref, "Checking for an image built by another process"
+                )
+                self.local = None
+                if self.registry:
+                    self.registry.forget_image(self.ref, self.prepend_server)
+                if self.check_existence():
+                    self.record_lock()
+                    return
+
+            self.build(ensure_parents, push_pipeline)
+
+        return
+
+    def build(self, ensure_parents=True, push_pipeline=None):
+        """Builds the image and pushes it if the remote policy allows. Used by ensure once it knows a build is needed"""
+
+        # Parents are ensured outside of the build phase, so that it only times this image's own build
+        if ensure_parents:
+            self.build_config.ensure_parents(push_pipeline)
+
+        report.message(self.ref, f"Building {self.ref}")
+        with report.phase(self.ref, "build"):
+            cache_from, cache_to = self.cache_references()
+            self.build_config.build_image(
+                self.ref,
+                ensure_parents=False,
+                push_pipeline=push_pipeline,
+                cache_from=cache_from,
+                cache_to=cache_to,
+            )
+        self.local = True
+        self.image_id = None
+        self.record_lock()
 
         if self.registry and self.remote_policy in {
             RemotePolicy.ALL,
             RemotePolicy.PUSH_ONLY,
         }:
-            print("Pushing image")
-            self.registry.push_image(self.ref, self.prepend_server)
+            if push_pipeline is not None:
+                report.message(self.ref, "Queued image for pushing")
+                push_pipeline.submit(self)
+            else:
+                report.message(self.ref, "Pushing image")
+                with report.phase(self.ref, "push"):
+                    self.registry.push_image(self.ref, self.prepend_server)
+
+        report.message(self.ref, "<<< Built image <<<")
+        report.outcome(self.ref, "built")
+
+    async def check_existence_async(self, pull=True):
+        """Async variant of check_existence"""
+
+        if self.local is None:
+            with report.phase(self.ref, "inspect"):
+                self.local = await get_engine().image_exists_async(self.ref)
+        if self.local:
+            report.message(self.ref, "<<< Image already exists locally <<<")
+            report.outcome(self.ref, "local")
+            return True
+
+        if self.registry and self.remote_policy in {
+            RemotePolicy.ALL,
+            RemotePolicy.PULL_ONLY,
+        }:
+            report.message(self.ref, "Checking for image on server...")
+            with report.phase(self.ref, "remote_check"):
+                remote = await self.registry.has_remote_image_async(
+                    self.ref, self.prepend_server
+                )
+            if remote is False:
+                report.message(self.ref, "Image not found on server")
+                return False
+            if not pull and remote:
+                return True
 
-        print("<<< Built image <<<")
+            with report.phase(self.ref, "pull"):
+                pulled = await self.registry.try_pull_image_async(
+                    self.ref, self.prepend_server
+                )
+            if pulled:
+                report.message(self.ref, "<<< Pulled image from server <<<")
+                report.outcome(self.ref, "pulled")
+                self.local = True
+                return True
 
-        return
+        return False
+
+    async def ensure_async(self, ensure_parents=True):
+        """
+        Async variant of ensure. Docker is driven with asyncio subprocesses (or the engine's own async support),
+        so many images can be ensured from one event loop. Parents are ensured concurrently.
+        """
+        try:
+            await self._ensure_async(ensure_parents)
+        finally:
+            self.forget_existence()
+
+    async def _ensure_async(self, ensure_parents):
+        loop = asyncio.get_running_loop()
+        # Hashing the build inputs for the reference reads files, so it happens in the executor
+        ref = await loop.run_in_executor(None, lambda: self.ref)
+        report.message(ref, f">>> Ensuring image {ref} >>>")
+
+        if (
+            not self.force_build
+            and self.lockfile
+            and await loop.run_in_executor(None, self.verify_locked)
+        ):
+            report.message(self.ref, "<<< Image matches lockfile <<<")
+            report.outcome(self.ref, "local")
+            return
+
+        if not self.force_build and await self.check_existence_async():
+            await loop.run_in_executor(None, self.record_lock)
+            return
+
+        if self.build_config is None:
+            raise DockerImage.BuildFailedException(
+                f"Image {self.ref} needs to be built but it has no build config, so it can't be ensured."
+            )
+
+        if ensure_parents:
+            await self.build_config.ensure_parents_async()
+
+        report.message(self.ref, f"Building {self.ref}")
+        with report.phase(self.ref, "build"):
+            # Using a registry cache logs in to the registry, which may run docker login
+            cache_from, cache_to = await loop.run_in_executor(
+                None, self.cache_references
+            )
+            await self.build_config.build_image_async(
+                self.ref,
+                ensure_parents=False,
+                cache_from=cache_from,
+                cache_to=cache_to,
+            )
+        self.local = True
+        self.image_id = None
+        await loop.run_in_executor(None, self.record_lock)
+
+        if self.registry and self.remote_policy in {
+            RemotePolicy.ALL,
+            RemotePolicy.PUSH_ONLY,
+        }:
+            report.message(self.ref, "Pushing image")
+            with report.phase(self.ref, "push"):
+                await self.registry.push_image_async(self.ref, self.prepend_server)
+
+        report.message(self.ref, "<<< Built image <<<")
+        report.outcome(self.ref, "built")
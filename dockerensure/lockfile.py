@@ -0,0 +1,114 @@
+import json
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+from .digestcache import StatHasher
+
+
+class Lockfile:
+    """
+    Records the reference and image ID that each image resolved to, along with a fingerprint of its inputs.
+
+    The fingerprint is made from the metadata (size, mtime, inode) of the input files rather than their
+    contents, so it is cheap to compute. When the fingerprint of an image hasn't changed since it was
+    recorded, its reference is taken from the lockfile instead of being hashed, and ensure only checks
+    that the local image still has the recorded ID instead of checking for it locally and on the server.
+
+    Usage:
+    with Lockfile("dockerensure.lock") as lockfile:
+        image = DockerImage("app", config, with_hash=True, lockfile=lockfile)
+        image.ensure()
+    # The lockfile is saved here
+
+    Params:
+    path: File to keep the state in. It is created if it doesn't exist
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.entries: Dict[str, dict] = {}
+        self.changed = False
+
+        try:
+            data = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            data = {}
+        if data.get("version") == Lockfile.VERSION:
+            self.entries = data.get("images", {})
+
+    @staticmethod
+    def key(image):
+        """Images are recorded by name and version, so each image has a single entry"""
+        if image.version:
+            return f"{image.name}@{image.version}"
+        return image.name
+
+    @staticmethod
+    def fingerprint(image):
+        """Returns a digest of the image's settings and the metadata of its input files"""
+
+        hasher = StatHasher()
+        hasher.add_str(image.name)
+        hasher.add_str(str(image.version))
+        hasher.add_str(f"{image.with_hash} {image.hash_len}")
+        if image.build_config is None:
+            return hasher.hexdigest()
+        return image.build_config.add_state_to_hash(hasher)
+
+    def get(self, image, fingerprint) -> Optional[dict]:
+        """Returns the recorded reference and ID of the image if its fingerprint matches"""
+
+        with self.lock:
+            entry = self.entries.get(Lockfile.key(image))
+        if entry and entry["fingerprint"] == fingerprint:
+            return entry
+        return None
+
+    def previous_reference(self, image) -> Optional[str]:
+        """Returns the reference that the image was last recorded with, even if its inputs have changed"""
+
+        with self.lock:
+            entry = self.entries.get(Lockfile.key(image))
+        return entry and entry["reference"]
+
+    def record(self, image, fingerprint, reference, image_id):
+        entry = {"fingerprint": fingerprint, "reference": reference, "id": image_id}
+        with self.lock:
+            if self.entries.get(Lockfile.key(image)) != entry:
+                self.entries[Lockfile.key(image)] = entry
+                self.changed = True
+
+    def save(self):
+        """Writes the lockfile if anything has changed. The file is replaced atomically"""
+
+        with self.lock:
+            if not self.changed:
+                return
+            data = json.dumps(
+                {"version": Lockfile.VERSION, "images": self.entries},
+                indent=2,
+                sort_keys=True,
+            )
+            self.changed = False
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(data)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.save()
@@ -0,0 +1,185 @@
+import hashlib
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from os import PathLike
+from typing import Optional, Union
+
+from . import report
+from .utils import default_cache_dir
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+
+class BuildLocks:
+    """
+    Per-reference locks shared between processes, so that only one process on the host builds an image at once.
+
+    By default the locks use flock, which the OS releases if the holding process dies. Where flock can't be used
+    (e.g. a directory shared over the network) leases can be used instead: a lock file is created exclusively and
+    refreshed while it is held, and is taken over once it hasn't been refreshed for stale_after seconds, or if
+    its process has died on this host.
+
+    Params:
+    directory: Directory to keep the lock files in. Defaults to locks in the dockerensure cache directory
+    stale_after: Seconds after which an unrefreshed lease is considered abandoned
+    poll_interval: Seconds between attempts to take a lease
+    use_flock: Whether to use flock rather than leases. Defaults to flock where available
+    """
+
+    def __init__(
+        self,
+        directory: Union[None, str, PathLike] = None,
+        stale_after: float = 300,
+        poll_interval: float = 0.5,
+        use_flock: Optional[bool] = None,
+    ):
+        self.directory = directory or default_cache_dir() / "locks"
+        os.makedirs(self.directory, exist_ok=True)
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+        self.use_flock = fcntl is not None if use_flock is None else use_flock
+
+    def path(self, reference):
+        name = hashlib.sha256(reference.encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.directory, name + ".lock")
+
+    @contextmanager
+    def hold(self, reference):
+        """
+        Holds the lock for a reference. Yields True if another process held it first, in which case the
+        image may have been built in the meantime.
+        """
+
+        if self.use_flock:
+            with self._flock(reference) as waited:
+                yield waited
+        else:
+            with self._lease(reference) as waited:
+                yield waited
+
+    @contextmanager
+    def _flock(self, reference):
+        fd = os.open(self.path(reference), os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            waited = False
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                waited = True
+                report.message(
+                    reference, "Waiting for another process to build the image"
+                )
+                with report.phase(reference, "lock_wait"):
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+
+            try:
+                yield waited
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def _stale_key(self, path):
+        """
+        Returns the identity (inode and mtime) of the lease at path if it has been abandoned, otherwise None.
+        """
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        key = (stat.st_ino, stat.st_mtime_ns)
+
+        # Checked before reading the lease, since a holder that died before writing it leaves it empty
+        if time.time() - stat.st_mtime > self.stale_after:
+            return key
+
+        try:
+            with open(path) as f:
+                host, pid = f.read().split()[:2]
+        except (OSError, ValueError):
+            # The holder hasn't finished writing it yet, or has just released it
+            return None
+
+        if host == socket.gethostname():
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                return key
+            except OSError:
+                pass
+        return None
+
+    def _take_over(self, path, stale_key):
+        """
+        Removes an abandoned lease. It is first renamed to a name unique to this thread, so only one waiter
+        can claim it. If the claimed file turns out not to be the abandoned lease (another waiter took over
+        and created a new one in the meantime) it is put back.
+        """
+
+        claimed = f"{path}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}"
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return
+
+        try:
+            stat = os.stat(claimed)
+            if (stat.st_ino, stat.st_mtime_ns) != stale_key:
+                try:
+                    os.link(claimed, path)
+                except FileExistsError:
+                    pass
+        finally:
+            os.unlink(claimed)
+
+    @contextmanager
+    def _lease(self, reference):
+        path = self.path(reference)
+        waited = False
+        while True:
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+                break
+            except FileExistsError:
+                stale_key = self._stale_key(path)
+                if stale_key is not None:
+                    report.message(reference, "Taking over an abandoned build lock")
+                    self._take_over(path, stale_key)
+                    continue
+                if not waited:
+                    waited = True
+                    report.message(
+                        reference, "Waiting for another process to build the image"
+                    )
+                time.sleep(self.poll_interval)
+
+        with os.fdopen(fd, "w") as f:
+            f.write(f"{socket.gethostname()} {os.getpid()}\n")
+
+        released = threading.Event()
+
+        def refresh():
+            while not released.wait(self.stale_after / 3):
+                try:
+                    os.utime(path)
+                except OSError:
+                    return
+
+        refresher = threading.Thread(target=refresh, daemon=True)
+        refresher.start()
+        try:
+            yield waited
+        finally:
+            released.set()
+            refresher.join()
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,69 @@
+import json
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+
+@dataclass
+class PlanEntry:
+    """
+    What ensure would do for one image.
+
+    action is one of:
+    local: The image already exists locally
+    pull: The image exists on its registry and would be pulled
+    pull_or_build: The registry couldn't be queried, so a pull would be attempted before building
+    build: The image would be built
+
+    push is True if the image would be pushed after being built.
+    """
+
+    reference: str
+    action: str
+    push: bool = False
+    parents: List[str] = field(default_factory=list)
+    remote: Optional[bool] = None
+
+
+class Plan:
+    """
+    The result of planning a graph: the action that ensure would take for each image, in the order
+    they would be ensured. Produced by ImageGraph.plan, which has no side effects.
+    """
+
+    def __init__(self, entries: List[PlanEntry]):
+        self.entries = entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __getitem__(self, reference) -> PlanEntry:
+        for entry in self.entries:
+            if entry.reference == reference:
+                return entry
+        raise KeyError(reference)
+
+    @property
+    def to_build(self) -> List[str]:
+        """References of the images that would (or might) be built"""
+        return [
+            entry.reference
+            for entry in self.entries
+            if entry.action in ("build", "pull_or_build")
+        ]
+
+    def summary(self) -> Dict[str, int]:
+        """Returns the number of images for each action, and the number of pushes"""
+        counts = {"local": 0, "pull": 0, "pull_or_build": 0, "build": 0, "push": 0}
+        for entry in self.entries:
+            counts[entry.action] += 1
+            counts["push"] += entry.push
+        return counts
+
+    def to_dict(self):
+        return {
+            "images": [asdict(entry) for entry in self.entries],
+            "summary": self.summary(),
+        }
+
+    def to_json(self, indent=2):
+        return json.dumps(self.to_dict(), indent=indent)
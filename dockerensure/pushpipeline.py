@@ -0,0 +1,103 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict
+
+from . import report
+
+
+class PushPipeline:
+    """
+    Pushes images to their registries in the background, so that building can carry on while images are
+    uploaded. Failed pushes are retried with exponential backoff.
+
+    Usage:
+    with PushPipeline() as pushes:
+        for image in images:
+            image.ensure(push_pipeline=pushes)
+    # All pushes have finished here. PushFailedException is raised if any of them failed
+
+    Params:
+    max_workers: Maximum number of pushes to run at once
+    retries: Number of times a failed push is retried
+    backoff: Seconds to wait before the first retry. The wait doubles after each attempt
+    """
+
+    class PushFailedException(Exception):
+        """Raised when pushes failed. failures maps each reference to its last exception"""
+
+        def __init__(self, failures):
+            self.failures = failures
+            super().__init__(f"Failed to push {', '.join(failures)}")
+
+    def __init__(self, max_workers: int = 2, retries: int = 2, backoff: float = 1.0):
+        self.retries = retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="dockerensure-push"
+        )
+        self.lock = threading.Lock()
+        self.pending: Dict[str, Future] = {}
+        self.failures: Dict[str, Exception] = {}
+
+    def submit(self, image) -> Future:
+        """
+        Queues a push of the image to its registry. An image that is already queued isn't pushed twice.
+        """
+
+        with self.lock:
+            if image.ref not in self.pending:
+                self.pending[image.ref] = self.executor.submit(self._push, image)
+            return self.pending[image.ref]
+
+    def _push(self, image):
+        attempt = 0
+        while True:
+            try:
+                with report.phase(image.ref, "push"):
+                    image.registry.push_image(image.ref, image.prepend_server)
+                report.message(image.ref, "<<< Pushed image <<<")
+                return
+            except Exception as e:
+                if attempt >= self.retries:
+                    report.message(image.ref, f"Failed to push image: {e}")
+                    with self.lock:
+                        self.failures[image.ref] = e
+                    raise
+
+                delay = self.backoff * 2**attempt
+                report.message(image.ref, f"Push failed, retrying in {delay:.1f}s: {e}")
+                time.sleep(delay)
+                attempt += 1
+
+    def flush(self) -> Dict[str, Exception]:
+        """
+        Waits for every queued push to finish. Returns the pushes that failed since the last flush, as a
+        mapping of reference -> exception. The pipeline can be used again afterwards.
+        """
+
+        with self.lock:
+            futures = list(self.pending.values())
+        for future in futures:
+            future.exception()
+
+        with self.lock:
+            failures = self.failures
+            self.failures = {}
+            for ref, future in list(self.pending.items()):
+                if future.done():
+                    del self.pending[ref]
+        return failures
+
+    def close(self):
+        """Waits for the queued pushes and stops the workers"""
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        failures = self.flush()
+        self.close()
+        if failures and exc_type is None:
+            raise PushPipeline.PushFailedException(failures)
@@ -1,70 +1,244 @@
-import subprocess
-from dataclasses import dataclass
-from typing import Optional
+import asyncio
+from dataclasses import dataclass, field
+from typing import ClassVar, Dict, Optional, Set, Tuple
 
+from . import report
+from .absentcache import AbsentCache
+from .engine import get_engine
 from .image import DockerImage
+from .registryclient import DOCKER_HUB_HOST, RegistryClient
+from .sessions import get_session
+from .utils import normalize_reference, registry_host, split_reference
 
 
 @dataclass
 class DockerRegistry:
     """
     Provides functions to interact with a remote Docker server: logging in, pushing and pulling images.
+
+    Registries for the same server and username share a process-wide session (see sessions.get_session), so
+    Docker is only logged in once per process, or not at all if docker login already stored the credentials.
+    API connections and tokens are shared too. If no password is given, the stored one is used for the API.
     """
 
     server: Optional[str]  # Set to None for the default Docker registry
     username: Optional[str] = None
     password: Optional[str] = None
+    insecure: bool = (
+        False  # Use HTTP instead of HTTPS for registry API requests. Always true for localhost
+    )
+    # Remembers images that the server doesn't have. Defaults to an in-memory cache with a one minute TTL
+    absent_cache: Optional[AbsentCache] = field(default=None, repr=False, compare=False)
+
+    supports_build_cache: ClassVar[bool] = True
 
     def __post_init__(self):
-        self.loggedin = False
+        self.session = get_session(
+            self.server, self.username, self.password, self.insecure
+        )
+        self.client = self.session.client
+        # Tags of each (registry host, repository), as found by resolve_remote_images. Only kept for the
+        # run that listed them (see forget_listings), as other runners may push tags in the meantime
+        self.remote_tags: Dict[Tuple[str, str], Set[str]] = {}
+        if self.absent_cache is None:
+            self.absent_cache = AbsentCache()
+
+    @property
+    def loggedin(self):
+        return self.session.loggedin
 
     def login(self):
-        if self.loggedin:
-            return
-
-        if not self.username:
-            return
+        self.session.login()
 
-        self.loggedin = True
-
-        args = ["docker", "login"]
-        if self.server:
-            args += [self.server]
-        args += ["-u", self.username, "-p", self.password]
-        subprocess.run(args, check=True)
+    async def login_async(self):
+        await self.session.login_async()
 
     def prepend_server(self, name):
         if not self.server:
             return name
         return self.server + "/" + name
 
+    def remote_name(self, local_name, prepend_server):
+        if prepend_server:
+            return self.prepend_server(local_name)
+        return local_name
+
+    def split_remote_name(self, remote_name) -> Tuple[RegistryClient, str, str]:
+        """
+        Returns the API client for the registry that a remote name refers to, and the repository (without the
+        host) and tag. A fully qualified name on another registry, e.g. ghcr.io/org/app with server None, is
+        looked up on that registry without credentials. Docker Hub names lose their docker.io/ and library/
+        prefixes, e.g. docker.io/library/alpine -> alpine.
+        """
+
+        client = self.client
+        if self.server and remote_name.startswith(self.server + "/"):
+            host = self.server
+        else:
+            host = registry_host(remote_name)
+        if host is not None and host != self.server:
+            other = get_session(host).client
+            if other.host != client.host:
+                client = other
+
+        if client.host == DOCKER_HUB_HOST:
+            remote_name = normalize_reference(remote_name)
+        elif host is not None:
+            remote_name = remote_name[len(host) + 1 :]
+        repository, tag = split_reference(remote_name)
+        return client, repository, tag or "latest"
+
+    def forget_listings(self):
+        """Forgets the tags listed by resolve_remote_images, so that the next run lists them again"""
+        self.remote_tags.clear()
+
+    def forget_image(self, local_name, prepend_server):
+        """Forgets whether the server has the image, e.g. because another process may have pushed it since"""
+
+        remote_name = self.remote_name(local_name, prepend_server)
+        client, repository, _ = self.split_remote_name(remote_name)
+        self.absent_cache.discard(client.host, remote_name)
+        self.remote_tags.pop((client.host, repository), None)
+
+    def has_remote_image(self, local_name, prepend_server) -> Optional[bool]:
+        """
+        Checks whether the image exists on the server without pulling it, using a manifest HEAD request.
+        Returns None if the server couldn't be queried. Images found to be absent are remembered in absent_cache.
+        """
+
+        remote_name = self.remote_name(local_name, prepend_server)
+        client, repository, tag = self.split_remote_name(remote_name)
+        if self.absent_cache.is_absent(client.host, remote_name):
+            return False
+
+        if (client.host, repository) in self.remote_tags:
+            exists = tag in self.remote_tags[client.host, repository]
+        else:
+            try:
+                exists = client.manifest_exists(repository, tag)
+            except Exception:
+                return None
+
+        if not exists:
+            self.absent_cache.add(client.host, remote_name)
+        return exists
+
+    def resolve_remote_images(self, images) -> Dict[str, Optional[bool]]:
+        """
+        Checks which of the given images exist on the server, listing the tags of each repository once
+        rather than checking each image separately. The tags are remembered for has_remote_image.
+
+        Returns a mapping of reference -> whether the image exists, or None if the server couldn't be queried.
+        """
+
+        existence = {}
+        by_repository = {}
+        clients = {}
+        for image in images:
+            remote_name = self.remote_name(image.ref, image.prepend_server)
+            client, repository, tag = self.split_remote_name(remote_name)
+            if self.absent_cache.is_absent(client.host, remote_name):
+                existence[image.ref] = False
+                continue
+            clients[client.host] = client
+            by_repository.setdefault((client.host, repository), []).append(
+                (image.ref, remote_name, tag)
+            )
+
+        for key, tagged in by_repository.items():
+            host, repository = key
+            if key not in self.remote_tags:
+                try:
+                    self.remote_tags[key] = set(clients[host].list_tags(repository))
+                except Exception:
+                    existence.update({ref: None for ref, _, _ in tagged})
+                    continue
+
+            tags = self.remote_tags[key]
+            for ref, remote_name, tag in tagged:
+                existence[ref] = tag in tags
+                if not existence[ref]:
+                    self.absent_cache.add(host, remote_name)
+
+        return existence
+
     def try_pull_image(self, local_name, prepend_server):
-        self.login()
+        remote_name = self.remote_name(local_name, prepend_server)
+        client, _, _ = self.split_remote_name(remote_name)
+        if self.absent_cache.is_absent(client.host, remote_name):
+            return False
 
-        remote_name = local_name
-        if prepend_server:
-            remote_name = self.prepend_server(local_name)
+        self.login()
 
+        engine = get_engine()
         try:
-            subprocess.run(["docker", "pull", remote_name], check=True)
+            engine.pull(remote_name)
         except Exception as e:
             return False
 
         if prepend_server:
-            subprocess.run(["docker", "tag", remote_name, local_name], check=True)
+            engine.tag(remote_name, local_name)
+            report.tagged(local_name, remote_name)
 
         return True
 
     def push_image(self, local_name, prepend_server):
         self.login()
 
+        engine = get_engine()
         remote_name = local_name
         if prepend_server:
             remote_name = self.prepend_server(local_name)
 
-            subprocess.run(["docker", "tag", local_name, remote_name], check=True)
+            engine.tag(local_name, remote_name)
+            report.tagged(local_name, remote_name)
+
+        engine.push(remote_name)
+        client, repository, tag = self.split_remote_name(remote_name)
+        self.absent_cache.discard(client.host, remote_name)
+        if (client.host, repository) in self.remote_tags:
+            self.remote_tags[client.host, repository].add(tag)
+
+    async def has_remote_image_async(self, local_name, prepend_server):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, self.has_remote_image, local_name, prepend_server
+        )
+
+    async def try_pull_image_async(self, local_name, prepend_server):
+        remote_name = self.remote_name(local_name, prepend_server)
+        client, _, _ = self.split_remote_name(remote_name)
+        if self.absent_cache.is_absent(client.host, remote_name):
+            return False
 
-        subprocess.run(["docker", "push", remote_name], check=True)
+        await self.login_async()
+
+        engine = get_engine()
+        try:
+            await engine.pull_async(remote_name)
+        except Exception as e:
+            return False
+
+        if prepend_server:
+            await engine.tag_async(remote_name, local_name)
+            report.tagged(local_name, remote_name)
+
+        return True
+
+    async def push_image_async(self, local_name, prepend_server):
+        await self.login_async()
+
+        engine = get_engine()
+        remote_name = self.remote_name(local_name, prepend_server)
+        if prepend_server:
+            await engine.tag_async(local_name, remote_name)
+            report.tagged(local_name, remote_name)
+
+        await engine.push_async(remote_name)
+        client, repository, tag = self.split_remote_name(remote_name)
+        self.absent_cache.discard(client.host, remote_name)
+        if (client.host, repository) in self.remote_tags:
+            self.remote_tags[client.host, repository].add(tag)
 
     def image(self, *args, **kwargs):
         """
@@ -0,0 +1,180 @@
+import base64
+import http.client
+import json
+import re
+import threading
+import urllib.parse
+import urllib.request
+from typing import Dict, List, Optional
+
+from .connpool import ConnectionPool
+
+DOCKER_HUB_HOST = "registry-1.docker.io"
+
+MANIFEST_TYPES = ", ".join(
+    [
+        "application/vnd.docker.distribution.manifest.v2+json",
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+        "application/vnd.oci.image.manifest.v1+json",
+        "application/vnd.oci.image.index.v1+json",
+    ]
+)
+
+
+def is_local_host(host):
+    return host.split(":")[0] in ("localhost", "127.0.0.1", "::1")
+
+
+class RegistryClient:
+    """
+    Minimal client for the Docker Registry HTTP API v2, used to find out whether images exist without pulling them.
+
+    Connections are kept alive and bearer tokens are cached per scope, so repeated checks against the same
+    repository cost a single round trip.
+
+    Params:
+    host: Registry host, e.g. "myregistry.com:5000". None for Docker Hub
+    username/password: Credentials, if the registry needs them
+    secure: Use HTTPS. Defaults to True except for localhost, which Docker also treats as insecure
+    timeout: Socket timeout in seconds
+    """
+
+    class RegistryException(Exception):
+        pass
+
+    def __init__(
+        self,
+        host: Optional[str] = None,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        secure: Optional[bool] = None,
+        timeout: float = 30,
+    ):
+        self.host = host or DOCKER_HUB_HOST
+        self.username = username
+        self.password = password
+        if secure is None:
+            secure = not is_local_host(self.host)
+
+        connection_class = (
+            http.client.HTTPSConnection if secure else http.client.HTTPConnection
+        )
+        self.pool = ConnectionPool(lambda: connection_class(self.host, timeout=timeout))
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.tokens: Dict[str, str] = {}
+        self.use_basic = False
+
+    def repository(self, name):
+        """Returns the repository path for an image name, adding library/ for official Docker Hub images"""
+        if self.host == DOCKER_HUB_HOST and "/" not in name:
+            return "library/" + name
+        return name
+
+    def _basic_auth(self):
+        credentials = f"{self.username}:{self.password}".encode("utf-8")
+        return "Basic " + base64.b64encode(credentials).decode("ascii")
+
+    def _auth_headers(self, scope):
+        with self.lock:
+            token = self.tokens.get(scope)
+        if token:
+            return {"Authorization": "Bearer " + token}
+        if self.use_basic and self.username:
+            return {"Authorization": self._basic_auth()}
+        return {}
+
+    def _authenticate(self, challenge, scope):
+        """Handles a WWW-Authenticate challenge, fetching a bearer token if needed"""
+
+        scheme, _, params = challenge.partition(" ")
+        params = dict(re.findall(r'(\w+)="([^"]*)"', params))
+
+        if scheme.lower() == "basic":
+            if not self.username:
+                raise RegistryClient.RegistryException(
+                    f"{self.host} requires credentials"
+                )
+            self.use_basic = True
+            return
+
+        if scheme.lower() != "bearer" or "realm" not in params:
+            raise RegistryClient.RegistryException(
+                f"Unsupported authentication challenge from {self.host}: {challenge}"
+            )
+
+        query = {"scope": params.get("scope", scope)}
+        if "service" in params:
+            query["service"] = params["service"]
+        request = urllib.request.Request(
+            params["realm"] + "?" + urllib.parse.urlencode(query)
+        )
+        if self.username:
+            request.add_header("Authorization", self._basic_auth())
+
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            body = json.loads(response.read())
+
+        token = body.get("token") or body.get("access_token")
+        with self.lock:
+            self.tokens[scope] = token
+
+    def request(self, method, path, repository, headers=None):
+        """Makes an authenticated request, returning (response, body)"""
+
+        scope = f"repository:{repository}:pull"
+        for attempt in range(2):
+            response, body = self.pool.request(
+                method, path, headers={**(headers or {}), **self._auth_headers(scope)}
+            )
+            if response.status == 401 and attempt == 0:
+                self._authenticate(response.getheader("WWW-Authenticate", ""), scope)
+                continue
+            return response, body
+
+    def manifest_exists(self, name, tag) -> bool:
+        """Checks whether a tag exists with a HEAD request for its manifest"""
+
+        repository = self.repository(name)
+        response, _ = self.request(
+            "HEAD",
+            f"/v2/{repository}/manifests/{tag}",
+            repository,
+            headers={"Accept": MANIFEST_TYPES},
+        )
+        if response.status == 200:
+            return True
+        if response.status == 404:
+            return False
+        raise RegistryClient.RegistryException(
+            f"Unexpected status {response.status} checking {repository}:{tag}"
+        )
+
+    def list_tags(self, name) -> List[str]:
+        """Returns all tags of a repository, following pagination. A repository that doesn't exist has no tags"""
+
+        repository = self.repository(name)
+        path = f"/v2/{repository}/tags/list?n=1000"
+        tags = []
+        while path:
+            response, body = self.request("GET", path, repository)
+            if response.status == 404:
+                return tags
+            if response.status != 200:
+                raise RegistryClient.RegistryException(
+                    f"Unexpected status {response.status} listing tags of {repository}"
+                )
+
+            tags += json.loads(body).get("tags") or []
+
+            link = re.match(r"<([^>]+)>", response.getheader("Link", ""))
+            path = None
+            if link:
+                url = urllib.parse.urlsplit(link.group(1))
+                path = url.path + ("?" + url.query if url.query else "")
+
+        return tags
+
+    def close(self):
+        self.pool.close()
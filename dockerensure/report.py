@@ -0,0 +1,186 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger("dockerensure")
+
+
+@dataclass
+class Event:
+    """
+    Something that happened while ensuring images. Listeners receive every event.
+
+    kind is one of:
+    message: Progress text for the image (text)
+    phase: A phase of work finished (phase, duration in seconds, outcome of "ok" or "failed")
+    outcome: The image has been ensured (outcome of "local", "pulled" or "built")
+    tag: The image was also tagged as another reference (alias), e.g. with its registry's server prepended
+    counter: A counter was incremented (counter, amount)
+    """
+
+    kind: str
+    image: Optional[str] = None
+    text: Optional[str] = None
+    phase: Optional[str] = None
+    duration: Optional[float] = None
+    outcome: Optional[str] = None
+    counter: Optional[str] = None
+    amount: int = 0
+    alias: Optional[str] = None
+
+
+def print_messages(event: Event):
+    """Prints progress messages to stdout. This listener is installed by default"""
+    if event.kind == "message":
+        print(event.text)
+
+
+def log_messages(event: Event):
+    """Sends events to the dockerensure logger. Can be used in place of print_messages"""
+    if event.kind == "message":
+        logger.info("%s: %s", event.image, event.text)
+    elif event.kind == "phase":
+        logger.debug(
+            "%s: %s %s in %.3fs",
+            event.image,
+            event.phase,
+            event.outcome,
+            event.duration,
+        )
+
+
+_listeners: List[Callable[[Event], None]] = [print_messages]
+_listeners_lock = threading.Lock()
+
+
+def add_listener(listener: Callable[[Event], None]):
+    with _listeners_lock:
+        _listeners.append(listener)
+
+
+def remove_listener(listener: Callable[[Event], None]):
+    with _listeners_lock:
+        if listener in _listeners:
+            _listeners.remove(listener)
+
+
+def emit(event: Event):
+    with _listeners_lock:
+        listeners = list(_listeners)
+    for listener in listeners:
+        listener(event)
+
+
+def message(image, text):
+    emit(Event("message", image=image, text=text))
+
+
+def outcome(image, result):
+    emit(Event("outcome", image=image, outcome=result))
+
+
+def tagged(image, alias):
+    emit(Event("tag", image=image, alias=alias))
+
+
+def count(counter, amount=1):
+    emit(Event("counter", counter=counter, amount=amount))
+
+
+@contextmanager
+def phase(image, name):
+    """
+    Times the enclosed block and reports it as a phase of work on the image. The event is yielded, so its image
+    can be changed before it is reported, e.g. to the reference of an image that only becomes known in the block.
+    """
+
+    event = Event("phase", image=image, phase=name)
+    start = time.perf_counter()
+    event.outcome = "failed"
+    try:
+        yield event
+        event.outcome = "ok"
+    finally:
+        event.duration = time.perf_counter() - start
+        emit(event)
+
+
+class RunReport:
+    """
+    Listener that collects the timing of every phase of every image, counters (e.g. bytes hashed and
+    digest cache hits) and the outcome of each image, for exporting as JSON.
+
+    Usage:
+    with RunReport.record() as report:
+        ensure_all(images)
+    print(report.to_json())
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.phases: List[dict] = []
+        self.counters: Dict[str, int] = {}
+        self.outcomes: Dict[str, str] = {}
+
+    def __call__(self, event: Event):
+        with self.lock:
+            if event.kind == "phase":
+                self.phases.append(
+                    {
+                        "image": event.image,
+                        "phase": event.phase,
+                        "duration": event.duration,
+                        "outcome": event.outcome,
+                    }
+                )
+            elif event.kind == "counter":
+                self.counters[event.counter] = (
+                    self.counters.get(event.counter, 0) + event.amount
+                )
+            elif event.kind == "outcome":
+                self.outcomes[event.image] = event.outcome
+
+    @classmethod
+    @contextmanager
+    def record(cls):
+        report = cls()
+        add_listener(report)
+        try:
+            yield report
+        finally:
+            remove_listener(report)
+
+    def phase_totals(self) -> Dict[str, float]:
+        """Returns the total time spent in each phase, over all images"""
+        totals = {}
+        with self.lock:
+            for entry in self.phases:
+                totals[entry["phase"]] = (
+                    totals.get(entry["phase"], 0) + entry["duration"]
+                )
+        return totals
+
+    def to_dict(self):
+        with self.lock:
+            images = {}
+            for entry in self.phases:
+                image = images.setdefault(entry["image"], {"phases": []})
+                image["phases"].append({k: v for k, v in entry.items() if k != "image"})
+            for image, result in self.outcomes.items():
+                images.setdefault(image, {"phases": []})["outcome"] = result
+
+            data = {
+                "start": self.start,
+                "images": images,
+                "counters": dict(self.counters),
+            }
+        data["phase_totals"] = self.phase_totals()
+        return data
+
+    def to_json(self, indent=2):
+        return json.dumps(self.to_dict(), indent=indent)
@@ -0,0 +1,181 @@
+import asyncio
+import base64
+import json
+import os
+import subprocess
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from . import report
+from .engine import get_engine
+from .registryclient import RegistryClient
+
+DOCKER_HUB_SERVERS = (None, "docker.io", "index.docker.io")
+DOCKER_HUB_CONFIG_KEY = "https://index.docker.io/v1/"
+
+
+def docker_config_path() -> Path:
+    """Returns the docker CLI config file, which is in DOCKER_CONFIG if it is set, otherwise in ~/.docker"""
+    directory = os.environ.get("DOCKER_CONFIG") or Path.home() / ".docker"
+    return Path(directory) / "config.json"
+
+
+def _config_keys(server) -> List[str]:
+    """Returns the keys that credentials for a server may be stored under in the docker config"""
+    if server in DOCKER_HUB_SERVERS:
+        return [DOCKER_HUB_CONFIG_KEY, "docker.io", "index.docker.io"]
+    return [server, "https://" + server, "http://" + server]
+
+
+def _helper_credentials(helper, key) -> Optional[Tuple[str, str]]:
+    try:
+        p = subprocess.run(
+            [f"docker-credential-{helper}", "get"],
+            input=key,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            check=True,
+        )
+        credentials = json.loads(p.stdout)
+        return credentials["Username"], credentials["Secret"]
+    except (OSError, subprocess.CalledProcessError, ValueError, KeyError):
+        return None
+
+
+def stored_credentials(server) -> Optional[Tuple[str, str]]:
+    """
+    Returns the (username, password) that docker login stored for a server, either in the docker config
+    or in a credential helper, or None if there are none.
+    """
+
+    try:
+        config = json.loads(docker_config_path().read_text())
+    except (OSError, ValueError):
+        return None
+
+    helpers = config.get("credHelpers") or {}
+    auths = config.get("auths") or {}
+    keys = _config_keys(server)
+    for key in keys:
+        if key in helpers:
+            return _helper_credentials(helpers[key], key)
+        auth = (auths.get(key) or {}).get("auth")
+        if auth:
+            try:
+                decoded = base64.b64decode(auth).decode("utf-8")
+            except ValueError:
+                continue
+            username, _, password = decoded.partition(":")
+            return username, password
+
+    if config.get("credsStore"):
+        for key in keys:
+            if key in auths:
+                return _helper_credentials(config["credsStore"], key)
+    return None
+
+
+class RegistrySession:
+    """
+    State shared by every DockerRegistry for the same server and username: the registry API client,
+    with its connections and tokens, and whether Docker has been given the credentials.
+
+    Params: as for DockerRegistry
+    """
+
+    def __init__(self, server, username=None, password=None, insecure=False):
+        self.server = server
+        self.username = username
+        self.password = password
+        self.lock = threading.Lock()
+        self.loggedin = False
+        self.client = RegistryClient(
+            None if server in DOCKER_HUB_SERVERS else server,
+            username,
+            password,
+            secure=False if insecure else None,
+        )
+
+        if username and password is None:
+            # Fall back on the password stored by docker login, for the API client
+            stored = stored_credentials(server)
+            if stored and stored[0] == username:
+                self.password = self.client.password = stored[1]
+
+    def update_password(self, password):
+        """Switches to a different password, e.g. after it has been rotated"""
+
+        with self.lock:
+            if password is None or password == self.password:
+                return
+            self.password = self.client.password = password
+            self.loggedin = False
+            with self.client.lock:
+                self.client.tokens.clear()
+
+    def _use_stored(self) -> bool:
+        """If docker login has already stored these credentials, gives them to the engine and returns True"""
+
+        if stored_credentials(self.server) != (self.username, self.password):
+            return False
+        get_engine().set_credentials(self.server, self.username, self.password)
+        report.count("logins_reused")
+        return True
+
+    def login(self):
+        if not self.username:
+            return
+        with self.lock:
+            if self.loggedin:
+                return
+            if not self._use_stored():
+                get_engine().login(self.server, self.username, self.password)
+            self.loggedin = True
+
+    async def login_async(self):
+        """
+        Async variant of login. The login runs in the event loop's executor under the session lock, so callers
+        wait until it has finished, whether it was started by a thread or by another coroutine.
+        """
+        if not self.username or self.loggedin:
+            return
+        await asyncio.get_running_loop().run_in_executor(None, self.login)
+
+    def close(self):
+        self.client.close()
+
+
+_sessions: Dict[tuple, RegistrySession] = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(server, username=None, password=None, insecure=False):
+    """
+    Returns the process-wide session for a server and username, creating it if needed.
+    Thread safe. Docker Hub's names for itself share a session.
+    """
+
+    host = None if server in DOCKER_HUB_SERVERS else server
+    key = (host, username, insecure)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _sessions[key] = RegistrySession(
+                server, username, password, insecure
+            )
+            return session
+
+    session.update_password(password)
+    return session
+
+
+def reset_sessions():
+    """Closes and forgets every session, so that the next use of each registry logs in again"""
+
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        session.close()
@@ -0,0 +1,166 @@
+import asyncio
+import gzip
+import hashlib
+import os
+import threading
+from os import PathLike
+from typing import ClassVar, Dict, List, Optional, Union
+
+from . import report
+from .engine import get_engine
+from .image import DockerImage
+from .utils import normalize_reference
+
+
+class TarballCache:
+    """
+    Keeps images as gzipped `docker save` archives in a directory, e.g. on a shared filesystem or a local SSD.
+    It can be used as the registry of a DockerImage in place of a DockerRegistry: images that don't exist
+    locally are loaded from the directory, and built images are saved to it, depending on the remote policy.
+
+    Archives are streamed to and from Docker, and are written to a temporary file that is renamed into place,
+    so other processes never see a partial archive. Archives are touched when they are loaded, and once the
+    directory holds more than max_bytes the least recently used are removed.
+
+    Params:
+    directory: Directory to keep the archives in
+    max_bytes: Maximum total size of the archives. Unlimited if None
+    compresslevel: gzip compression level. Lower levels are faster, higher levels use less space
+    """
+
+    # BuildKit layer caches need a registry
+    supports_build_cache: ClassVar[bool] = False
+
+    def __init__(
+        self,
+        directory: Union[str, PathLike],
+        max_bytes: Optional[int] = None,
+        compresslevel: int = 1,
+    ):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.compresslevel = compresslevel
+
+    def path(self, reference):
+        name = hashlib.sha256(normalize_reference(reference).encode("utf-8"))
+        return os.path.join(self.directory, name.hexdigest()[:32] + ".tar.gz")
+
+    def login(self):
+        pass
+
+    async def login_async(self):
+        pass
+
+    def forget_listings(self):
+        pass
+
+    def forget_image(self, local_name, prepend_server):
+        pass
+
+    def prepend_server(self, name):
+        return name
+
+    def remote_name(self, local_name, prepend_server):
+        return local_name
+
+    def has_remote_image(self, local_name, prepend_server) -> Optional[bool]:
+        return os.path.exists(self.path(local_name))
+
+    def resolve_remote_images(self, images) -> Dict[str, Optional[bool]]:
+        return {
+            image.ref: self.has_remote_image(image.ref, image.prepend_server)
+            for image in images
+        }
+
+    def try_pull_image(self, local_name, prepend_server):
+        path = self.path(local_name)
+        try:
+            f = gzip.open(path, "rb")
+        except FileNotFoundError:
+            return False
+
+        try:
+            with f:
+                get_engine().load(f)
+        except Exception:
+            return False
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return True
+
+    def push_image(self, local_name, prepend_server):
+        path = self.path(local_name)
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporary, "wb") as raw:
+                with gzip.GzipFile(
+                    fileobj=raw, mode="wb", compresslevel=self.compresslevel, mtime=0
+                ) as f:
+                    get_engine().save(local_name, f)
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(temporary, path)
+        except BaseException:
+            try:
+                os.unlink(temporary)
+            except FileNotFoundError:
+                pass
+            raise
+
+        if self.max_bytes is not None:
+            self.evict(keep=path)
+
+    def evict(self, keep=None) -> List[str]:
+        """
+        Removes the least recently used archives until the total size is at most max_bytes.
+        The archive at keep (the one just written) is never removed. Returns the removed paths.
+        """
+
+        archives = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".tar.gz"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            archives.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in archives)
+        removed = []
+        for _, size, path in sorted(archives):
+            if self.max_bytes is None or total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed.append(path)
+            report.count("archives_evicted")
+        return removed
+
+    async def has_remote_image_async(self, local_name, prepend_server):
+        return self.has_remote_image(local_name, prepend_server)
+
+    async def try_pull_image_async(self, local_name, prepend_server):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, self.try_pull_image, local_name, prepend_server
+        )
+
+    async def push_image_async(self, local_name, prepend_server):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.push_image, local_name, prepend_server)
+
+    def image(self, *args, **kwargs):
+        """
+        Constructs a DockerImage that uses this cache
+        """
+        return DockerImage(*args, registry=self, **kwargs)
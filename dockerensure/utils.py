@@ -1,5 +1,10 @@
 import datetime
+import logging
+import os
 from dataclasses import dataclass
+from pathlib import Path
+
+logger = logging.getLogger("dockerensure")
 
 
 @dataclass
@@ -11,8 +16,68 @@ class IntervalOffset:
 
     def get_intervals(self):
         now = datetime.datetime.now(datetime.timezone.utc)
-        print(now)
-        print(self.offset)
         delta = now - self.offset
-        print(delta)
+        logger.debug("Interval offset %s, now %s, delta %s", self.offset, now, delta)
         return delta // self.interval
+
+
+def default_cache_dir():
+    """
+    Returns the directory used for persistent caches. This can be set with the DOCKERENSURE_CACHE_DIR environment
+    variable, otherwise it is placed in the user cache directory.
+    """
+
+    if os.environ.get("DOCKERENSURE_CACHE_DIR"):
+        return Path(os.environ["DOCKERENSURE_CACHE_DIR"])
+
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "dockerensure"
+
+
+def split_reference(reference):
+    """
+    Splits an image reference into its repository and tag, e.g. "host:5000/image:1.0" -> ("host:5000/image", "1.0").
+    The tag is None if the reference doesn't have one. Digest references keep the digest in the tag, e.g. "image@sha256:..."
+    -> ("image", "sha256:...").
+    """
+
+    if "@" in reference:
+        repository, digest = reference.split("@", 1)
+        return repository, digest
+
+    slash = reference.rfind("/")
+    colon = reference.rfind(":")
+    if colon > slash:
+        return reference[:colon], reference[colon + 1 :]
+
+    return reference, None
+
+
+def registry_host(reference):
+    """Returns the registry host of an image reference, or None if it refers to the default registry (Docker Hub)"""
+
+    first, _, rest = reference.partition("/")
+    if rest and ("." in first or ":" in first or first == "localhost"):
+        return first
+
+    return None
+
+
+def normalize_reference(reference):
+    """
+    Returns the reference in the short form that Docker lists images with, e.g. "docker.io/library/alpine" -> "alpine:latest",
+    so that references to the same image compare equal.
+    """
+
+    for prefix in ("docker.io/", "index.docker.io/"):
+        if reference.startswith(prefix):
+            reference = reference[len(prefix) :]
+            break
+
+    if reference.startswith("library/") and reference.count("/") == 1:
+        reference = reference[len("library/") :]
+
+    repository, tag = split_reference(reference)
+    if tag is None:
+        return repository + ":latest"
+    return reference
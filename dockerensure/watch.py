@@ -0,0 +1,323 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from . import report
+from .context import IgnoreMatcher, walk_context
+from .digestcache import DigestCache
+from .graph import ImageGraph, ensure_all
+
+_IN_MODIFY = 0x2
+_IN_ATTRIB = 0x4
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_DELETE_SELF = 0x400
+_IN_ISDIR = 0x40000000
+_IN_MASK = (
+    _IN_MODIFY
+    | _IN_ATTRIB
+    | _IN_CLOSE_WRITE
+    | _IN_MOVED_FROM
+    | _IN_MOVED_TO
+    | _IN_CREATE
+    | _IN_DELETE
+    | _IN_DELETE_SELF
+)
+_EVENT = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """
+    Watches directories for changes with Linux inotify, through ctypes. Directories created inside
+    watched directories are watched too.
+
+    Raises OSError if inotify isn't available.
+    """
+
+    def __init__(self, directories: Iterable[str]):
+        path = ctypes.util.find_library("c")
+        self.libc = ctypes.CDLL(path, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories: Dict[int, str] = {}
+        for directory in directories:
+            self.add(directory)
+
+    def add(self, directory):
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(directory), ctypes.c_uint32(_IN_MASK)
+        )
+        if wd >= 0:
+            self.directories[wd] = directory
+
+    def wait(self, timeout) -> Set[str]:
+        """Waits up to timeout seconds for changes, returning the paths that changed"""
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        changed = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+
+            directory = self.directories.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, os.fsdecode(name)) if name else directory
+            changed.add(path)
+
+            if mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+                for root, _, _ in os.walk(path):
+                    self.add(root)
+
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Finds changes by comparing snapshots of file metadata. Used where inotify isn't available.
+
+    Params:
+    snapshot: Returns a mapping of path -> metadata for every watched file
+    interval: Seconds between snapshots
+    """
+
+    def __init__(self, snapshot: Callable[[], Dict[str, tuple]], interval=1.0):
+        self.snapshot = snapshot
+        self.interval = interval
+        self.previous = snapshot()
+
+    def wait(self, timeout) -> Set[str]:
+        deadline = time.monotonic() + timeout
+        while True:
+            current = self.snapshot()
+            changed = {
+                path
+                for path in self.previous.keys() | current.keys()
+                if self.previous.get(path) != current.get(path)
+            }
+            self.previous = current
+            remaining = deadline - time.monotonic()
+            if changed or remaining <= 0:
+                return changed
+            time.sleep(min(self.interval, remaining))
+
+    def close(self):
+        pass
+
+
+class Watch:
+    """
+    Keeps images up to date while their inputs are edited.
+
+    When files that an image depends on change, that image and the images built from it are ensured again.
+    Changes are debounced, so a burst of saves causes one rebuild. Build configs without a digest cache are
+    given an in-memory one, so when a build context is walked only the files that changed are read again.
+    Files listed individually with FilePolicy.Only are hashed as a stream, so they are all read again
+    whenever any of them changes.
+
+    Params:
+    images: The images to keep up to date. Their parents are watched too
+    debounce: Seconds without changes to wait for before rebuilding
+    poll_interval: Seconds between checks when polling is used instead of inotify
+    use_inotify: Whether to use inotify. By default it is used if available
+    max_workers: Passed to ensure_all
+    """
+
+    def __init__(
+        self,
+        images: Iterable["DockerImage"],
+        debounce: float = 0.5,
+        poll_interval: float = 1.0,
+        use_inotify: Optional[bool] = None,
+        max_workers: int = 4,
+    ):
+        self.images = list(ImageGraph(images))
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.max_workers = max_workers
+
+        cache = DigestCache(":memory:")
+        for image in self.images:
+            if image.build_config and image.build_config.digest_cache is None:
+                image.build_config.digest_cache = cache
+
+    def inputs(self) -> List[Tuple["DockerImage", str, IgnoreMatcher, str]]:
+        """Returns (image, context directory, matcher, Dockerfile path) for every image with a build config"""
+
+        inputs = []
+        for image in self.images:
+            config = image.build_config
+            if config is None:
+                continue
+            root = os.path.abspath(config.directory or ".")
+            dockerfile = os.path.abspath(config.get_relative(config.dockerfile))
+            inputs.append(
+                (image, root, IgnoreMatcher(config.docker_ignore_lines()), dockerfile)
+            )
+        return inputs
+
+    def affected(self, paths: Iterable[str]) -> List["DockerImage"]:
+        """Returns the images that depend on any of the given paths"""
+
+        affected = {}
+        inputs = self.inputs()
+        for path in paths:
+            path = os.path.abspath(path)
+            for image, root, matcher, dockerfile in inputs:
+                if id(image) in affected:
+                    continue
+                if path == dockerfile:
+                    affected[id(image)] = image
+                    continue
+                relative = os.path.relpath(path, root).replace(os.sep, "/")
+                if relative.startswith("../") or relative in (
+                    "..",
+                    ".",
+                    ".dockerignore",
+                ):
+                    continue
+                if not matcher.is_excluded(relative):
+                    affected[id(image)] = image
+        return list(affected.values())
+
+    def directories(self) -> Set[str]:
+        """Returns the directories to watch: the parts of each context that aren't ignored"""
+
+        directories = set()
+        for _, root, matcher, dockerfile in self.inputs():
+            directories.add(os.path.dirname(dockerfile))
+            for path, names, _ in os.walk(root):
+                directories.add(path)
+                relative = os.path.relpath(path, root).replace(os.sep, "/")
+                prefix = "" if relative == "." else relative + "/"
+                names[:] = [
+                    name
+                    for name in names
+                    if not (
+                        matcher.is_excluded(prefix + name)
+                        and matcher.can_prune(prefix + name)
+                    )
+                ]
+        return directories
+
+    def snapshot(self) -> Dict[str, tuple]:
+        """Returns the metadata of every input file, for polling"""
+
+        snapshot = {}
+        for image, root, _, dockerfile in self.inputs():
+            paths = [dockerfile] + [
+                path
+                for _, path in walk_context(
+                    root, image.build_config.docker_ignore_lines()
+                )
+            ]
+            for path in paths:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        return snapshot
+
+    def watcher(self):
+        if self.use_inotify is not False:
+            try:
+                return InotifyWatcher(self.directories())
+            except (OSError, AttributeError, TypeError):
+                if self.use_inotify:
+                    raise
+        return PollingWatcher(self.snapshot, self.poll_interval)
+
+    def rebuild(self, changed: Iterable[str]) -> List["DockerImage"]:
+        """
+        Ensures the images affected by the changed paths again, along with their dependents.
+        Returns the images that were ensured.
+        """
+
+        affected = self.affected(changed)
+        if not affected:
+            return []
+
+        graph = ImageGraph(self.images)
+        refs = set()
+        for image in affected:
+            refs.add(image.ref)
+            refs |= graph.downstream(image.ref)
+        images = [graph.nodes[ref] for ref in graph.order if ref in refs]
+
+        for image in images:
+            image.invalidate()
+
+        report.message(
+            None, f"Changes detected, ensuring {', '.join(i.name for i in images)}"
+        )
+        ensure_all(images, max_workers=self.max_workers)
+        return images
+
+    def run(self, stop: Optional[threading.Event] = None):
+        """
+        Ensures the images, then watches their inputs and keeps them up to date until stop is set
+        (or forever). Failures are reported and watching carries on.
+        """
+
+        stop = stop or threading.Event()
+        try:
+            ensure_all(self.images, max_workers=self.max_workers)
+        except ImageGraph.EnsureFailedException as e:
+            report.message(None, str(e))
+
+        watcher = self.watcher()
+        try:
+            while not stop.is_set():
+                changed = watcher.wait(min(self.poll_interval, 0.5))
+                if not changed:
+                    continue
+
+                while not stop.is_set():
+                    more = watcher.wait(self.debounce)
+                    if not more:
+                        break
+                    changed |= more
+
+                try:
+                    self.rebuild(changed)
+                except Exception as e:
+                    report.message(None, f"Failed to ensure images: {e}")
+
+                if isinstance(watcher, InotifyWatcher):
+                    for directory in self.directories():
+                        watcher.add(directory)
+        finally:
+            watcher.close()
+
+
+def watch(images, **kwargs):
+    """Ensures the images and keeps them up to date as their inputs change. See Watch"""
+    Watch(images, **kwargs).run()
@@ -0,0 +1,281 @@
+"""
+Offline benchmarks for dockerensure. No Docker daemon or network is needed: builds go to an in-process
+fake engine, or to the scripted fake docker executable next to this file to include the cost of the CLI.
+
+Usage:
+python tests/benchmarks/bench.py                    Run everything and print the results
+python tests/benchmarks/bench.py -k hash            Only run benchmarks with "hash" in their name
+python tests/benchmarks/bench.py --save main        Save the results as the baseline "main"
+python tests/benchmarks/bench.py --compare main     Compare the results against the baseline "main"
+
+Baselines are stored as JSON in tests/benchmarks/baselines. Each benchmark is run several times and the
+best time is kept, as it is the least affected by noise.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from dockerensure import BuildConfig, DockerImage, ensure_all, report  # noqa: E402
+from dockerensure.digestcache import DigestCache  # noqa: E402
+from dockerensure.engine import CLIEngine, Engine, set_engine  # noqa: E402
+from dockerensure.filepolicy import FilePolicy  # noqa: E402
+from dockerensure.hasher import Hasher  # noqa: E402
+from dockerensure.utils import normalize_reference  # noqa: E402
+
+BENCH_DIR = Path(__file__).resolve().parent
+BASELINE_DIR = BENCH_DIR / "baselines"
+
+benchmarks = {}
+
+
+def benchmark(function):
+    benchmarks[function.__name__] = function
+    return function
+
+
+class BenchEngine(Engine):
+    """In-process fake engine. latency simulates the round trip of each call to the daemon"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.images = set()
+        self.calls = 0
+
+    def _call(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def image_exists(self, reference):
+        self._call()
+        return normalize_reference(reference) in self.images
+
+    def list_images(self):
+        self._call()
+        return {image: "sha256:0" for image in self.images}
+
+    def pull(self, reference):
+        self._call()
+        raise Exception("Not found")
+
+    def push(self, reference):
+        self._call()
+
+    def tag(self, source, target):
+        self._call()
+
+    def login(self, server, username, password):
+        self._call()
+
+    def build(
+        self,
+        name,
+        directory,
+        dockerfile,
+        build_args,
+        context=None,
+        cache_from=(),
+        cache_to=None,
+    ):
+        self._call()
+        self.images.add(normalize_reference(name))
+
+
+def write_files(directory, count, size):
+    data = os.urandom(size)
+    for i in range(count):
+        path = directory / f"d{i % 50}" / f"f{i}"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+
+def chain(depth, directory):
+    images = []
+    for i in range(depth):
+        parents = images[-1:]
+        images.append(
+            DockerImage(
+                f"chain{i}",
+                BuildConfig(
+                    files=FilePolicy.Nothing, directory=directory, parents=parents
+                ),
+            )
+        )
+    return images
+
+
+def fan(width, directory):
+    base = DockerImage(
+        "base", BuildConfig(files=FilePolicy.Nothing, directory=directory)
+    )
+    return [
+        DockerImage(
+            f"leaf{i}",
+            BuildConfig(files=FilePolicy.Nothing, directory=directory, parents=[base]),
+        )
+        for i in range(width)
+    ]
+
+
+@benchmark
+def hash_large_file(tmp):
+    path = tmp / "large"
+    path.write_bytes(os.urandom(1024 * 1024) * 128)
+
+    start = time.perf_counter()
+    Hasher().add_file(path)
+    return time.perf_counter() - start
+
+
+@benchmark
+def hash_many_small_files(tmp):
+    write_files(tmp, 5000, 1024)
+    paths = sorted(tmp.rglob("f*"))
+
+    start = time.perf_counter()
+    Hasher().add_files(paths)
+    return time.perf_counter() - start
+
+
+@benchmark
+def get_hash_big_context(tmp):
+    write_files(tmp, 20000, 512)
+    (tmp / "Dockerfile").write_text("FROM scratch")
+
+    start = time.perf_counter()
+    BuildConfig(directory=tmp).get_hash()
+    return time.perf_counter() - start
+
+
+@benchmark
+def get_hash_big_context_cached(tmp):
+    context = tmp / "context"
+    write_files(context, 20000, 512)
+    (context / "Dockerfile").write_text("FROM scratch")
+    cache = DigestCache(tmp / "cache.sqlite")
+    BuildConfig(directory=context, digest_cache=cache).get_hash()
+
+    start = time.perf_counter()
+    BuildConfig(directory=context, digest_cache=cache).get_hash()
+    return time.perf_counter() - start
+
+
+def ensure_graph(tmp, images, engine, parallel=False):
+    (tmp / "Dockerfile").write_text("FROM scratch")
+    set_engine(engine)
+    try:
+        start = time.perf_counter()
+        if parallel:
+            ensure_all(images, max_workers=8)
+        else:
+            for image in images:
+                image.ensure()
+        return time.perf_counter() - start
+    finally:
+        set_engine(CLIEngine())
+
+
+@benchmark
+def ensure_deep_graph(tmp):
+    return ensure_graph(tmp, chain(50, tmp)[-1:], BenchEngine(latency=0.001))
+
+
+@benchmark
+def ensure_wide_graph(tmp):
+    return ensure_graph(tmp, fan(100, tmp), BenchEngine(latency=0.001))
+
+
+@benchmark
+def ensure_wide_graph_parallel(tmp):
+    return ensure_graph(tmp, fan(100, tmp), BenchEngine(latency=0.001), True)
+
+
+@benchmark
+def ensure_warm_graph_cli(tmp):
+    images = fan(20, tmp)
+    state = tmp / "state.json"
+    local = [normalize_reference(i.ref) for i in images] + ["base:latest"]
+    state.write_text(json.dumps({"local": local, "remote": []}))
+
+    bin_dir = tmp / "bin"
+    bin_dir.mkdir()
+    os.symlink(BENCH_DIR / "fake_docker", bin_dir / "docker")
+    environ = dict(os.environ)
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+    os.environ["FAKE_DOCKER_STATE"] = str(state)
+    try:
+        return ensure_graph(tmp, images, CLIEngine())
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+
+
+def run(names, repeat):
+    report.remove_listener(report.print_messages)
+    results = {}
+    try:
+        for name in names:
+            times = []
+            for _ in range(repeat):
+                with tempfile.TemporaryDirectory() as tmp:
+                    times.append(benchmarks[name](Path(tmp)))
+            results[name] = min(times)
+            print(f"{name:32} {results[name] * 1000:10.2f} ms", flush=True)
+    finally:
+        report.add_listener(report.print_messages)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            cwd=BENCH_DIR,
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(results, baseline_name):
+    baseline = json.loads((BASELINE_DIR / f"{baseline_name}.json").read_text())
+    print(f"\nCompared with {baseline_name} ({baseline.get('commit')}):")
+    for name, seconds in results.items():
+        if name not in baseline["results"]:
+            continue
+        ratio = seconds / baseline["results"][name]
+        print(f"{name:32} {ratio:9.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the dockerensure benchmarks")
+    parser.add_argument("-k", help="Only run benchmarks containing this string")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", metavar="NAME", help="Save results as a baseline")
+    parser.add_argument("--compare", metavar="NAME", help="Compare with a baseline")
+    args = parser.parse_args()
+
+    names = [name for name in benchmarks if not args.k or args.k in name]
+    results = run(names, args.repeat)
+
+    if args.save:
+        BASELINE_DIR.mkdir(exist_ok=True)
+        data = {"commit": git_commit(), "time": time.time(), "results": results}
+        (BASELINE_DIR / f"{args.save}.json").write_text(json.dumps(data, indent=2))
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
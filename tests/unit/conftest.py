@@ -0,0 +1,265 @@
+import json
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from dockerensure.engine import CLIEngine, Engine, set_engine
+from dockerensure.sessions import reset_sessions
+from dockerensure.utils import normalize_reference
+
+
+class FakeDaemonHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.daemon.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunk = self.rfile.read(size + 2)[:size]
+                if not size:
+                    return body
+                body += chunk
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def respond(self):
+        url = urlparse(self.path)
+        path = url.path.split("/", 2)[2]
+        request = {
+            "method": self.command,
+            "path": "/" + path,
+            "params": {k: v[0] for k, v in parse_qs(url.query).items()},
+            "headers": dict(self.headers),
+            "body": self.read_body(),
+        }
+        self.server.daemon.requests.append(request)
+
+        status, body = self.server.daemon.route(request)
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_HEAD = do_DELETE = respond
+
+
+class FakeDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    A stand-in for the Docker daemon listening on a unix socket.
+    Responses are looked up in routes by (method, path), anything else gets a 404.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path):
+        super().__init__(str(path), FakeDaemonHandler)
+        self.daemon = self
+        self.path = str(path)
+        self.routes = {}
+        self.requests = []
+        self.connections = 0
+
+    def route(self, request):
+        response = self.routes.get((request["method"], request["path"]))
+        if callable(response):
+            return response(request)
+        return response or (404, {"message": "not found"})
+
+
+@pytest.fixture
+def fake_daemon(tmp_path):
+    server = FakeDaemon(tmp_path / "docker.sock")
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    )
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class FakeEngine(Engine):
+    """
+    An in-process stand-in for the Docker daemon. images maps normalized references to image IDs,
+    and every call is recorded in calls.
+    """
+
+    def __init__(self, images=()):
+        self.images = {
+            normalize_reference(image): f"sha256:{image}" for image in images
+        }
+        self.sizes = {}
+        self.calls = []
+
+    def image_exists(self, reference):
+        self.calls.append(("image_exists", reference))
+        return normalize_reference(reference) in self.images
+
+    def list_images(self):
+        self.calls.append(("list_images",))
+        return dict(self.images)
+
+    def image_id(self, reference):
+        self.calls.append(("image_id", reference))
+        return self.images.get(normalize_reference(reference))
+
+    def pull(self, reference):
+        self.calls.append(("pull", reference))
+        raise Exception(f"{reference} not found")
+
+    def push(self, reference):
+        self.calls.append(("push", reference))
+
+    def tag(self, source, target):
+        self.calls.append(("tag", source, target))
+        self.images[normalize_reference(target)] = self.images[
+            normalize_reference(source)
+        ]
+
+    def remove_image(self, reference):
+        self.calls.append(("remove_image", reference))
+        del self.images[normalize_reference(reference)]
+
+    def image_size(self, reference):
+        self.calls.append(("image_size", reference))
+        if normalize_reference(reference) not in self.images:
+            return None
+        return self.sizes.get(normalize_reference(reference), 0)
+
+    def save(self, reference, file):
+        self.calls.append(("save", reference))
+        reference = normalize_reference(reference)
+        file.write(json.dumps({reference: self.images[reference]}).encode("utf-8"))
+
+    def load(self, file):
+        self.calls.append(("load",))
+        self.images.update(json.loads(file.read()))
+
+    def login(self, server, username, password):
+        self.calls.append(("login", server, username))
+
+    def set_credentials(self, server, username, password):
+        self.calls.append(("set_credentials", server, username))
+
+    def build(
+        self,
+        name,
+        directory,
+        dockerfile,
+        build_args,
+        context=None,
+        cache_from=(),
+        cache_to=None,
+    ):
+        self.calls.append(("build", name))
+        self.images[normalize_reference(name)] = f"sha256:{name}"
+
+
+@pytest.fixture(autouse=True)
+def registry_sessions(tmp_path_factory, monkeypatch):
+    """Gives every test its own registry sessions, and a docker config that has no credentials"""
+    monkeypatch.setenv("DOCKER_CONFIG", str(tmp_path_factory.mktemp("docker-config")))
+    yield
+    reset_sessions()
+
+
+@pytest.fixture
+def fake_engine():
+    engine = FakeEngine()
+    set_engine(engine)
+    yield engine
+    set_engine(CLIEngine())
+
+
+class FakeRegistryHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def respond(self):
+        registry = self.server
+        url = urlparse(self.path)
+        registry.requests.append((self.command, url.path))
+
+        if url.path == "/token":
+            registry.token_requests += 1
+            return self.send(200, json.dumps({"token": "secret"}).encode("utf-8"))
+
+        if self.headers.get("Authorization") != "Bearer secret":
+            realm = f"http://127.0.0.1:{registry.server_port}/token"
+            return self.send(
+                401,
+                headers={"WWW-Authenticate": f'Bearer realm="{realm}",service="fake"'},
+            )
+
+        path = url.path[len("/v2/") :]
+        if path.endswith("/tags/list"):
+            repository = path[: -len("/tags/list")]
+            if repository not in registry.images:
+                return self.send(404)
+            body = {"name": repository, "tags": sorted(registry.images[repository])}
+            return self.send(200, json.dumps(body).encode("utf-8"))
+
+        repository, _, tag = path.partition("/manifests/")
+        if tag in registry.images.get(repository, ()):
+            return self.send(200)
+        return self.send(404)
+
+    do_GET = do_HEAD = respond
+
+
+class FakeRegistry(ThreadingHTTPServer):
+    """
+    A stand-in for a registry implementing manifest HEAD and tag listing behind token authentication.
+    images maps repository -> set of tags.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeRegistryHandler)
+        self.host = f"127.0.0.1:{self.server_port}"
+        self.images = {}
+        self.requests = []
+        self.connections = 0
+        self.token_requests = 0
+
+
+@pytest.fixture
+def fake_registry():
+    server = FakeRegistry()
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    )
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,42 @@
+from unittest.mock import patch
+
+from dockerensure.absentcache import AbsentCache
+
+
+def test_absent():
+    cache = AbsentCache()
+    cache.add("registry", "test:1.0")
+
+    assert cache.is_absent("registry", "test:1.0")
+    assert not cache.is_absent("registry", "test:2.0")
+    assert not cache.is_absent("other", "test:1.0")
+
+
+def test_expires():
+    cache = AbsentCache(ttl=10)
+    with patch("time.time", return_value=1000):
+        cache.add("registry", "test:1.0")
+
+    with patch("time.time", return_value=1009):
+        assert cache.is_absent("registry", "test:1.0")
+    with patch("time.time", return_value=1010):
+        assert not cache.is_absent("registry", "test:1.0")
+
+
+def test_discard(tmp_path):
+    cache = AbsentCache(path=tmp_path / "absent.sqlite")
+    cache.add("registry", "test:1.0")
+    cache.discard("registry", "test:1.0")
+
+    assert not cache.is_absent("registry", "test:1.0")
+    assert not AbsentCache(path=tmp_path / "absent.sqlite").is_absent(
+        "registry", "test:1.0"
+    )
+
+
+def test_persisted(tmp_path):
+    AbsentCache(path=tmp_path / "absent.sqlite").add("registry", "test:1.0")
+
+    assert AbsentCache(path=tmp_path / "absent.sqlite").is_absent(
+        "registry", "test:1.0"
+    )
@@ -1,10 +1,14 @@
+import io
+import tarfile
 from datetime import timedelta
 from unittest.mock import Mock, mock_open, patch
 
 import pytest
 
 from dockerensure.buildconfig import BuildConfig, IntervalOffset
+from dockerensure.digestcache import DigestCache
 from dockerensure.filepolicy import FilePolicy
+from dockerensure.image import DockerImage
 
 
 @pytest.mark.parametrize(
@@ -27,7 +31,7 @@ def test_ignore_file(policy, output):
 @patch.object(BuildConfig, "create_docker_ignore_file", Mock())
 @patch("subprocess.run", Mock())
 def test_parents_ensured():
-    parent = Mock()
+    parent = Mock(build_config=None)
     BuildConfig(".", parents=[parent]).build_image("test")
 
     parent.ensure.assert_called_once()
@@ -46,8 +50,64 @@ def test_build_args(mock_run):
     )
 
 
-def test_unhashable():
-    assert BuildConfig(files=FilePolicy.All).is_hashable() is False
+@pytest.mark.parametrize(
+    "policy", [FilePolicy.All, FilePolicy.AllBut(["this"]), FilePolicy.Nothing]
+)
+def test_hashable(policy):
+    assert BuildConfig(files=policy).is_hashable() is True
+
+
+@pytest.fixture
+def context(tmp_path):
+    (tmp_path / "Dockerfile").write_text("FROM alpine")
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "main.py").write_text("print()")
+    (tmp_path / "data.txt").write_text("data")
+    return tmp_path
+
+
+@pytest.mark.parametrize(
+    "policy,changed,differs",
+    [
+        (FilePolicy.All, "data.txt", True),
+        (FilePolicy.AllBut(["data.txt"]), "data.txt", False),
+        (FilePolicy.AllBut(["data.txt"]), "src/main.py", True),
+        (FilePolicy.Only(["src"]), "src/main.py", True),
+        (FilePolicy.Only(["src"]), "data.txt", False),
+        (FilePolicy.Only(["*.txt"]), "data.txt", True),
+        (FilePolicy.Only(["*.txt"]), "src/main.py", False),
+    ],
+)
+def test_context_hash(context, policy, changed, differs):
+    config = BuildConfig(directory=context, files=policy)
+    before = config.get_hash()
+
+    (context / changed).write_text("changed")
+
+    assert (config.get_hash() != before) is differs
+
+
+def test_context_hash_ignores_dockerignore(context):
+    config = BuildConfig(directory=context, files=FilePolicy.All)
+    before = config.get_hash()
+
+    config.create_docker_ignore_file()
+
+    assert config.get_hash() == before
+
+
+def test_context_hash_cached(context):
+    cache = DigestCache(context / "cache" / "cache.sqlite")
+    config = BuildConfig(
+        directory=context, files=FilePolicy.AllBut(["cache"]), digest_cache=cache
+    )
+    expected = BuildConfig(directory=context, files=FilePolicy.AllBut(["cache"]))
+
+    assert config.get_hash() == expected.get_hash()
+
+    with patch("dockerensure.digestcache.file_digest") as mock_digest:
+        assert config.get_hash() == expected.get_hash()
+        mock_digest.assert_not_called()
 
 
 @patch("dockerensure.buildconfig.Hasher.add_file", Mock())
@@ -84,3 +144,112 @@ def test_unhashed_args_used(mock_run):
     ).build_image("test")
 
     assert "Test=Hi" in mock_run.call_args.args[0]
+
+
+def test_digest_cache(tmp_path):
+    dockerfile = tmp_path / "Dockerfile"
+    dockerfile.write_text("FROM alpine")
+    (tmp_path / "file").write_text("test")
+
+    def config(**kwargs):
+        return BuildConfig(
+            directory=tmp_path, files=FilePolicy.Only(["file"]), **kwargs
+        )
+
+    cache = DigestCache(tmp_path / "cache.sqlite")
+    expected = config().get_hash()
+
+    assert config(digest_cache=cache).get_hash() == expected
+
+    with patch("dockerensure.buildconfig.Hasher.add_files") as mock_add:
+        assert config(digest_cache=cache).get_hash() == expected
+        mock_add.assert_not_called()
+
+    (tmp_path / "file").write_text("changed")
+    assert config(digest_cache=cache).get_hash() == config().get_hash() != expected
+
+
+def test_stream_context(context, fake_engine):
+    config = BuildConfig(
+        directory=context, files=FilePolicy.Only(["src"]), stream_context=True
+    )
+    with patch.object(fake_engine, "build") as mock_build:
+        config.build_image("test")
+
+    assert not (context / ".dockerignore").exists()
+
+    output = io.BytesIO()
+    mock_build.call_args.kwargs["context"](output)
+    with tarfile.open(fileobj=io.BytesIO(output.getvalue())) as tar:
+        names = sorted(tar.getnames())
+    assert names == [".dockerignore", "Dockerfile", "src/main.py"]
+
+
+@pytest.fixture
+def multistage(tmp_path):
+    (tmp_path / "Dockerfile").write_text(
+        "ARG BASE\n"
+        "FROM $BASE AS build\n"
+        "FROM node:18 AS assets\n"
+        "FROM python:3.12-slim\n"
+        "COPY --from=build /app /app\n"
+    )
+    return tmp_path
+
+
+def test_link_parents(multistage):
+    base = DockerImage("base", version="1.0")
+    other = DockerImage("other")
+
+    config = BuildConfig(
+        directory=multistage,
+        build_args={"BASE": base.ref},
+        known_images=[other, base],
+    )
+
+    assert config.parents == [base]
+    assert config.external_bases() == ["node:18", "python:3.12-slim"]
+
+
+def test_prefetch(fake_engine, multistage):
+    fake_engine.images = {"node:18": "sha256:1"}
+    base = DockerImage("base")
+    config = BuildConfig(
+        files=FilePolicy.Nothing,
+        directory=multistage,
+        build_args={"BASE": "base"},
+        parents=[base],
+        prefetch_bases=True,
+    )
+
+    with patch.object(BuildConfig, "create_docker_ignore_file"):
+        config.build_image("test", ensure_parents=False)
+
+    pulls = [call for call in fake_engine.calls if call[0] in ("pull", "build")]
+    assert pulls == [("pull", "python:3.12-slim"), ("build", "test")]
+
+
+def test_files_from_dockerfile(tmp_path):
+    (tmp_path / "Dockerfile").write_text(
+        "FROM python\nCOPY app.py /app/\nCOPY src /app/src\n"
+    )
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "lib.py").write_text("1")
+    (tmp_path / "app.py").write_text("1")
+    (tmp_path / "README.md").write_text("1")
+    config = BuildConfig(directory=tmp_path, files=FilePolicy.FromDockerfile)
+
+    assert config.docker_ignore_lines() == ["**", "!app.py", "!src"]
+
+    digest = config.get_hash()
+    (tmp_path / "README.md").write_text("2")
+    assert config.get_hash() == digest
+    (tmp_path / "src" / "lib.py").write_text("2")
+    assert config.get_hash() != digest
+
+
+def test_files_from_dockerfile_whole_context(tmp_path):
+    (tmp_path / "Dockerfile").write_text("FROM python\nCOPY . /app\n")
+    config = BuildConfig(directory=tmp_path, files=FilePolicy.FromDockerfile)
+
+    assert config.file_policy() == FilePolicy.All
@@ -0,0 +1,138 @@
+import io
+import os
+import tarfile
+from unittest.mock import patch
+
+import pytest
+
+from dockerensure.context import (
+    ContextStream,
+    IgnoreMatcher,
+    context_digest,
+    tree_digest,
+    walk_context,
+    write_context_tar,
+)
+
+
+@pytest.mark.parametrize(
+    "lines,path,excluded",
+    [
+        ([], "file", False),
+        (["file"], "file", True),
+        (["/file"], "file", True),
+        (["file"], "dir/file", False),
+        (["dir"], "dir/sub/file", True),
+        (["*.txt"], "a.txt", True),
+        (["*.txt"], "dir/a.txt", False),
+        (["**/*.txt"], "dir/sub/a.txt", True),
+        (["**/*.txt"], "a.txt", True),
+        (["dir/**"], "dir/sub/a", True),
+        (["a?c"], "abc", True),
+        (["a[xy]c"], "ayc", True),
+        (["a[^xy]c"], "ayc", False),
+        (["**", "!src"], "src/main.py", False),
+        (["**", "!src"], "other/main.py", True),
+        (["**", "!src", "src/tmp"], "src/tmp/x", True),
+        (["# comment"], "# comment", False),
+    ],
+)
+def test_matcher(lines, path, excluded):
+    assert IgnoreMatcher(lines).is_excluded(path) is excluded
+
+
+@pytest.fixture
+def context(tmp_path):
+    for path in ["Dockerfile", "a/one", "a/two.py", "b/c/three.py", ".dockerignore"]:
+        path = tmp_path / path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(str(path))
+    return tmp_path
+
+
+def files(context, lines):
+    return [relative for relative, _ in walk_context(context, lines)]
+
+
+def test_walk(context):
+    assert files(context, []) == ["Dockerfile", "a/one", "a/two.py", "b/c/three.py"]
+
+
+def test_walk_exclusions(context):
+    assert files(context, ["**", "!**/*.py"]) == ["a/two.py", "b/c/three.py"]
+    assert files(context, ["**", "!b"]) == ["b/c/three.py"]
+    assert files(context, ["a", "Dockerfile"]) == ["b/c/three.py"]
+
+
+def test_walk_prunes(context):
+    scanned = []
+    real_scandir = os.scandir
+
+    def scandir(path):
+        scanned.append(os.path.relpath(path, context))
+        return real_scandir(path)
+
+    with patch("os.scandir", scandir):
+        assert files(context, ["**", "!a"]) == ["a/one", "a/two.py"]
+
+    assert "b" not in scanned
+
+
+def test_tree_digest():
+    digest = tree_digest({"a/b": "1", "c": "2"})
+
+    assert digest == tree_digest({"c": "2", "a/b": "1"})
+    assert digest != tree_digest({"a/b": "1", "c": "3"})
+    assert digest != tree_digest({"b/b": "1", "c": "2"})
+
+
+def test_context_digest(context):
+    before = context_digest(context, [])
+    assert context_digest(context, []) == before
+
+    (context / "a" / "one").write_text("changed")
+    assert context_digest(context, []) != before
+
+
+def test_context_digest_mode(context):
+    before = context_digest(context, [])
+
+    os.chmod(context / "a" / "one", 0o755)
+    assert context_digest(context, []) != before
+
+
+def read_tar(data):
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        return {
+            member.name: tar.extractfile(member).read()
+            for member in tar.getmembers()
+            if member.isfile()
+        }
+
+
+def test_context_tar(context):
+    output = io.BytesIO()
+    write_context_tar(context, ["**", "!a"], "Dockerfile", output)
+
+    files = read_tar(output.getvalue())
+    assert sorted(files) == [".dockerignore", "Dockerfile", "a/one", "a/two.py"]
+    assert files[".dockerignore"] == b"**\n!a"
+    assert files["a/one"] == str(context / "a" / "one").encode()
+
+
+def test_context_stream(context):
+    with ContextStream(
+        lambda f: write_context_tar(context, [], "Dockerfile", f)
+    ) as stream:
+        data = b"".join(stream.chunks())
+
+    assert "b/c/three.py" in read_tar(data)
+
+
+def test_context_stream_error(context):
+    def fail(f):
+        raise ValueError("Bad")
+
+    with pytest.raises(ValueError):
+        with ContextStream(fail) as stream:
+            stream.reader.read()
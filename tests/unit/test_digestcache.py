@@ -0,0 +1,56 @@
+import os
+
+from dockerensure.digestcache import DigestCache, StatHasher, stat_key
+
+
+def test_get_put(tmp_path):
+    cache = DigestCache(tmp_path / "cache.sqlite")
+
+    assert cache.get("key") is None
+    cache.put("key", "abc")
+    assert cache.get("key") == "abc"
+
+
+def test_persistent(tmp_path):
+    DigestCache(tmp_path / "cache.sqlite").put("key", "abc")
+
+    assert DigestCache(tmp_path / "cache.sqlite").get("key") == "abc"
+
+
+def test_eviction(tmp_path):
+    cache = DigestCache(tmp_path / "cache.sqlite", max_entries=2)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    cache.get("a")
+    cache.put("c", "3")
+
+    assert len(cache) == 2
+    assert cache.get("a") == "1"
+    assert cache.get("b") is None
+    assert cache.get("c") == "3"
+
+
+def test_stat_key(tmp_path):
+    path = tmp_path / "file"
+    path.write_text("test")
+    before = stat_key(path)
+
+    assert stat_key(path) == before
+
+    path.write_text("longer")
+    assert stat_key(path) != before
+
+
+def test_stat_hasher_mtime(tmp_path):
+    path = tmp_path / "file"
+    path.write_text("test")
+
+    def key():
+        hasher = StatHasher()
+        hasher.add_files([path])
+        return hasher.hexdigest()
+
+    before = key()
+    os.utime(path, ns=(0, 0))
+
+    assert key() != before
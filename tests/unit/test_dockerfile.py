@@ -0,0 +1,128 @@
+import pytest
+
+from dockerensure.dockerfile import Dockerfile, parse_instructions, substitute
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        ("$A", "1"),
+        ("${A}-x", "1-x"),
+        ("${MISSING}", ""),
+        ("${MISSING:-default}", "default"),
+        ("${A:-default}", "1"),
+        ("${A:+set}", "set"),
+        ("${MISSING:+set}", ""),
+        ("plain", "plain"),
+    ],
+)
+def test_substitute(value, expected):
+    assert substitute(value, {"A": "1"}) == expected
+
+
+def test_parse_instructions():
+    instructions = parse_instructions(
+        "# syntax=docker/dockerfile:1\n"
+        "ARG BASE=python\n"
+        "FROM --platform=linux/amd64 $BASE AS build\n"
+        "RUN apt-get update && \\\n"
+        "    # A comment inside a continuation\n"
+        "    apt-get install -y git\n"
+        "\n"
+        "from scratch\n"
+        "copy --from=build /app /app\n"
+    )
+
+    assert [(i.keyword, i.stage) for i in instructions] == [
+        ("ARG", -1),
+        ("FROM", 0),
+        ("RUN", 0),
+        ("FROM", 1),
+        ("COPY", 1),
+    ]
+    assert instructions[1].flags == {"platform": "linux/amd64"}
+    assert instructions[1].value == "$BASE AS build"
+    assert instructions[2].value == "apt-get update &&  apt-get install -y git"
+    assert instructions[4].flags == {"from": "build"}
+
+
+def test_base_images():
+    dockerfile = Dockerfile(
+        "ARG REGISTRY=docker.io\n"
+        "ARG VERSION\n"
+        "ARG IMAGE=$REGISTRY/python:${VERSION:-3.10}\n"
+        "FROM $IMAGE AS Builder\n"
+        "FROM builder AS test\n"
+        "FROM node:18\n"
+        "FROM scratch\n"
+        "FROM $IMAGE\n"
+    )
+
+    assert dockerfile.base_images() == ["docker.io/python:3.10", "node:18"]
+    assert dockerfile.stage_names() == {"builder", "test"}
+
+
+def test_build_args_override_defaults():
+    dockerfile = Dockerfile(
+        "ARG VERSION=3.10\nFROM python:$VERSION\n", build_args={"VERSION": "3.12"}
+    )
+
+    assert dockerfile.base_images() == ["python:3.12"]
+
+
+def test_copy_sources():
+    dockerfile = Dockerfile(
+        "FROM python AS build\n"
+        "ARG SRC=src\n"
+        "ENV APP=/app\n"
+        "COPY --from=builder /out /out\n"
+        "COPY --chown=app $SRC/ ${APP}/\n"
+        "ADD https://example.com/archive.tgz /tmp/\n"
+        'COPY ["requirements.txt", "./setup.py", "/app/"]\n'
+        "COPY *.cfg ./\n"
+        "FROM python\n"
+        "COPY --from=build /app /app\n"
+        "COPY ./setup.py /app/\n",
+        build_args={"SRC": "lib"},
+    )
+
+    assert dockerfile.copy_sources() == [
+        "lib",
+        "requirements.txt",
+        "setup.py",
+        "*.cfg",
+    ]
+
+
+def test_copy_whole_context():
+    assert Dockerfile("FROM python\nCOPY . /app\n").copy_sources() is None
+
+
+def test_heredocs_skipped():
+    dockerfile = Dockerfile(
+        "FROM python:3.11\n"
+        "RUN <<EOF python3\n"
+        "from pathlib import Path\n"
+        "# Not a comment\n"
+        "EOF\n"
+        "COPY <<-'CONFIG' <<SCRIPT /etc/app/\n"
+        "\tfrom config\n"
+        "\tCONFIG\n"
+        "ADD setup.py /app/\n"
+        "SCRIPT\n"
+        "RUN echo $((1<<2))\n"
+        "FROM node:18\n"
+        "COPY src /app/\n"
+    )
+
+    assert [i.keyword for i in dockerfile.instructions] == [
+        "FROM",
+        "RUN",
+        "COPY",
+        "RUN",
+        "FROM",
+        "COPY",
+    ]
+    assert dockerfile.base_images() == ["python:3.11", "node:18"]
+    assert len(dockerfile.stages) == 2
+    assert dockerfile.copy_sources() == ["src"]
@@ -0,0 +1,323 @@
+import asyncio
+import base64
+import http.client
+import io
+import json
+import subprocess
+from unittest.mock import AsyncMock, Mock, patch
+
+import pytest
+
+from dockerensure import report
+from dockerensure.engine import CLIEngine, SocketEngine, get_engine, set_engine
+
+
+@pytest.fixture
+def engine(fake_daemon):
+    engine = SocketEngine(fake_daemon.path)
+    yield engine
+    engine.close()
+
+
+def test_default_engine():
+    assert isinstance(get_engine(), CLIEngine)
+
+
+def test_set_engine():
+    engine = SocketEngine("/missing.sock")
+    set_engine(engine)
+    try:
+        assert get_engine() is engine
+    finally:
+        set_engine(CLIEngine())
+
+
+@patch("subprocess.run")
+def test_cli_exists(mock_run):
+    mock_run.return_value.returncode = 1
+
+    assert CLIEngine().image_exists("test") is False
+    assert " ".join(mock_run.call_args.args[0]) == "docker image inspect test"
+
+
+def test_image_exists(fake_daemon, engine):
+    fake_daemon.routes[("GET", "/images/test:1.0/json")] = (200, {"Id": "sha256:1"})
+
+    assert engine.image_exists("test:1.0") is True
+    assert engine.image_exists("other") is False
+
+
+def test_image_id(fake_daemon, engine):
+    fake_daemon.routes[("GET", "/images/test:1.0/json")] = (200, {"Id": "sha256:1"})
+
+    assert engine.image_id("test:1.0") == "sha256:1"
+    assert engine.image_id("other") is None
+
+
+def test_remove_image(fake_daemon, engine):
+    fake_daemon.routes[("DELETE", "/images/test:1.0")] = (200, [])
+    fake_daemon.routes[("GET", "/images/test:2.0/json")] = (200, {"Size": 1234})
+
+    engine.remove_image("test:1.0")
+    assert fake_daemon.requests[-1]["method"] == "DELETE"
+    assert engine.image_size("test:2.0") == 1234
+    assert engine.image_size("other") is None
+
+
+def test_docker_host(monkeypatch):
+    monkeypatch.setenv("DOCKER_HOST", "unix:///run/user/docker.sock")
+    assert SocketEngine().socket_path == "/run/user/docker.sock"
+
+    monkeypatch.setenv("DOCKER_HOST", "tcp://docker:2375")
+    with pytest.raises(SocketEngine.UnsupportedHostException):
+        SocketEngine()
+
+
+def test_connection_reused(fake_daemon, engine):
+    fake_daemon.routes[("GET", "/images/test/json")] = (200, {})
+
+    for _ in range(5):
+        engine.image_exists("test")
+
+    assert fake_daemon.connections == 1
+
+
+def test_streamed_body_not_retried(fake_daemon, engine):
+    fake_daemon.routes[("POST", "/images/load")] = (200, b'{"stream": "Loaded"}\n')
+    # An idle connection that the daemon has closed
+    dead = Mock()
+    dead.request.side_effect = http.client.RemoteDisconnected()
+    engine.pool.idle.append(dead)
+
+    engine.load(io.BytesIO(b"tar"))
+
+    dead.request.assert_not_called()
+    assert fake_daemon.requests[-1]["body"] == b"tar"
+
+
+def test_pull(fake_daemon, engine):
+    fake_daemon.routes[("POST", "/images/create")] = (200, b'{"status": "done"}\n')
+
+    engine.pull("localhost:5000/test:1.0")
+
+    request = fake_daemon.requests[-1]
+    assert request["params"] == {"fromImage": "localhost:5000/test", "tag": "1.0"}
+
+
+def test_pull_stream_error(fake_daemon, engine):
+    fake_daemon.routes[("POST", "/images/create")] = (
+        200,
+        b'{"status": "pulling"}\n{"error": "manifest unknown"}\n',
+    )
+
+    with pytest.raises(SocketEngine.APIException, match="manifest unknown"):
+        engine.pull("test")
+
+
+def test_push_with_login(fake_daemon, engine):
+    fake_daemon.routes[("POST", "/auth")] = (200, {"Status": "Login Succeeded"})
+    fake_daemon.routes[("POST", "/images/docker.io/test/push")] = (200, b"")
+
+    engine.login("docker.io", "user", "pass")
+    engine.push("docker.io/test:1.0")
+
+    request = fake_daemon.requests[-1]
+    assert request["params"] == {"tag": "1.0"}
+    auth = json.loads(base64.urlsafe_b64decode(request["headers"]["X-Registry-Auth"]))
+    assert auth["username"] == "user"
+    assert auth["serveraddress"] == "docker.io"
+
+
+def test_login_failed(fake_daemon, engine):
+    fake_daemon.routes[("POST", "/auth")] = (401, {"message": "unauthorized"})
+
+    with pytest.raises(SocketEngine.APIException, match="unauthorized"):
+        engine.login(None, "user", "bad")
+
+
+def test_tag(fake_daemon, engine):
+    fake_daemon.routes[("POST", "/images/test/tag")] = (201, b"")
+
+    engine.tag("test", "docker.io/test:1.0")
+
+    assert fake_daemon.requests[-1]["params"] == {
+        "repo": "docker.io/test",
+        "tag": "1.0",
+    }
+
+
+def test_build_fallback(engine):
+    with patch.object(engine.fallback, "build") as mock_build:
+        engine.build("test", None, "Dockerfile", {})
+
+    mock_build.assert_called_once_with("test", None, "Dockerfile", {}, None, (), None)
+
+
+def test_build_cache_fallback(engine):
+    context = lambda f: f.write(b"tar")
+    with patch.object(engine.fallback, "build") as mock_build:
+        engine.build("test", None, "Dockerfile", {}, context, ["reg/test:cache"])
+
+    mock_build.assert_called_once_with(
+        "test", None, "Dockerfile", {}, context, ["reg/test:cache"], None
+    )
+
+
+def test_build_cache_fallback_login(fake_daemon, engine):
+    fake_daemon.routes[("POST", "/auth")] = (200, {"Status": "Login Succeeded"})
+    engine.login("reg.example.com", "user", "pass")
+    engine.set_credentials("stored.example.com", "user", "pass")
+
+    context = lambda f: f.write(b"tar")
+    with patch.object(engine.fallback, "build"), patch.object(
+        engine.fallback, "login"
+    ) as mock_login:
+        for _ in range(2):
+            engine.build(
+                "test",
+                None,
+                "Dockerfile",
+                {},
+                context,
+                ["stored.example.com/test:cache"],
+                "reg.example.com/test:cache",
+            )
+
+    mock_login.assert_called_once_with("reg.example.com", "user", "pass")
+
+
+@patch("subprocess.run")
+def test_cli_build_cache(mock_run):
+    CLIEngine().build(
+        "test",
+        None,
+        "Dockerfile",
+        {},
+        cache_from=["reg/test:buildcache", "reg/test:old"],
+        cache_to="reg/test:buildcache",
+    )
+
+    assert mock_run.call_args.args[0] == [
+        "docker",
+        "buildx",
+        "build",
+        "--load",
+        "-t",
+        "test",
+        ".",
+        "-f",
+        "Dockerfile",
+        "--cache-from",
+        "type=registry,ref=reg/test:buildcache",
+        "--cache-from",
+        "type=registry,ref=reg/test:old",
+        "--cache-to",
+        "type=registry,ref=reg/test:buildcache,mode=max",
+    ]
+
+
+@patch("asyncio.create_subprocess_exec")
+def test_cli_async(mock_exec):
+    mock_exec.return_value.wait = AsyncMock(return_value=0)
+
+    asyncio.run(CLIEngine().pull_async("test"))
+
+    assert mock_exec.call_args.args == ("docker", "pull", "test")
+
+
+@patch("asyncio.create_subprocess_exec")
+def test_cli_async_failure(mock_exec):
+    mock_exec.return_value.wait = AsyncMock(return_value=1)
+
+    with pytest.raises(subprocess.CalledProcessError):
+        asyncio.run(CLIEngine().push_async("test"))
+
+    assert asyncio.run(CLIEngine().image_exists_async("test")) is False
+
+
+def test_default_async(fake_daemon, engine):
+    fake_daemon.routes[("GET", "/images/test/json")] = (200, {})
+
+    assert asyncio.run(engine.image_exists_async("test")) is True
+
+
+def test_cli_build_stream():
+    received = []
+
+    def run(args, **kwargs):
+        received.append(kwargs["stdin"].read())
+
+    with patch("subprocess.run", side_effect=run) as mock_run:
+        CLIEngine().build(
+            "test", None, "Dockerfile", {"A": "B"}, context=lambda f: f.write(b"tar")
+        )
+
+    assert (
+        " ".join(mock_run.call_args.args[0])
+        == "docker build -t test - -f Dockerfile --build-arg A=B"
+    )
+    assert received == [b"tar"]
+
+
+def test_build_stream(fake_daemon, engine):
+    fake_daemon.routes[("POST", "/build")] = (
+        200,
+        b'{"stream": "Step 1/2"}\n{"stream": "\\n"}\n{"stream": "Step 2/2\\n"}\n',
+    )
+    messages = []
+
+    def listener(event):
+        if event.kind == "message":
+            messages.append((event.image, event.text))
+
+    report.add_listener(listener)
+    try:
+        engine.build(
+            "test", None, "Dockerfile", {"A": "B"}, context=lambda f: f.write(b"tar")
+        )
+    finally:
+        report.remove_listener(listener)
+
+    request = fake_daemon.requests[-1]
+    assert request["body"] == b"tar"
+    assert request["params"]["t"] == "test"
+    assert json.loads(request["params"]["buildargs"]) == {"A": "B"}
+    assert messages == [("test", "Step 1/2"), ("test", "Step 2/2")]
+
+    # The response was read to the end, so the connection is reused
+    assert len(engine.pool.idle) == 1
+
+
+def test_build_stream_error(fake_daemon, engine):
+    fake_daemon.routes[("POST", "/build")] = (200, b'{"error": "failed"}\n')
+
+    with pytest.raises(SocketEngine.APIException):
+        engine.build("test", None, "Dockerfile", {}, context=lambda f: f.write(b"tar"))
+
+
+def test_load_stream(fake_daemon, engine):
+    fake_daemon.routes[("POST", "/images/load")] = (200, b'{"stream": "Loaded"}\n')
+
+    engine.load(io.BytesIO(b"tar"))
+
+    request = fake_daemon.requests[-1]
+    assert request["body"] == b"tar"
+    assert request["params"]["quiet"] == "1"
+
+
+def test_cli_save():
+    with patch("subprocess.Popen") as mock_popen:
+        mock_popen.return_value.stdout = io.BytesIO(b"tar")
+        mock_popen.return_value.wait.return_value = 0
+        out = io.BytesIO()
+        CLIEngine().save("test:1.0", out)
+
+    assert " ".join(mock_popen.call_args.args[0]) == "docker save test:1.0"
+    assert out.getvalue() == b"tar"
+
+
+def test_cli_load_failure():
+    with patch("subprocess.Popen") as mock_popen:
+        mock_popen.return_value.wait.return_value = 1
+        with pytest.raises(subprocess.CalledProcessError):
+            CLIEngine().load(io.BytesIO(b"tar"))
@@ -0,0 +1,115 @@
+import pytest
+
+from dockerensure import report
+from dockerensure.buildconfig import BuildConfig
+from dockerensure.eviction import UsageIndex, evict
+from dockerensure.filepolicy import FilePolicy
+from dockerensure.image import DockerImage
+from dockerensure.registry import DockerRegistry
+
+
+@pytest.fixture
+def index(fake_engine):
+    index = UsageIndex(":memory:")
+    for i, reference in enumerate(
+        ["app:1", "app:2", "app:3", "app:4", "base:1", "base:2", "tool:1"]
+    ):
+        fake_engine.images[reference] = f"sha256:{reference}"
+        index.record(reference, used=i)
+    yield index
+    index.close()
+
+
+def test_keep_per_repository(fake_engine, index):
+    assert sorted(evict(index, keep=2)) == ["app:1", "app:2"]
+
+    assert "app:1" not in fake_engine.images
+    assert ("remove_image", "app:2") in fake_engine.calls
+    assert index.entries()["app"] == ["app:4", "app:3"]
+
+
+def test_live_parents_protected(fake_engine, index):
+    base = DockerImage("base", version="1")
+    app = DockerImage(
+        "app", BuildConfig(files=FilePolicy.Nothing, parents=[base]), version="1"
+    )
+
+    assert sorted(evict(index, [app], keep=1)) == ["app:2", "app:3"]
+    assert "base:1" in fake_engine.images
+    assert "app:1" in fake_engine.images
+
+
+def test_byte_budget(fake_engine, index):
+    fake_engine.sizes = {reference: 100 for reference in fake_engine.images}
+
+    evicted = evict(index, keep=None, max_bytes=450)
+
+    assert evicted == ["app:1", "app:2", "app:3"]
+
+
+def test_failed_removal_skipped(fake_engine, index):
+    remove_image = fake_engine.remove_image
+
+    def failing_remove(reference):
+        if reference == "app:1":
+            raise RuntimeError("image is being used by a running container")
+        remove_image(reference)
+
+    fake_engine.remove_image = failing_remove
+
+    with report.RunReport.record() as run:
+        evicted = evict(index, keep=2)
+
+    assert evicted == ["app:2"]
+    assert "app:1" in fake_engine.images
+    assert "app:2" not in fake_engine.images
+    assert index.entries()["app"] == ["app:4", "app:3", "app:1"]
+    assert run.counters["images_evicted"] == 1
+
+
+def test_dry_run(fake_engine, index):
+    evicted = evict(index, keep=1, dry_run=True)
+
+    assert sorted(evicted) == ["app:1", "app:2", "app:3", "base:1"]
+    assert len(fake_engine.images) == 7
+
+
+def test_missing_images_forgotten(fake_engine, index):
+    del fake_engine.images["tool:1"]
+
+    evict(index, keep=None)
+
+    assert "tool" not in index.entries()
+
+
+def test_records_ensured_images(fake_engine):
+    index = UsageIndex(":memory:")
+    fake_engine.images["app:latest"] = "sha256:1"
+    report.add_listener(index)
+    try:
+        DockerImage("app").ensure()
+    finally:
+        report.remove_listener(index)
+
+    assert index.entries() == {"app": ["app:latest"]}
+
+
+def test_registry_tags_removed(fake_engine):
+    index = UsageIndex(":memory:")
+    registry = DockerRegistry("registry.example.com")
+    report.add_listener(index)
+    try:
+        for version in ["1", "2"]:
+            fake_engine.images[f"app:{version}"] = f"sha256:{version}"
+            index.record(f"app:{version}", used=int(version))
+            registry.push_image(f"app:{version}", True)
+    finally:
+        report.remove_listener(index)
+
+    assert evict(index, keep=1) == ["app:1"]
+
+    assert "app:1" not in fake_engine.images
+    assert "registry.example.com/app:1" not in fake_engine.images
+    assert "registry.example.com/app:2" in fake_engine.images
+    assert index.aliases("app:1") == []
+    assert index.aliases("app:2") == ["registry.example.com/app:2"]
@@ -0,0 +1,171 @@
+import asyncio
+import threading
+from unittest.mock import AsyncMock, Mock
+
+import pytest
+
+from dockerensure.buildconfig import BuildConfig
+from dockerensure.filepolicy import FilePolicy
+from dockerensure.graph import ImageGraph, ensure_all, ensure_all_async
+from dockerensure.image import DockerImage
+
+
+@pytest.fixture(autouse=True)
+def engine(fake_engine):
+    return fake_engine
+
+
+def make_image(name, parents=(), ensure=None):
+    image = DockerImage(name, build_config=BuildConfig(parents=list(parents)))
+    image.ensure = Mock(side_effect=ensure)
+    return image
+
+
+@pytest.fixture
+def diamond():
+    base = make_image("base")
+    left = make_image("left", [base])
+    right = make_image("right", [base])
+    top = make_image("top", [left, right])
+    return base, left, right, top
+
+
+def test_dedupe(diamond):
+    base, left, right, top = diamond
+    graph = ImageGraph([top, left])
+
+    assert len(graph) == 4
+    assert graph.order[0] == "base"
+    assert graph.order[-1] == "top"
+    assert graph.dependents["base"] == ["left", "right"]
+
+
+def test_dedupe_by_reference():
+    base_a = make_image("base")
+    base_b = make_image("base")
+    graph = ImageGraph([make_image("a", [base_a]), make_image("b", [base_b])])
+
+    assert len(graph) == 3
+
+
+@pytest.mark.parametrize("with_hash", [False, True])
+def test_cycle(with_hash, tmp_path):
+    (tmp_path / "Dockerfile").write_text("FROM scratch\n")
+    config = dict(directory=tmp_path, files=FilePolicy.Nothing)
+    a = DockerImage("a", BuildConfig(**config), with_hash=with_hash)
+    b = DockerImage("b", BuildConfig(parents=[a], **config), with_hash=with_hash)
+    a.build_config.parents.append(b)
+
+    with pytest.raises(ImageGraph.CycleException):
+        ImageGraph([a])
+
+
+def test_ensure_once(diamond):
+    base, left, right, top = diamond
+    ensure_all([top, left, base])
+
+    for image in diamond:
+        image.ensure.assert_called_once_with(ensure_parents=False, push_pipeline=None)
+
+
+def test_ensure_order(diamond):
+    order = []
+    lock = threading.Lock()
+    for image in diamond:
+
+        def record(ensure_parents, push_pipeline, name=image.name):
+            with lock:
+                order.append(name)
+
+        image.ensure.side_effect = record
+
+    ensure_all([diamond[3]])
+
+    assert order[0] == "base"
+    assert order[-1] == "top"
+
+
+def test_ensure_concurrent():
+    barrier = threading.Barrier(2, timeout=5)
+
+    def meet(ensure_parents, push_pipeline):
+        barrier.wait()
+
+    ensure_all(
+        [make_image("a", ensure=meet), make_image("b", ensure=meet)], max_workers=2
+    )
+
+
+def test_failure_skips_dependents(diamond):
+    base, left, right, top = diamond
+    base.ensure.side_effect = DockerImage.BuildFailedException("Bad")
+    other = make_image("other")
+
+    with pytest.raises(ImageGraph.EnsureFailedException) as e:
+        ensure_all([top, other])
+
+    assert list(e.value.failures) == ["base"]
+    assert e.value.skipped == {"left", "right", "top"}
+    left.ensure.assert_not_called()
+    top.ensure.assert_not_called()
+    other.ensure.assert_called_once()
+
+
+def test_ensure_resolves_once(engine, diamond):
+    engine.images = {"base:latest": "sha256:1"}
+    seen = {}
+    for image in diamond:
+        image.ensure.side_effect = (
+            lambda ensure_parents, push_pipeline, image=image: seen.setdefault(
+                image.name, image.local
+            )
+        )
+    ensure_all([diamond[3]])
+
+    assert engine.calls == [("list_images",)]
+    assert [seen[image.name] for image in diamond] == [True, False, False, False]
+    # The answers only hold for the run
+    assert [image.local for image in diamond] == [None] * 4
+
+
+def test_ensure_async(diamond):
+    for image in diamond:
+        image.ensure_async = AsyncMock()
+
+    asyncio.run(ensure_all_async([diamond[3], diamond[1]]))
+
+    for image in diamond:
+        image.ensure_async.assert_awaited_once_with(ensure_parents=False)
+
+
+def test_ensure_async_limit():
+    running = []
+    peak = []
+
+    async def ensure(ensure_parents):
+        running.append(1)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.pop()
+
+    images = [make_image(f"image{i}") for i in range(6)]
+    for image in images:
+        image.ensure_async = AsyncMock(side_effect=ensure)
+
+    asyncio.run(ensure_all_async(images, limit=2))
+
+    assert max(peak) == 2
+
+
+def test_ensure_async_failure(diamond):
+    base, left, right, top = diamond
+    for image in diamond:
+        image.ensure_async = AsyncMock()
+    base.ensure_async.side_effect = DockerImage.BuildFailedException("Bad")
+
+    with pytest.raises(ImageGraph.EnsureFailedException) as e:
+        asyncio.run(ensure_all_async([top]))
+
+    assert list(e.value.failures) == ["base"]
+    assert e.value.skipped == {"left", "right", "top"}
+    top.ensure_async.assert_not_awaited()
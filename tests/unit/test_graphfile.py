@@ -0,0 +1,157 @@
+import json
+from unittest.mock import patch
+
+import pytest
+
+from dockerensure.__main__ import main, split_graph_target
+from dockerensure.buildconfig import BuildConfig
+from dockerensure.filepolicy import FilePolicy
+from dockerensure.graphfile import GraphFile
+from dockerensure.image import RemotePolicy
+from dockerensure.registry import DockerRegistry
+from dockerensure.tarballcache import TarballCache
+
+TOML = """
+lockfile = "dockerensure.lock"
+
+[registries.main]
+server = "registry.example.com"
+username = "ci"
+password_env = "TEST_REGISTRY_PASSWORD"
+
+[caches.shared]
+directory = "cache"
+max_bytes = 1000
+
+[images.base]
+version = "1"
+registry = "shared"
+build = { directory = "base", files = "dockerfile" }
+
+[images.app]
+name = "myorg/app"
+with_hash = true
+registry = "main"
+remote_policy = "pull_only"
+build = { directory = "app", parents = ["base"], files = { only = ["src"] }, interval = { days = 1 } }
+
+[images.worker]
+build = { directory = "app", parents = ["base"], build_args = { MODE = "worker" } }
+
+[images.python]
+name = "python:3.11"
+"""
+
+YAML = """
+images:
+  base:
+    build:
+      directory: base
+  app:
+    build:
+      directory: app
+      parents: [base]
+      files: nothing
+"""
+
+
+@pytest.fixture
+def project(tmp_path):
+    for directory in ("base", "app"):
+        (tmp_path / directory).mkdir()
+        (tmp_path / directory / "Dockerfile").write_text("FROM scratch")
+    (tmp_path / "images.toml").write_text(TOML)
+    (tmp_path / "images.yaml").write_text(YAML)
+    return tmp_path
+
+
+def test_load_toml(project, monkeypatch):
+    monkeypatch.setenv("TEST_REGISTRY_PASSWORD", "secret")
+    graph = GraphFile.load(project / "images.toml")
+
+    base, app, worker, python = graph.select()
+    assert isinstance(graph.registries["main"], DockerRegistry)
+    assert graph.registries["main"].password == "secret"
+    assert isinstance(base.registry, TarballCache)
+    assert base.registry.directory == project / "cache"
+    assert base.build_config.files is FilePolicy.FromDockerfile
+    assert base.build_config.directory == project / "base"
+
+    assert app.name == "myorg/app"
+    assert app.remote_policy is RemotePolicy.PULL_ONLY
+    assert app.build_config.parents == [base]
+    assert worker.build_config.parents[0] is base
+    assert app.build_config.files == FilePolicy.Only(["src"])
+    assert app.build_config.interval.interval.days == 1
+    assert app.build_config.digest_cache is worker.build_config.digest_cache
+    assert app.lockfile is graph.lockfile
+
+    assert python.build_config is None
+    assert python.ref == "python:3.11"
+
+
+def test_load_yaml(project):
+    graph = GraphFile.load(project / "images.yaml")
+    assert [image.name for image in graph.select(["app"])] == ["app"]
+    assert graph.images["app"].build_config.files is FilePolicy.Nothing
+
+
+@pytest.mark.parametrize(
+    "data, message",
+    [
+        ({}, "no images"),
+        ({"images": {"a": {"colour": "red"}}}, "unknown settings"),
+        ({"images": {"a": {"build": {"parents": ["b"]}}}}, "unknown parent"),
+        (
+            {
+                "images": {
+                    "a": {"build": {"parents": ["b"]}},
+                    "b": {"build": {"parents": ["a"]}},
+                }
+            },
+            "a -> b -> a",
+        ),
+        ({"images": {"a": {"registry": "nowhere"}}}, "unknown registry"),
+        ({"images": {"a": {"remote_policy": "sometimes"}}}, "remote policy"),
+        ({"images": {"a": {"build": {"files": "some"}}}}, "files policy"),
+    ],
+)
+def test_invalid(tmp_path, data, message):
+    with pytest.raises(GraphFile.InvalidGraphException, match=message):
+        GraphFile(data, tmp_path)
+
+
+def test_unknown_target(project):
+    graph = GraphFile.load(project / "images.yaml")
+    with pytest.raises(GraphFile.InvalidGraphException, match="missing"):
+        graph.select(["missing"])
+
+
+def test_split_graph_target():
+    assert split_graph_target("images.toml") == ("images.toml", None)
+    assert split_graph_target("dir/images.yml:a,b") == ("dir/images.yml", ["a", "b"])
+    assert split_graph_target("images:app") is None
+
+
+def test_cli_ensures_targets_together(fake_engine, project, capsys):
+    graph_path = str(project / "images.yaml")
+    with patch.object(BuildConfig, "create_docker_ignore_file"):
+        assert main([f"{graph_path}:app", f"{graph_path}:base"]) == 0
+
+    builds = [call for call in fake_engine.calls if call[0] == "build"]
+    assert [call[1].split(":")[0] for call in builds] == ["base", "app"]
+
+
+def test_cli_plan(fake_engine, project, capsys):
+    assert main(["--plan", str(project / "images.yaml")]) == 0
+
+    plan = json.loads(capsys.readouterr().out)
+    assert [image["action"] for image in plan["images"]] == ["build", "build"]
+
+
+def test_cli_saves_lockfile(fake_engine, project):
+    fake_engine.images = {"python:3.11": "sha256:py"}
+    assert main([str(project / "images.toml") + ":python"]) == 0
+
+    lock = json.loads((project / "dockerensure.lock").read_text())
+    assert lock["images"]["python:3.11"]["id"] == "sha256:py"
@@ -1,6 +1,8 @@
 import hashlib
 import tempfile
 
+import pytest
+
 from dockerensure.hasher import Hasher
 
 
@@ -39,3 +41,40 @@ def test_hash_file():
         hasher.add_file(f.name)
 
     assert hasher.hexdigest() == expected.hexdigest()
+
+
+def test_hash_file_chunked(tmp_path):
+    path = tmp_path / "data"
+    path.write_bytes(bytes(range(256)) * 10)
+
+    whole = Hasher()
+    whole.add_file(path)
+
+    chunked = Hasher(chunk_size=7)
+    chunked.add_file(path)
+
+    assert chunked.hexdigest() == whole.hexdigest()
+
+
+def test_hash_files(tmp_path):
+    paths = []
+    for i in range(5):
+        path = tmp_path / f"file{i}"
+        path.write_bytes(str(i).encode() * (i * 100))
+        paths.append(path)
+
+    expected = Hasher(chunk_size=64)
+    for path in paths:
+        expected.add_file(path)
+
+    hasher = Hasher(chunk_size=64)
+    hasher.add_files(paths, buffers=2)
+
+    assert hasher.hexdigest() == expected.hexdigest()
+
+
+def test_hash_files_missing(tmp_path):
+    (tmp_path / "exists").write_text("test")
+
+    with pytest.raises(FileNotFoundError):
+        Hasher().add_files([tmp_path / "exists", tmp_path / "missing"])
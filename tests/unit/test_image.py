@@ -1,4 +1,6 @@
+import asyncio
 import os
+import threading
 from unittest.mock import Mock, patch
 
 import pytest
@@ -34,9 +36,8 @@ class TestName:
         with pytest.raises(DockerImage.UnhashableReferenceException):
             DockerImage("base", with_hash=True)
 
-    def test_hash_unhashable_config(self):
-        with pytest.raises(DockerImage.UnhashableReferenceException):
-            DockerImage("base", with_hash=True, build_config=BuildConfig())
+    def test_hash_whole_context(self):
+        DockerImage("base", with_hash=True, build_config=BuildConfig())
 
     def test_prepend_server(self):
         image = DockerImage("base", registry=DockerRegistry("docker.io"))
@@ -99,7 +100,7 @@ class TestEnsure:
             di.ensure()
 
     def test_build(self, capsys):
-        mock_bc = Mock(spec=BuildConfig)
+        mock_bc = Mock(spec=BuildConfig, parents=[])
         di = DockerImage("test", build_config=mock_bc)
         di.has_local_image = Mock(return_value=False)
 
@@ -108,7 +109,7 @@ class TestEnsure:
         assert "Built image" in capsys.readouterr().out
 
     def test_push(self, capsys):
-        mock_bc = Mock(spec=BuildConfig)
+        mock_bc = Mock(spec=BuildConfig, parents=[])
         mock_registry = Mock(spec=DockerRegistry)
         di = DockerImage(
             "test",
@@ -132,3 +133,255 @@ class TestEnsure:
 
         with pytest.raises(DockerImage.BuildFailedException):
             di.ensure()
+
+
+class TestResolveLocal:
+    def test_resolve(self, fake_engine):
+        fake_engine.images = {"base:latest": "sha256:1", "other:1.0": "sha256:2"}
+        images = [
+            DockerImage("docker.io/library/base"),
+            DockerImage("other", version="2.0"),
+        ]
+
+        assert DockerImage.resolve_local_images(images) == {
+            "docker.io/library/base": True,
+            "other:2.0": False,
+        }
+        assert fake_engine.calls == [("list_images",)]
+
+        assert images[0].has_local_image() is True
+        assert fake_engine.calls == [("list_images",)]
+
+    def test_ensure_graph(self, fake_engine):
+        fake_engine.images = {"base:latest": "sha256:1"}
+        base = DockerImage("base")
+        middle = DockerImage("middle", BuildConfig(parents=[base]))
+        top = DockerImage("top", BuildConfig(parents=[middle, base]))
+        middle.build_config.build_image = Mock()
+        top.build_config.build_image = Mock()
+
+        top.ensure()
+
+        # The parents are resolved together once top turns out to need a build
+        assert fake_engine.calls == [("image_exists", "top"), ("list_images",)]
+
+    def test_existing_image_parents_not_checked(self, fake_engine):
+        registry = DockerRegistry("registry.example.com")
+        registry.resolve_remote_images = Mock()
+        registry.has_remote_image = Mock()
+        fake_engine.images = {"top:latest": "sha256:1"}
+        base = registry.image("base")
+        middle = registry.image("middle", BuildConfig(parents=[base]))
+        top = DockerImage("top", BuildConfig(parents=[middle, base]))
+
+        top.ensure()
+
+        assert fake_engine.calls == [("image_exists", "top")]
+        registry.resolve_remote_images.assert_not_called()
+        registry.has_remote_image.assert_not_called()
+
+    def test_removed_between_ensures(self, fake_engine):
+        base = DockerImage("base", BuildConfig(files=FilePolicy.Nothing))
+        top = DockerImage("top", BuildConfig(files=FilePolicy.Nothing, parents=[base]))
+        with patch.object(BuildConfig, "create_docker_ignore_file"):
+            top.ensure()
+            fake_engine.images = {}
+            fake_engine.calls = []
+            top.ensure()
+
+        assert fake_engine.calls.count(("build", "base")) == 1
+        assert fake_engine.calls.count(("build", "top")) == 1
+
+    def test_digest_reference_inspected(self, fake_engine):
+        reference = "base@sha256:" + "a" * 64
+        base = DockerImage(reference)
+        fake_engine.images = {reference: "sha256:1"}
+
+        assert DockerImage.resolve_local_images([base]) == {reference: True}
+        assert ("image_exists", reference) in fake_engine.calls
+
+
+class TestRemote:
+    def test_missing_on_server_not_pulled(self):
+        mock_registry = Mock(spec=DockerRegistry)
+        mock_registry.has_remote_image.return_value = False
+        di = DockerImage("test", registry=mock_registry)
+        di.has_local_image = Mock(return_value=False)
+
+        assert di.check_existence() is False
+        mock_registry.try_pull_image.assert_not_called()
+
+    def test_exists_without_pull(self):
+        mock_registry = Mock(spec=DockerRegistry)
+        mock_registry.has_remote_image.return_value = True
+        di = DockerImage("test", registry=mock_registry)
+        di.has_local_image = Mock(return_value=False)
+
+        assert di.check_existence(pull=False) is True
+        mock_registry.try_pull_image.assert_not_called()
+
+    def test_unknown_falls_back_to_pull(self):
+        mock_registry = Mock(spec=DockerRegistry)
+        mock_registry.has_remote_image.return_value = None
+        di = DockerImage("test", registry=mock_registry)
+        di.has_local_image = Mock(return_value=False)
+
+        assert di.check_existence() is True
+        mock_registry.try_pull_image.assert_called_once()
+
+
+class TestEnsureAsync:
+    def test_exists_locally(self, fake_engine, capsys):
+        fake_engine.images = {"test:latest": "sha256:1"}
+
+        asyncio.run(DockerImage("test").ensure_async())
+
+        assert "exists locally" in capsys.readouterr().out
+
+    def test_build_with_parent(self, fake_engine):
+        parent = DockerImage("parent", BuildConfig(files=FilePolicy.Nothing))
+        child = DockerImage(
+            "child", BuildConfig(files=FilePolicy.Nothing, parents=[parent])
+        )
+
+        with patch.object(BuildConfig, "create_docker_ignore_file"):
+            asyncio.run(child.ensure_async())
+
+        builds = [call for call in fake_engine.calls if call[0] == "build"]
+        assert builds == [("build", "parent"), ("build", "child")]
+
+    def test_diamond_built_once(self, fake_engine):
+        def make(name, *parents):
+            config = BuildConfig(files=FilePolicy.Nothing, parents=list(parents))
+            return DockerImage(name, config)
+
+        base = make("base")
+        top = make("top", make("left", base), make("right", base))
+
+        with patch.object(BuildConfig, "create_docker_ignore_file"):
+            asyncio.run(top.ensure_async())
+
+        builds = [call[1] for call in fake_engine.calls if call[0] == "build"]
+        assert sorted(builds) == ["base", "left", "right", "top"]
+        assert builds[0] == "base" and builds[-1] == "top"
+
+    def test_blocking_work_off_loop(self, fake_engine):
+        parent = DockerImage(
+            "parent", BuildConfig(files=FilePolicy.Nothing), with_hash=True
+        )
+        child = DockerImage(
+            "child",
+            BuildConfig(files=FilePolicy.Nothing, parents=[parent]),
+            with_hash=True,
+        )
+        threads = []
+
+        def get_hash(config):
+            threads.append(threading.current_thread())
+            return "0" * 64
+
+        def cache_references(image):
+            threads.append(threading.current_thread())
+            return [], None
+
+        with patch.object(BuildConfig, "get_hash", get_hash), patch.object(
+            DockerImage, "cache_references", cache_references
+        ), patch.object(BuildConfig, "create_docker_ignore_file"):
+            asyncio.run(child.ensure_async())
+
+        assert len(threads) == 4
+        assert threading.main_thread() not in threads
+
+    def test_push(self, fake_engine):
+        registry = DockerRegistry("docker.io")
+        registry.has_remote_image = Mock(return_value=False)
+        image = registry.image("test", BuildConfig(files=FilePolicy.Nothing))
+
+        with patch.object(BuildConfig, "create_docker_ignore_file"):
+            asyncio.run(image.ensure_async())
+
+        assert ("push", "docker.io/test") in fake_engine.calls
+
+
+class TestTransitiveHash:
+    def make(self, directory, name, parents=(), **build_args):
+        config = BuildConfig(
+            files=FilePolicy.Nothing,
+            directory=directory,
+            parents=list(parents),
+            build_args=build_args,
+        )
+        return DockerImage(name, config, with_hash=True)
+
+    def test_parent_change_propagates(self, tmp_path):
+        (tmp_path / "Dockerfile").write_text("FROM scratch")
+
+        def top_ref(base_version):
+            base = self.make(tmp_path, "base", VERSION=base_version)
+            middle = self.make(tmp_path, "middle", [base])
+            return self.make(tmp_path, "top", [middle]).ref
+
+        assert top_ref("1") == top_ref("1")
+        assert top_ref("1") != top_ref("2")
+
+    def test_hashed_once(self, tmp_path):
+        (tmp_path / "Dockerfile").write_text("FROM scratch")
+        base = self.make(tmp_path, "base")
+        base.build_config.get_hash = Mock(wraps=base.build_config.get_hash)
+        left = self.make(tmp_path, "left", [base])
+        right = self.make(tmp_path, "right", [base])
+        self.make(tmp_path, "top", [left, right]).ref
+
+        base.build_config.get_hash.assert_called_once()
+
+
+class TestBuildCache:
+    def make(self, remote_policy=RemotePolicy.ALL, lockfile=None):
+        registry = DockerRegistry("reg.example.com")
+        registry.has_remote_image = Mock(return_value=False)
+        return registry.image(
+            "app",
+            BuildConfig(files=FilePolicy.Nothing),
+            version="2",
+            build_cache=True,
+            remote_policy=remote_policy,
+            lockfile=lockfile,
+        )
+
+    def test_disabled(self):
+        image = self.make()
+        image.build_cache = False
+
+        assert image.cache_references() == ([], None)
+
+    def test_policies(self):
+        cache = "reg.example.com/app:buildcache"
+
+        assert self.make().cache_references() == ([cache], cache)
+        assert self.make(RemotePolicy.PULL_ONLY).cache_references() == ([cache], None)
+        assert self.make(RemotePolicy.PUSH_ONLY).cache_references() == ([], cache)
+        assert self.make(RemotePolicy.NONE).cache_references() == ([], None)
+
+    def test_previous_reference(self):
+        lockfile = Mock(previous_reference=Mock(return_value="app:1"))
+
+        cache_from, _ = self.make(lockfile=lockfile).cache_references()
+
+        assert cache_from == [
+            "reg.example.com/app:buildcache",
+            "reg.example.com/app:1",
+        ]
+
+    @patch("subprocess.run")
+    def test_ensure(self, mock_run):
+        mock_run.return_value.returncode = 1
+        image = self.make(RemotePolicy.PUSH_ONLY)
+
+        with patch.object(BuildConfig, "create_docker_ignore_file"):
+            image.ensure()
+
+        commands = [" ".join(call.args[0]) for call in mock_run.call_args_list]
+        assert (
+            "docker buildx build --load -t app:2 . -f Dockerfile "
+            "--cache-to type=registry,ref=reg.example.com/app:buildcache,mode=max"
+        ) in commands
@@ -0,0 +1,81 @@
+import json
+from unittest.mock import patch
+
+import pytest
+
+from dockerensure.buildconfig import BuildConfig
+from dockerensure.filepolicy import FilePolicy
+from dockerensure.image import DockerImage
+from dockerensure.lockfile import Lockfile
+
+
+@pytest.fixture
+def context(tmp_path):
+    directory = tmp_path / "context"
+    directory.mkdir()
+    (directory / "Dockerfile").write_text("FROM scratch")
+    (directory / "app.py").write_text("print('hello')")
+    return directory
+
+
+def make_image(context, lockfile):
+    return DockerImage(
+        "app",
+        BuildConfig(files=FilePolicy.Only(["app.py"]), directory=context),
+        with_hash=True,
+        lockfile=lockfile,
+    )
+
+
+def ensure(context, path):
+    with Lockfile(path) as lockfile:
+        image = make_image(context, lockfile)
+        with patch.object(BuildConfig, "create_docker_ignore_file"):
+            image.ensure()
+    return image
+
+
+def test_warm_run(fake_engine, context, tmp_path):
+    path = tmp_path / "dockerensure.lock"
+    image = ensure(context, path)
+
+    entry = json.loads(path.read_text())["images"]["app"]
+    assert entry["reference"] == image.ref
+    assert entry["id"] == f"sha256:{image.ref}"
+
+    fake_engine.calls = []
+    with patch.object(BuildConfig, "get_hash") as get_hash:
+        warm = ensure(context, path)
+
+    get_hash.assert_not_called()
+    assert warm.ref == image.ref
+    assert fake_engine.calls == [("image_id", image.ref)]
+
+
+def test_image_replaced(fake_engine, context, tmp_path):
+    path = tmp_path / "dockerensure.lock"
+    image = ensure(context, path)
+    fake_engine.images = {}
+
+    ensure(context, path)
+
+    assert fake_engine.calls.count(("build", image.ref)) == 2
+
+
+def test_inputs_changed(fake_engine, context, tmp_path):
+    path = tmp_path / "dockerensure.lock"
+    image = ensure(context, path)
+    (context / "app.py").write_text("print('goodbye')")
+
+    changed = ensure(context, path)
+
+    assert changed.ref != image.ref
+    assert ("build", changed.ref) in fake_engine.calls
+    assert json.loads(path.read_text())["images"]["app"]["reference"] == changed.ref
+
+
+def test_unreadable_lockfile(tmp_path):
+    path = tmp_path / "dockerensure.lock"
+    path.write_text("not json")
+
+    assert Lockfile(path).entries == {}
@@ -0,0 +1,189 @@
+import os
+import threading
+import time
+from unittest.mock import Mock, patch
+
+import pytest
+
+from dockerensure.buildconfig import BuildConfig
+from dockerensure.image import DockerImage
+from dockerensure.locks import BuildLocks
+from dockerensure.registry import DockerRegistry
+from dockerensure.utils import normalize_reference
+
+
+@pytest.mark.parametrize("use_flock", [True, False])
+def test_second_holder_waits(tmp_path, use_flock):
+    locks = BuildLocks(tmp_path, poll_interval=0.01, use_flock=use_flock)
+    held = threading.Event()
+    release = threading.Event()
+    order = []
+
+    def first():
+        with locks.hold("app:1") as waited:
+            order.append(("first", waited))
+            held.set()
+            release.wait(5)
+            order.append("first released")
+
+    thread = threading.Thread(target=first)
+    thread.start()
+    held.wait(5)
+
+    def second():
+        with locks.hold("app:1") as waited:
+            order.append(("second", waited))
+
+    waiter = threading.Thread(target=second)
+    waiter.start()
+    time.sleep(0.1)
+    release.set()
+    thread.join()
+    waiter.join()
+
+    assert order == [("first", False), "first released", ("second", True)]
+
+
+def test_other_references_dont_wait(tmp_path):
+    locks = BuildLocks(tmp_path)
+    with locks.hold("app:1"):
+        with locks.hold("app:2") as waited:
+            assert not waited
+
+
+def test_lease_removed_on_release(tmp_path):
+    locks = BuildLocks(tmp_path, use_flock=False)
+    with locks.hold("app:1"):
+        assert os.path.exists(locks.path("app:1"))
+    assert not os.path.exists(locks.path("app:1"))
+
+
+def test_expired_lease_taken_over(tmp_path):
+    locks = BuildLocks(tmp_path, stale_after=60, use_flock=False)
+    path = locks.path("app:1")
+    with open(path, "w") as f:
+        f.write("otherhost 1\n")
+    old = time.time() - 120
+    os.utime(path, (old, old))
+
+    with locks.hold("app:1") as waited:
+        assert not waited
+
+
+def test_dead_holder_lease_taken_over(tmp_path):
+    locks = BuildLocks(tmp_path, use_flock=False)
+    with patch("dockerensure.locks.socket.gethostname", return_value="here"):
+        with open(locks.path("app:1"), "w") as f:
+            f.write("here 999999999\n")
+        with locks.hold("app:1") as waited:
+            assert not waited
+
+
+def test_live_lease_not_taken_over(tmp_path):
+    locks = BuildLocks(tmp_path, poll_interval=0.01, use_flock=False)
+    with open(locks.path("app:1"), "w") as f:
+        f.write("otherhost 1\n")
+    assert locks._stale_key(locks.path("app:1")) is None
+
+
+def test_empty_lease_expires(tmp_path):
+    # The holder died between creating the lease and writing its host and pid
+    locks = BuildLocks(tmp_path, stale_after=0.2, use_flock=False)
+    path = locks.path("app:1")
+    open(path, "w").close()
+    old = time.time() - 100
+    os.utime(path, (old, old))
+
+    with locks.hold("app:1") as waited:
+        assert not waited
+
+
+def test_fresh_lease_not_taken_over(tmp_path):
+    locks = BuildLocks(tmp_path, stale_after=60, use_flock=False)
+    path = locks.path("app:1")
+    with open(path, "w") as f:
+        f.write("otherhost 1\n")
+    old = time.time() - 120
+    os.utime(path, (old, old))
+    stale_key = locks._stale_key(path)
+    assert stale_key is not None
+
+    # Another waiter takes over first and creates its own lease
+    os.unlink(path)
+    with open(path, "w") as f:
+        f.write("otherhost 2\n")
+
+    locks._take_over(path, stale_key)
+
+    with open(path) as f:
+        assert f.read() == "otherhost 2\n"
+    assert os.listdir(tmp_path) == [os.path.basename(path)]
+
+
+def make_image(tmp_path, locks, registry=None):
+    (tmp_path / "Dockerfile").write_text("FROM scratch")
+    return DockerImage(
+        "app",
+        BuildConfig(directory=tmp_path),
+        version="1",
+        registry=registry,
+        build_locks=locks,
+    )
+
+
+def test_waiter_uses_image_built_by_holder(fake_engine, tmp_path):
+    locks = BuildLocks(tmp_path / "locks")
+    image = make_image(tmp_path, locks)
+    ready = threading.Event()
+
+    def other_process():
+        with locks.hold(image.ref):
+            ready.set()
+            time.sleep(0.1)
+            fake_engine.images[normalize_reference(image.ref)] = "sha256:other"
+
+    thread = threading.Thread(target=other_process)
+    thread.start()
+    ready.wait(5)
+    with patch.object(BuildConfig, "create_docker_ignore_file"):
+        image.ensure()
+    thread.join()
+
+    assert ("build", image.ref) not in fake_engine.calls
+    assert fake_engine.calls.count(("image_exists", image.ref)) == 2
+
+
+def test_builds_when_unlocked(fake_engine, tmp_path):
+    image = make_image(tmp_path, BuildLocks(tmp_path / "locks"))
+    with patch.object(BuildConfig, "create_docker_ignore_file"):
+        image.ensure()
+
+    assert ("build", image.ref) in fake_engine.calls
+    assert fake_engine.calls.count(("image_exists", image.ref)) == 1
+
+
+def test_waiter_uses_image_pushed_by_holder(fake_engine, tmp_path):
+    """A holder on another host pushes the image, which the waiter then pulls"""
+
+    locks = BuildLocks(tmp_path / "locks", poll_interval=0.01, use_flock=False)
+    registry = DockerRegistry("registry.example.com")
+    registry.has_remote_image = Mock(return_value=False)
+    registry.try_pull_image = Mock(return_value=True)
+    image = make_image(tmp_path, locks, registry)
+    ready = threading.Event()
+
+    def other_host():
+        with locks.hold(image.ref):
+            ready.set()
+            time.sleep(0.1)
+            registry.has_remote_image.return_value = True
+
+    thread = threading.Thread(target=other_host)
+    thread.start()
+    ready.wait(5)
+    with patch.object(BuildConfig, "create_docker_ignore_file"):
+        image.ensure()
+    thread.join()
+
+    assert ("build", image.ref) not in fake_engine.calls
+    registry.try_pull_image.assert_called_once_with(image.ref, True)
@@ -0,0 +1,81 @@
+import json
+import sys
+from unittest.mock import Mock
+
+import pytest
+
+from dockerensure import DockerRegistry, plan_all
+from dockerensure.__main__ import main
+from dockerensure.buildconfig import BuildConfig
+from dockerensure.filepolicy import FilePolicy
+from dockerensure.image import DockerImage, RemotePolicy
+
+
+@pytest.fixture
+def graph(tmp_path):
+    (tmp_path / "Dockerfile").write_text("FROM scratch")
+    registry = Mock(spec=DockerRegistry)
+    registry.has_remote_image.side_effect = lambda ref, prepend: {
+        "remote": True,
+        "missing": False,
+    }.get(ref)
+
+    def make(name, parents=(), **kwargs):
+        config = BuildConfig(
+            files=FilePolicy.Nothing, directory=tmp_path, parents=list(parents)
+        )
+        return DockerImage(name, config, registry=registry, **kwargs)
+
+    local = make("local")
+    remote = make("remote", [local])
+    missing = make("missing", [local])
+    unknown = make("unknown", [remote, missing])
+    forced = make("forced", force_build=True, remote_policy=RemotePolicy.PULL_ONLY)
+    return [local, remote, missing, unknown, forced]
+
+
+def test_plan(fake_engine, graph, tmp_path):
+    fake_engine.images = {"local:latest": "sha256:1", "forced:latest": "sha256:2"}
+
+    plan = plan_all(graph[3:])
+
+    assert [(entry.reference, entry.action, entry.push) for entry in plan] == [
+        ("local", "local", False),
+        ("remote", "pull", False),
+        ("missing", "build", True),
+        ("unknown", "pull_or_build", True),
+        ("forced", "build", False),
+    ]
+    assert plan["unknown"].parents == ["remote", "missing"]
+    assert plan.to_build == ["missing", "unknown", "forced"]
+    assert plan.summary() == {
+        "local": 1,
+        "pull": 1,
+        "pull_or_build": 1,
+        "build": 2,
+        "push": 2,
+    }
+
+    # Nothing was pulled, built or written
+    assert fake_engine.calls == [("list_images",)]
+    assert not (tmp_path / ".dockerignore").exists()
+
+
+def test_cli_plan(fake_engine, tmp_path, monkeypatch, capsys):
+    (tmp_path / "Dockerfile").write_text("FROM scratch")
+    (tmp_path / "planimages.py").write_text(
+        "from dockerensure import BuildConfig, DockerImage\n"
+        "from dockerensure.filepolicy import FilePolicy\n"
+        "base = DockerImage('base')\n"
+        "app = DockerImage('app', BuildConfig(files=FilePolicy.Nothing, parents=[base]))\n"
+    )
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, "path", list(sys.path))
+    fake_engine.images = {"base:latest": "sha256:1"}
+
+    assert main(["--plan", "planimages:app"]) == 0
+
+    plan = json.loads(capsys.readouterr().out)
+    assert [image["action"] for image in plan["images"]] == ["local", "build"]
+    assert plan["summary"]["build"] == 1
+    assert ("build", "app") not in fake_engine.calls
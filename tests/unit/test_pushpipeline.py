@@ -0,0 +1,102 @@
+import threading
+from unittest.mock import Mock
+
+import pytest
+
+from dockerensure import DockerRegistry
+from dockerensure.buildconfig import BuildConfig
+from dockerensure.graph import ImageGraph, ensure_all
+from dockerensure.image import DockerImage, RemotePolicy
+from dockerensure.pushpipeline import PushPipeline
+
+
+def make_image(name, registry, parents=()):
+    image = DockerImage(
+        name,
+        build_config=Mock(spec=BuildConfig, parents=list(parents)),
+        registry=registry,
+        remote_policy=RemotePolicy.PUSH_ONLY,
+    )
+    image.local = False
+    return image
+
+
+def test_push_in_background():
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_push(ref, prepend_server):
+        started.set()
+        assert release.wait(5)
+
+    registry = Mock(spec=DockerRegistry)
+    registry.push_image.side_effect = slow_push
+
+    with PushPipeline() as pushes:
+        make_image("a", registry).ensure(push_pipeline=pushes)
+        assert started.wait(5)
+        # The push is still running but the next image can be built
+        b = make_image("b", registry)
+        b.ensure(push_pipeline=pushes)
+        b.build_config.build_image.assert_called_once()
+        release.set()
+
+    assert registry.push_image.call_count == 2
+
+
+def test_retry():
+    registry = Mock(spec=DockerRegistry)
+    registry.push_image.side_effect = [Exception("Timeout"), Exception("Timeout"), None]
+    pipeline = PushPipeline(retries=2, backoff=0)
+
+    make_image("a", registry).ensure(push_pipeline=pipeline)
+
+    assert pipeline.flush() == {}
+    assert registry.push_image.call_count == 3
+
+
+def test_failures_aggregated():
+    good = Mock(spec=DockerRegistry)
+    bad = Mock(spec=DockerRegistry)
+    bad.push_image.side_effect = Exception("Denied")
+
+    with pytest.raises(PushPipeline.PushFailedException) as e:
+        with PushPipeline(retries=1, backoff=0) as pushes:
+            for image in [
+                make_image("a", bad),
+                make_image("b", good),
+                make_image("c", bad),
+            ]:
+                image.ensure(push_pipeline=pushes)
+
+    assert sorted(e.value.failures) == ["a", "c"]
+    assert bad.push_image.call_count == 4
+    good.push_image.assert_called_once()
+
+
+def test_flush_resets():
+    registry = Mock(spec=DockerRegistry)
+    registry.push_image.side_effect = [Exception("Denied"), None]
+    pipeline = PushPipeline(retries=0)
+    image = make_image("a", registry)
+
+    pipeline.submit(image)
+    assert list(pipeline.flush()) == ["a"]
+
+    pipeline.submit(image)
+    assert pipeline.flush() == {}
+    pipeline.close()
+
+
+def test_graph_reports_push_failures(fake_engine):
+    registry = Mock(spec=DockerRegistry)
+    registry.push_image.side_effect = lambda ref, prepend: ref == "base" and 1 / 0
+    base = make_image("base", registry)
+    top = make_image("top", registry, [base])
+
+    with pytest.raises(ImageGraph.EnsureFailedException) as e:
+        ensure_all([top], push_pipeline=PushPipeline(retries=0))
+
+    assert list(e.value.failures) == ["base"]
+    # Only the push failed, so the dependent was still built
+    top.build_config.build_image.assert_called_once()
@@ -1,6 +1,11 @@
 from unittest.mock import patch
 
+import pytest
+
+from dockerensure.absentcache import AbsentCache
+from dockerensure.graph import ImageGraph
 from dockerensure.registry import DockerRegistry
+from dockerensure.registryclient import RegistryClient
 
 
 @patch("subprocess.run")
@@ -90,3 +95,131 @@ def test_docker_image_shortcut():
     reg = DockerRegistry("docker.io")
     image = reg.image("test")
     assert image.registry == reg
+
+
+@pytest.fixture
+def registry(fake_registry):
+    fake_registry.images = {"test": {"1.0"}}
+    return DockerRegistry(fake_registry.host)
+
+
+def test_has_remote_image(registry):
+    assert registry.has_remote_image("test:1.0", True) is True
+    assert registry.has_remote_image("test:2.0", True) is False
+    assert registry.has_remote_image(registry.server + "/test:1.0", False) is True
+
+
+def test_has_remote_image_unreachable():
+    registry = DockerRegistry("127.0.0.1:1")
+
+    assert registry.has_remote_image("test:1.0", True) is None
+
+
+def test_resolve_remote_images(fake_registry, registry):
+    images = [registry.image("test", version=v) for v in ["1.0", "2.0", "3.0"]]
+
+    assert registry.resolve_remote_images(images) == {
+        "test:1.0": True,
+        "test:2.0": False,
+        "test:3.0": False,
+    }
+    listings = [r for r in fake_registry.requests if r[1].endswith("/tags/list")]
+    assert len(listings) == 2  # The first is rejected to fetch a token
+
+    requests = len(fake_registry.requests)
+    assert registry.has_remote_image("test:1.0", True) is True
+    assert len(fake_registry.requests) == requests
+
+
+@patch("subprocess.run")
+def test_push_updates_tags(mock_run, registry):
+    registry.resolve_remote_images([registry.image("test", version="1.0")])
+    registry.push_image("test:2.0", True)
+
+    assert registry.has_remote_image("test:2.0", True) is True
+
+
+def test_listing_kept_for_one_run(fake_engine, fake_registry, registry):
+    image = registry.image("test", version="1.0")
+    ImageGraph([image]).plan()
+
+    # Another runner pushes a tag after the first run listed the repository
+    fake_registry.images["test"].add("3.0")
+
+    assert registry.has_remote_image("test:3.0", True) is True
+
+
+def test_listing_kept_for_whole_graph(fake_engine, fake_registry, registry):
+    fake_registry.images["test"] |= {"2.0", "3.0"}
+    images = [registry.image("test", version=v) for v in ["1.0", "2.0", "3.0"]]
+
+    # The images have no build configs, and the fake engine can't pull
+    with pytest.raises(ImageGraph.EnsureFailedException):
+        ImageGraph(images).ensure(max_workers=1)
+
+    assert fake_engine.calls.count(("pull", registry.server + "/test:1.0")) == 1
+    assert not [r for r in fake_registry.requests if "/manifests/" in r[1]]
+    assert registry.remote_tags == {}
+
+
+@patch("subprocess.run")
+def test_absent_cached(mock_run, fake_registry, registry):
+    assert registry.has_remote_image("test:2.0", True) is False
+    requests = len(fake_registry.requests)
+
+    assert registry.has_remote_image("test:2.0", True) is False
+    assert registry.try_pull_image("test:2.0", True) is False
+    assert len(fake_registry.requests) == requests
+    mock_run.assert_not_called()
+
+    registry.push_image("test:2.0", True)
+    fake_registry.images["test"].add("2.0")
+
+    assert registry.has_remote_image("test:2.0", True) is True
+
+
+def test_forget_image(fake_registry, registry):
+    registry.resolve_remote_images([registry.image("test", version="2.0")])
+    assert registry.has_remote_image("test:2.0", True) is False
+
+    fake_registry.images["test"].add("2.0")
+    registry.forget_image("test:2.0", True)
+
+    assert registry.has_remote_image("test:2.0", True) is True
+
+
+def test_absent_cache_shared(fake_registry, tmp_path):
+    path = tmp_path / "absent.sqlite"
+    first = DockerRegistry(fake_registry.host, absent_cache=AbsentCache(path=path))
+    first.resolve_remote_images([first.image("test", version="2.0")])
+    requests = len(fake_registry.requests)
+
+    second = DockerRegistry(fake_registry.host, absent_cache=AbsentCache(path=path))
+    assert second.resolve_remote_images([second.image("test", version="2.0")]) == {
+        "test:2.0": False
+    }
+    assert len(fake_registry.requests) == requests
+
+
+@pytest.mark.parametrize(
+    "remote_name,host,repository",
+    [
+        ("test:1.0", "registry-1.docker.io", "test"),
+        ("docker.io/library/test:1.0", "registry-1.docker.io", "test"),
+        ("docker.io/org/test:1.0", "registry-1.docker.io", "org/test"),
+        ("ghcr.io/org/test:1.0", "ghcr.io", "org/test"),
+    ],
+)
+def test_fully_qualified_names(remote_name, host, repository):
+    registry = DockerRegistry(None)
+    queried = []
+
+    def manifest_exists(client, name, tag):
+        queried.append((client.host, name, tag))
+        return False
+
+    with patch.object(RegistryClient, "manifest_exists", manifest_exists):
+        assert registry.has_remote_image(remote_name, False) is False
+
+    assert queried == [(host, repository, "1.0")]
+    assert registry.absent_cache.is_absent(host, remote_name)
@@ -0,0 +1,55 @@
+import http.client
+
+import pytest
+
+from dockerensure.registryclient import DOCKER_HUB_HOST, RegistryClient
+
+
+@pytest.fixture
+def client(fake_registry):
+    fake_registry.images = {"test": {"1.0", "2.0"}}
+    client = RegistryClient(fake_registry.host)
+    yield client
+    client.close()
+
+
+def test_manifest_exists(client):
+    assert client.manifest_exists("test", "1.0") is True
+    assert client.manifest_exists("test", "3.0") is False
+    assert client.manifest_exists("missing", "1.0") is False
+
+
+def test_token_reused(fake_registry, client):
+    for _ in range(3):
+        client.manifest_exists("test", "1.0")
+
+    assert fake_registry.token_requests == 1
+
+
+def test_connection_reused(fake_registry, client):
+    for _ in range(3):
+        client.manifest_exists("test", "1.0")
+
+    # One connection to the registry and one for the token
+    assert fake_registry.connections == 2
+
+
+def test_list_tags(client):
+    assert sorted(client.list_tags("test")) == ["1.0", "2.0"]
+    assert client.list_tags("missing") == []
+
+
+def test_docker_hub_repository():
+    client = RegistryClient()
+
+    assert client.host == DOCKER_HUB_HOST
+    assert client.repository("alpine") == "library/alpine"
+    assert client.repository("user/image") == "user/image"
+
+
+def test_secure_default():
+    local = RegistryClient("localhost:5000").pool.factory()
+    remote = RegistryClient("example.com").pool.factory()
+
+    assert not isinstance(local, http.client.HTTPSConnection)
+    assert isinstance(remote, http.client.HTTPSConnection)
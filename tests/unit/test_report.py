@@ -0,0 +1,112 @@
+import json
+import time
+from unittest.mock import Mock
+
+import pytest
+
+from dockerensure import report
+from dockerensure.buildconfig import BuildConfig
+from dockerensure.filepolicy import FilePolicy
+from dockerensure.hasher import Hasher
+from dockerensure.image import DockerImage
+from dockerensure.report import RunReport
+
+
+def test_phase():
+    with RunReport.record() as run:
+        with report.phase("image", "build"):
+            pass
+
+        with pytest.raises(ValueError):
+            with report.phase("image", "push"):
+                raise ValueError()
+
+    assert [(p["phase"], p["outcome"]) for p in run.phases] == [
+        ("build", "ok"),
+        ("push", "failed"),
+    ]
+
+
+def test_listener_removed():
+    with RunReport.record() as run:
+        pass
+    report.count("test")
+
+    assert run.counters == {}
+
+
+def test_custom_listener(capsys):
+    listener = Mock()
+    report.add_listener(listener)
+    report.remove_listener(report.print_messages)
+    try:
+        report.message("image", "hello")
+    finally:
+        report.remove_listener(listener)
+        report.add_listener(report.print_messages)
+
+    assert listener.call_args.args[0].text == "hello"
+    assert capsys.readouterr().out == ""
+
+
+def test_bytes_hashed(tmp_path):
+    (tmp_path / "file").write_text("test")
+
+    with RunReport.record() as run:
+        Hasher().add_file(tmp_path / "file")
+
+    assert run.counters == {"bytes_hashed": 4}
+
+
+def test_ensure_report(fake_engine):
+    image = DockerImage("test", BuildConfig(files=FilePolicy.Nothing))
+    image.build_config.create_docker_ignore_file = Mock()
+
+    with RunReport.record() as run:
+        image.ensure()
+
+    data = json.loads(run.to_json())
+    phases = [p["phase"] for p in data["images"]["test"]["phases"]]
+    assert phases == ["inspect", "build"]
+    assert data["images"]["test"]["outcome"] == "built"
+    assert set(data["phase_totals"]) == {"inspect", "build"}
+
+
+def test_hashed_image_reported_once(fake_engine, tmp_path):
+    (tmp_path / "Dockerfile").write_text("FROM scratch")
+    config = BuildConfig(files=FilePolicy.Nothing, directory=tmp_path)
+    image = DockerImage("test", config, with_hash=True)
+    config.create_docker_ignore_file = Mock()
+
+    with RunReport.record() as run:
+        image.ensure()
+
+    data = run.to_dict()
+    assert list(data["images"]) == [image.ref]
+    phases = [p["phase"] for p in data["images"][image.ref]["phases"]]
+    assert phases == ["hash", "inspect", "build"]
+
+
+def test_build_phase_excludes_parents(fake_engine):
+    parent = DockerImage("parent", BuildConfig(files=FilePolicy.Nothing))
+    child = DockerImage(
+        "child", BuildConfig(files=FilePolicy.Nothing, parents=[parent])
+    )
+    for image in (parent, child):
+        image.build_config.create_docker_ignore_file = Mock()
+
+    build = fake_engine.build
+
+    def slow_build(name, *args, **kwargs):
+        if name == "parent":
+            time.sleep(0.2)
+        build(name, *args, **kwargs)
+
+    fake_engine.build = slow_build
+
+    with RunReport.record() as run:
+        child.ensure()
+
+    durations = {(p["image"], p["phase"]): p["duration"] for p in run.phases}
+    assert durations[("parent", "build")] >= 0.2
+    assert durations[("child", "build")] < 0.2
@@ -0,0 +1,162 @@
+import asyncio
+import base64
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from dockerensure.registry import DockerRegistry
+from dockerensure.sessions import get_session, stored_credentials
+
+
+def write_config(config):
+    path = os.path.join(os.environ["DOCKER_CONFIG"], "config.json")
+    with open(path, "w") as f:
+        json.dump(config, f)
+
+
+def encode(username, password):
+    return base64.b64encode(f"{username}:{password}".encode()).decode()
+
+
+def logins(fake_engine):
+    return [call for call in fake_engine.calls if call[0] == "login"]
+
+
+def test_registries_share_session(fake_engine):
+    first = DockerRegistry("registry.example.com", "user", "pass")
+    second = DockerRegistry("registry.example.com", "user", "pass")
+    first.login()
+    second.login()
+
+    assert first.session is second.session
+    assert first.client is second.client
+    assert second.loggedin
+    assert logins(fake_engine) == [("login", "registry.example.com", "user")]
+
+
+def test_sessions_keyed_by_user(fake_engine):
+    DockerRegistry("registry.example.com", "first", "pass").login()
+    DockerRegistry("registry.example.com", "second", "pass").login()
+
+    assert len(logins(fake_engine)) == 2
+
+
+def test_docker_hub_names_share_session():
+    assert get_session("docker.io", "user") is get_session(None, "user")
+
+
+def test_concurrent_logins(fake_engine):
+    registries = [DockerRegistry("registry.example.com", "user", "pass")] * 8
+    threads = [threading.Thread(target=registry.login) for registry in registries]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(logins(fake_engine)) == 1
+
+
+def test_stored_credentials_reused(fake_engine):
+    write_config({"auths": {"registry.example.com": {"auth": encode("user", "pass")}}})
+
+    registry = DockerRegistry("registry.example.com", "user")
+    assert registry.client.password == "pass"
+    registry.login()
+
+    assert logins(fake_engine) == []
+    assert ("set_credentials", "registry.example.com", "user") in fake_engine.calls
+
+
+def test_docker_hub_stored_credentials():
+    write_config(
+        {"auths": {"https://index.docker.io/v1/": {"auth": encode("user", "pass")}}}
+    )
+    assert stored_credentials("docker.io") == ("user", "pass")
+    assert stored_credentials(None) == ("user", "pass")
+    assert stored_credentials("registry.example.com") is None
+
+
+def test_stale_stored_credentials(fake_engine):
+    write_config({"auths": {"registry.example.com": {"auth": encode("user", "old")}}})
+
+    DockerRegistry("registry.example.com", "user", "new").login()
+
+    assert len(logins(fake_engine)) == 1
+
+
+def test_password_change_logs_in_again(fake_engine):
+    DockerRegistry("registry.example.com", "user", "old").login()
+    registry = DockerRegistry("registry.example.com", "user", "new")
+    assert not registry.loggedin
+    registry.login()
+
+    assert len(logins(fake_engine)) == 2
+    assert registry.client.password == "new"
+
+
+@pytest.mark.skipif(os.name != "posix", reason="Needs an executable script")
+def test_credential_helper(tmp_path, monkeypatch):
+    helper = tmp_path / "docker-credential-test"
+    helper.write_text(
+        "#!/bin/sh\n"
+        "read server\n"
+        'echo "{\\"ServerURL\\": \\"$server\\", \\"Username\\": \\"user\\", \\"Secret\\": \\"pass\\"}"\n'
+    )
+    helper.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+    write_config({"credHelpers": {"registry.example.com": "test"}})
+    assert stored_credentials("registry.example.com") == ("user", "pass")
+
+    write_config({"credsStore": "test", "auths": {"other.example.com": {}}})
+    assert stored_credentials("other.example.com") == ("user", "pass")
+    assert stored_credentials("registry.example.com") is None
+
+
+def test_missing_credential_helper():
+    write_config({"credHelpers": {"registry.example.com": "missing"}})
+    assert stored_credentials("registry.example.com") is None
+
+
+def test_concurrent_async_logins_wait(fake_engine):
+    events = []
+
+    def slow_login(server, username, password):
+        events.append("login start")
+        time.sleep(0.1)
+        events.append("login done")
+
+    fake_engine.login = slow_login
+    registry = DockerRegistry("registry.example.com", "user", "pass")
+
+    async def pull(name):
+        await registry.login_async()
+        events.append(f"pull {name}")
+
+    async def main():
+        await asyncio.gather(pull(1), pull(2))
+
+    asyncio.run(main())
+
+    assert events[:2] == ["login start", "login done"]
+    assert sorted(events[2:]) == ["pull 1", "pull 2"]
+
+
+def test_thread_and_async_login_once(fake_engine):
+    calls = []
+
+    def slow_login(server, username, password):
+        calls.append(username)
+        time.sleep(0.1)
+
+    fake_engine.login = slow_login
+    registry = DockerRegistry("registry.example.com", "user", "pass")
+    thread = threading.Thread(target=registry.login)
+    thread.start()
+    asyncio.run(registry.login_async())
+    thread.join()
+
+    assert calls == ["user"]
@@ -0,0 +1,103 @@
+import os
+import time
+from unittest.mock import patch
+
+import pytest
+
+from dockerensure.buildconfig import BuildConfig
+from dockerensure.image import RemotePolicy
+from dockerensure.tarballcache import TarballCache
+from dockerensure.utils import normalize_reference
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return TarballCache(tmp_path / "cache")
+
+
+def test_round_trip(fake_engine, cache):
+    fake_engine.images[normalize_reference("app:1")] = "sha256:abc"
+    assert not cache.has_remote_image("app:1", True)
+
+    cache.push_image("app:1", True)
+    assert cache.has_remote_image("app:1", True)
+    assert os.listdir(cache.directory) == [os.path.basename(cache.path("app:1"))]
+
+    fake_engine.images = {}
+    assert cache.try_pull_image("app:1", True)
+    assert fake_engine.images == {normalize_reference("app:1"): "sha256:abc"}
+
+
+def test_missing_archive(fake_engine, cache):
+    assert not cache.try_pull_image("app:1", True)
+    assert fake_engine.calls == []
+
+
+def test_corrupt_archive(fake_engine, cache):
+    with open(cache.path("app:1"), "wb") as f:
+        f.write(b"not gzip")
+    assert not cache.try_pull_image("app:1", True)
+
+
+def test_failed_save_leaves_nothing(fake_engine, cache):
+    with patch.object(fake_engine, "save", side_effect=Exception("daemon went away")):
+        with pytest.raises(Exception):
+            cache.push_image("app:1", True)
+    assert os.listdir(cache.directory) == []
+
+
+def test_evicts_least_recently_used(fake_engine, tmp_path):
+    cache = TarballCache(tmp_path / "cache", max_bytes=1)
+    for index, reference in enumerate(["app:1", "app:2"]):
+        fake_engine.images[normalize_reference(reference)] = f"sha256:{index}"
+        cache.push_image(reference, True)
+
+    assert not cache.has_remote_image("app:1", True)
+    assert cache.has_remote_image("app:2", True)
+
+
+def test_load_refreshes_recency(fake_engine, tmp_path):
+    cache = TarballCache(tmp_path / "cache")
+    for reference in ["app:1", "app:2"]:
+        fake_engine.images[normalize_reference(reference)] = "sha256:abc"
+        cache.push_image(reference, True)
+    old = time.time() - 60
+    os.utime(cache.path("app:1"), (old, old))
+    os.utime(cache.path("app:2"), (old - 60, old - 60))
+    cache.try_pull_image("app:2", True)
+
+    size = os.path.getsize(cache.path("app:1"))
+    cache.max_bytes = size
+    assert cache.evict() == [cache.path("app:1")]
+
+
+def make_image(tmp_path, cache, **kwargs):
+    (tmp_path / "Dockerfile").write_text("FROM scratch")
+    return cache.image("app", BuildConfig(directory=tmp_path), version="1", **kwargs)
+
+
+def test_ensure_saves_then_loads(fake_engine, cache, tmp_path):
+    image = make_image(tmp_path, cache)
+    with patch.object(BuildConfig, "create_docker_ignore_file"):
+        image.ensure()
+    assert ("save", image.ref) in fake_engine.calls
+
+    fake_engine.images = {}
+    fake_engine.calls = []
+    image = make_image(tmp_path, cache)
+    image.ensure()
+
+    assert ("load",) in fake_engine.calls
+    assert ("build", image.ref) not in fake_engine.calls
+
+
+def test_no_build_cache(cache, tmp_path):
+    image = make_image(tmp_path, cache, build_cache=True)
+    assert image.cache_references() == ([], None)
+
+
+def test_pull_only_does_not_save(fake_engine, cache, tmp_path):
+    image = make_image(tmp_path, cache, remote_policy=RemotePolicy.PULL_ONLY)
+    with patch.object(BuildConfig, "create_docker_ignore_file"):
+        image.ensure()
+    assert os.listdir(cache.directory) == []
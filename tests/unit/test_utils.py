@@ -3,7 +3,7 @@ from unittest.mock import Mock, patch
 
 import pytest
 
-from dockerensure.utils import IntervalOffset
+from dockerensure.utils import IntervalOffset, registry_host, split_reference
 
 
 @pytest.mark.parametrize(
@@ -32,3 +32,31 @@ def test_intervals(mock_datetime, interval, offset, intervals):
     mock_datetime.now.return_value = now
 
     assert IntervalOffset(interval, offset).get_intervals() == intervals
+
+
+@pytest.mark.parametrize(
+    "reference,repository,tag",
+    [
+        ("image", "image", None),
+        ("image:1.0", "image", "1.0"),
+        ("host:5000/image", "host:5000/image", None),
+        ("host:5000/image:1.0", "host:5000/image", "1.0"),
+        ("image@sha256:abc", "image", "sha256:abc"),
+    ],
+)
+def test_split_reference(reference, repository, tag):
+    assert split_reference(reference) == (repository, tag)
+
+
+@pytest.mark.parametrize(
+    "reference,host",
+    [
+        ("image", None),
+        ("user/image:1.0", None),
+        ("docker.io/image", "docker.io"),
+        ("localhost/image", "localhost"),
+        ("host:5000/image:1.0", "host:5000"),
+    ],
+)
+def test_registry_host(reference, host):
+    assert registry_host(reference) == host
@@ -0,0 +1,130 @@
+import threading
+import time
+
+import pytest
+
+from dockerensure.buildconfig import BuildConfig
+from dockerensure.filepolicy import FilePolicy
+from dockerensure.image import DockerImage
+from dockerensure.watch import InotifyWatcher, PollingWatcher, Watch
+
+
+@pytest.fixture
+def project(tmp_path):
+    for name in ["base", "app", "other"]:
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "Dockerfile").write_text("FROM scratch")
+        (tmp_path / name / "main.py").write_text("1")
+        (tmp_path / name / "notes.txt").write_text("1")
+
+    def make(name, parents=()):
+        config = BuildConfig(
+            files=FilePolicy.AllBut(["*.txt"]),
+            directory=tmp_path / name,
+            parents=list(parents),
+            stream_context=True,
+        )
+        return DockerImage(name, config, with_hash=True)
+
+    base = make("base")
+    app = make("app", [base])
+    other = make("other")
+    return tmp_path, base, app, other
+
+
+def test_affected(project):
+    root, base, app, other = project
+    watch = Watch([app, other])
+
+    assert watch.affected([root / "base" / "main.py"]) == [base]
+    assert watch.affected([root / "app" / "Dockerfile"]) == [app]
+    assert watch.affected([root / "app" / "notes.txt"]) == []
+    assert watch.affected([root / "elsewhere.py"]) == []
+
+
+def test_rebuild_dependents(fake_engine, project):
+    root, base, app, other = project
+    watch = Watch([app, other])
+    watch.run(stop=_stopped())
+    old_refs = (base.ref, app.ref, other.ref)
+
+    (root / "base" / "main.py").write_text("2")
+    rebuilt = watch.rebuild([str(root / "base" / "main.py")])
+
+    assert rebuilt == [base, app]
+    assert base.ref != old_refs[0]
+    assert app.ref != old_refs[1]
+    assert other.ref == old_refs[2]
+    builds = [call[1] for call in fake_engine.calls if call[0] == "build"]
+    assert builds[-2:] == [base.ref, app.ref]
+
+
+def test_polling_watcher(tmp_path):
+    path = tmp_path / "file"
+    path.write_text("1")
+
+    def snapshot():
+        return {
+            str(p): (p.stat().st_mtime_ns, p.stat().st_size) for p in tmp_path.iterdir()
+        }
+
+    watcher = PollingWatcher(snapshot, interval=0.01)
+    assert watcher.wait(0) == set()
+
+    path.write_text("22")
+    (tmp_path / "new").write_text("1")
+    assert watcher.wait(1) == {str(path), str(tmp_path / "new")}
+
+
+def test_inotify_watcher(tmp_path):
+    try:
+        watcher = InotifyWatcher([str(tmp_path)])
+    except (OSError, AttributeError, TypeError):
+        pytest.skip("inotify is not available")
+
+    try:
+        (tmp_path / "sub").mkdir()
+        assert str(tmp_path / "sub") in watcher.wait(1)
+
+        (tmp_path / "sub" / "file").write_text("1")
+        changed = set()
+        deadline = time.monotonic() + 2
+        while str(tmp_path / "sub" / "file") not in changed:
+            assert time.monotonic() < deadline
+            changed |= watcher.wait(0.1)
+    finally:
+        watcher.close()
+
+
+@pytest.mark.parametrize("use_inotify", [None, False])
+def test_debounce(fake_engine, project, use_inotify):
+    root, base, app, other = project
+    watch = Watch([other], debounce=0.3, poll_interval=0.05, use_inotify=use_inotify)
+    rebuilds = []
+    original = watch.rebuild
+    watch.rebuild = lambda changed: rebuilds.append(original(changed))
+
+    stop = threading.Event()
+    thread = threading.Thread(target=watch.run, args=(stop,))
+    thread.start()
+    try:
+        time.sleep(0.2)
+        for i in range(5):
+            (root / "other" / "main.py").write_text(str(i))
+            time.sleep(0.05)
+
+        deadline = time.monotonic() + 5
+        while not rebuilds and time.monotonic() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.5)
+    finally:
+        stop.set()
+        thread.join()
+
+    assert rebuilds == [[other]]
+
+
+def _stopped():
+    stop = threading.Event()
+    stop.set()
+    return stop